@@ -22,4 +22,24 @@ app.conf.beat_schedule = {
         'task': 'users.tasks.block_inactive_users', # Путь к задаче
         'schedule': crontab(hour=0, minute=0), # Запуск каждый день в 00:00
     },
+    'dispatch-notification-outbox-every-minute': {
+        'task': 'lms.tasks.dispatch_notification_outbox',
+        'schedule': 60.0, # Outbox рассылок об обновлении курсов
+    },
+    'flush-last-seen-every-5-minutes': {
+        'task': 'users.tasks.flush_last_seen',
+        'schedule': 5 * 60.0, # Активность пользователей из кэша в БД
+    },
+    'send-daily-digest': {
+        'task': 'lms.tasks.send_daily_digest',
+        'schedule': crontab(hour=8, minute=0), # Сводка для режима digest
+    },
+    'reconcile-payments-every-15-minutes': {
+        'task': 'users.tasks.reconcile_payments',
+        'schedule': 15 * 60.0, # Статусы платежей, webhook которых не дошел
+    },
+    'expire-pending-checkouts-every-5-minutes': {
+        'task': 'users.tasks.expire_pending_checkouts',
+        'schedule': 5 * 60.0, # Платежи, сессия оплаты которых потеряна
+    },
 }
@@ -0,0 +1,181 @@
+"""Почтовый бэкенд с пулом постоянных SMTP-соединений.
+
+Стандартный SMTP-бэкенд Django открывает новое соединение (TCP + STARTTLS +
+AUTH) на каждый send_mail / get_connection(). В воркере Celery это
+занимает большую часть времени задачи рассылки и упирается в лимиты
+провайдера на число подключений. PooledSMTPEmailBackend берет уже
+авторизованное соединение из пула процесса, а при закрытии возвращает
+его обратно.
+"""
+
+import os
+import smtplib
+import threading
+import time
+
+from django.conf import settings
+from django.core.mail.backends.smtp import EmailBackend
+from django.core.mail.message import sanitize_address
+
+# Ошибки, после которых соединение считается оборванным и письмо
+# отправляется повторно через новое соединение
+RECONNECT_ERRORS = (smtplib.SMTPServerDisconnected, ConnectionError)
+
+
+def _quit(connection):
+    try:
+        connection.quit()
+    except (smtplib.SMTPException, OSError):
+        connection.close()
+
+
+class SMTPConnectionPool:
+    """Свободные соединения к одному SMTP-серверу (с одними учетными данными)"""
+
+    def __init__(self):
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def get(self, max_idle):
+        """Последнее возвращенное соединение, простаивавшее не дольше max_idle
+        секунд (дольше простаивавшие сервер скорее всего уже закрыл)"""
+        now = time.monotonic()
+        with self._lock:
+            while self._idle:
+                connection = self._idle.pop()
+                if now - connection.pool_released_at <= max_idle:
+                    return connection
+                _quit(connection)
+        return None
+
+    def put(self, connection, size):
+        connection.pool_released_at = time.monotonic()
+        with self._lock:
+            if len(self._idle) < size:
+                self._idle.append(connection)
+                return
+        _quit(connection)
+
+    def clear(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for connection in idle:
+            _quit(connection)
+
+    def __len__(self):
+        return len(self._idle)
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+# Сокеты нельзя делить между процессами: после fork (prefork-воркеры
+# Celery) дочерний процесс начинает с пустыми пулами
+os.register_at_fork(after_in_child=_pools.clear)
+
+
+def get_pool(key):
+    with _pools_lock:
+        return _pools.setdefault(key, SMTPConnectionPool())
+
+
+class PooledSMTPEmailBackend(EmailBackend):
+    """SMTP-бэкенд, переиспользующий соединения между вызовами и задачами.
+
+    - pool_size - сколько свободных соединений держать в процессе;
+    - max_messages - после стольких писем соединение закрывается
+      и открывается заново (лимиты провайдеров на сессию);
+    - max_idle - соединения, простаивавшие дольше (сек), не переиспользуются.
+
+    Если сервер закрыл соединение, письмо прозрачно отправляется
+    повторно через новое соединение
+    """
+
+    def __init__(
+        self, *args, pool_size=None, max_messages=None, max_idle=None, **kwargs
+    ):
+        super().__init__(*args, **kwargs)
+        self.pool_size = settings.EMAIL_POOL_SIZE if pool_size is None else pool_size
+        self.max_messages = (
+            settings.EMAIL_POOL_MAX_MESSAGES if max_messages is None else max_messages
+        )
+        self.max_idle = settings.EMAIL_POOL_MAX_IDLE if max_idle is None else max_idle
+        self.pool = get_pool(
+            (self.host, self.port, self.username, self.use_tls, self.use_ssl)
+        )
+
+    def open(self):
+        if self.connection:
+            return False
+
+        self.connection = self.pool.get(self.max_idle)
+        if self.connection:
+            return True
+        return self._open_new()
+
+    def _open_new(self):
+        """Открывает новое соединение, минуя пул"""
+        opened = super().open()
+        if self.connection:
+            self.connection.pool_messages = 0
+        return opened
+
+    def close(self):
+        """Возвращает соединение в пул вместо QUIT"""
+        if self.connection is None:
+            return
+        connection, self.connection = self.connection, None
+        if connection.pool_messages < self.max_messages:
+            self.pool.put(connection, self.pool_size)
+        else:
+            _quit(connection)
+
+    def _discard(self):
+        """Закрывает текущее соединение, не возвращая его в пул"""
+        connection, self.connection = self.connection, None
+        if connection is not None:
+            connection.close()
+
+    def _sendmail(self, from_email, recipients, message):
+        if self.connection.pool_messages >= self.max_messages:
+            _quit(self.connection)
+            self.connection = None
+            self._open_new()
+            if not self.connection:
+                raise smtplib.SMTPServerDisconnected("Не удалось переподключиться")
+        self.connection.pool_messages += 1
+        self.connection.sendmail(from_email, recipients, message)
+
+    def _send(self, email_message):
+        if not email_message.recipients():
+            return False
+        encoding = email_message.encoding or settings.DEFAULT_CHARSET
+        from_email = sanitize_address(email_message.from_email, encoding)
+        recipients = [
+            sanitize_address(addr, encoding) for addr in email_message.recipients()
+        ]
+        message = email_message.message().as_bytes(linesep="\r\n")
+        try:
+            try:
+                self._sendmail(from_email, recipients, message)
+            except RECONNECT_ERRORS:
+                # Соединение из пула закрыто сервером: одна попытка через новое.
+                # Другие соединения пула могли оборваться так же, поэтому
+                # повтор идет через свежее соединение, а не из пула
+                self._discard()
+                self._open_new()
+                if not self.connection:
+                    return False
+                self._sendmail(from_email, recipients, message)
+        except smtplib.SMTPRecipientsRefused:
+            # Сервер ответил отказом, сессия цела - соединение остается
+            if not self.fail_silently:
+                raise
+            return False
+        except (smtplib.SMTPException, OSError):
+            # Соединение в неизвестном состоянии не должно вернуться в пул
+            self._discard()
+            if not self.fail_silently:
+                raise
+            return False
+        return True
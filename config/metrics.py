@@ -0,0 +1,51 @@
+"""Простые метрики приложения.
+
+Каждое значение пишется строкой в лог "lms.metrics" (оттуда его забирает
+сборщик логов) и сохраняется в кэше, чтобы последнее значение можно было
+прочитать из кода или shell без внешней системы мониторинга.
+"""
+
+import logging
+
+from django.core.cache import cache
+
+logger = logging.getLogger("lms.metrics")
+
+METRICS_CACHE_TIMEOUT = 60 * 60 * 24
+
+
+def _key(name):
+    return f"metrics:{name}"
+
+
+def _log(kind, name, value, tags):
+    extra = "".join(f" {tag}={tag_value}" for tag, tag_value in sorted(tags.items()))
+    logger.info("%s %s=%s%s", kind, name, value, extra)
+
+
+def gauge(name, value, **tags):
+    """Текущее значение величины (глубина очереди, возраст и т.д.)"""
+    _log("gauge", name, value, tags)
+    cache.set(_key(name), value, timeout=METRICS_CACHE_TIMEOUT)
+
+
+def incr(name, value=1, **tags):
+    """Счетчик событий"""
+    _log("counter", name, value, tags)
+    key = _key(name)
+    if not cache.add(key, value, timeout=METRICS_CACHE_TIMEOUT):
+        try:
+            cache.incr(key, value)
+        except ValueError:
+            cache.set(key, value, timeout=METRICS_CACHE_TIMEOUT)
+
+
+def timing(name, milliseconds, **tags):
+    """Длительность операции (мс)"""
+    _log("timing", name, round(milliseconds, 2), tags)
+    cache.set(_key(name), milliseconds, timeout=METRICS_CACHE_TIMEOUT)
+
+
+def get_metric(name, default=None):
+    """Последнее значение метрики"""
+    return cache.get(_key(name), default)
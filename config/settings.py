@@ -8,6 +8,17 @@ load_dotenv()
 BASE_DIR = Path(__file__).resolve().parent.parent
 
 STRIPE_API_KEY = os.getenv("STRIPE_API_KEY")
+STRIPE_WEBHOOK_SECRET = os.getenv("STRIPE_WEBHOOK_SECRET")
+# Клиент Stripe (users/stripe_client.py): адрес API, таймауты подключения и
+# чтения (сек), сетевые повторы, соединений в пуле процесса, предохранитель:
+# сбоев подряд до размыкания и пауза до пробного запроса (сек)
+STRIPE_API_BASE = os.getenv("STRIPE_API_BASE", "https://api.stripe.com")
+STRIPE_CONNECT_TIMEOUT = float(os.getenv("STRIPE_CONNECT_TIMEOUT", 3))
+STRIPE_READ_TIMEOUT = float(os.getenv("STRIPE_READ_TIMEOUT", 20))
+STRIPE_MAX_NETWORK_RETRIES = int(os.getenv("STRIPE_MAX_NETWORK_RETRIES", 2))
+STRIPE_POOL_SIZE = int(os.getenv("STRIPE_POOL_SIZE", 10))
+STRIPE_BREAKER_THRESHOLD = int(os.getenv("STRIPE_BREAKER_THRESHOLD", 5))
+STRIPE_BREAKER_RESET = float(os.getenv("STRIPE_BREAKER_RESET", 30))
 
 SECRET_KEY = os.getenv("SECRET_KEY")
 
@@ -26,6 +37,7 @@ INSTALLED_APPS = [
     "django.contrib.sessions",
     "django.contrib.messages",
     "django.contrib.staticfiles",
+    "django.contrib.postgres",
     "rest_framework",
     "django_filters",
     "rest_framework_simplejwt",
@@ -42,6 +54,7 @@ MIDDLEWARE = [
     "django.middleware.common.CommonMiddleware",
     "django.middleware.csrf.CsrfViewMiddleware",
     "django.contrib.auth.middleware.AuthenticationMiddleware",
+    "users.middleware.LastSeenMiddleware",
     "django.contrib.messages.middleware.MessageMiddleware",
     "django.middleware.clickjacking.XFrameOptionsMiddleware",
     "corsheaders.middleware.CorsMiddleware",
@@ -103,12 +116,83 @@ USE_I18N = True
 
 USE_TZ = True
 
-EMAIL_BACKEND = 'django.core.mail.backends.smtp.EmailBackend'
+# SMTP с пулом постоянных соединений (config/mail.py)
+EMAIL_BACKEND = os.getenv("EMAIL_BACKEND", "config.mail.PooledSMTPEmailBackend")
 EMAIL_HOST = os.getenv("EMAIL_HOST")
 EMAIL_PORT = os.getenv("EMAIL_PORT", 587)
 EMAIL_USE_TLS = os.getenv("EMAIL_USE_TLS", True)
 EMAIL_HOST_USER = os.getenv("EMAIL_HOST_USER")
 EMAIL_HOST_PASSWORD = os.getenv("EMAIL_HOST_PASSWORD")
+EMAIL_TIMEOUT = int(os.getenv("EMAIL_TIMEOUT", 30))
+
+# Пул SMTP-соединений процесса: число свободных соединений, писем
+# на одно соединение и максимальный простой соединения (сек)
+EMAIL_POOL_SIZE = int(os.getenv("EMAIL_POOL_SIZE", 2))
+EMAIL_POOL_MAX_MESSAGES = int(os.getenv("EMAIL_POOL_MAX_MESSAGES", 100))
+EMAIL_POOL_MAX_IDLE = int(os.getenv("EMAIL_POOL_MAX_IDLE", 60))
+
+# Рассылка об обновлении курса: окно (сек), за которое все правки курса
+# и его уроков сливаются в одну рассылку, размер пачки получателей
+# на одну подзадачу, число повторов пачки и пауза между ними (сек)
+COURSE_NOTIFY_DEBOUNCE = int(os.getenv("COURSE_NOTIFY_DEBOUNCE", 15 * 60))
+COURSE_NOTIFY_BATCH_SIZE = int(os.getenv("COURSE_NOTIFY_BATCH_SIZE", 500))
+COURSE_NOTIFY_MAX_RETRIES = int(os.getenv("COURSE_NOTIFY_MAX_RETRIES", 3))
+COURSE_NOTIFY_RETRY_DELAY = int(os.getenv("COURSE_NOTIFY_RETRY_DELAY", 60))
+
+# Активность пользователей (last_seen): не чаще раза в LAST_SEEN_INTERVAL сек
+# на пользователя пишется в кэш, задача flush_last_seen переносит ее в БД
+# по LAST_SEEN_FLUSH_BATCH записей за один bulk_update
+LAST_SEEN_INTERVAL = int(os.getenv("LAST_SEEN_INTERVAL", 15 * 60))
+LAST_SEEN_FLUSH_BATCH = int(os.getenv("LAST_SEEN_FLUSH_BATCH", 1000))
+
+# Блокировка неактивных пользователей: размер диапазона id на один UPDATE
+# и пауза между диапазонами (сек)
+BLOCK_INACTIVE_BATCH_SIZE = int(os.getenv("BLOCK_INACTIVE_BATCH_SIZE", 1000))
+BLOCK_INACTIVE_SLEEP = float(os.getenv("BLOCK_INACTIVE_SLEEP", 0.1))
+
+# Ежедневная сводка: сколько получателей обрабатывать за одну пачку
+DIGEST_BATCH_SIZE = int(os.getenv("DIGEST_BATCH_SIZE", 500))
+
+# Outbox рассылок: записей за одну выборку диспетчера, максимум выборок
+# за запуск, через сколько секунд взятая, но не отправленная запись
+# забирается повторно, и сколько дней хранить отправленные записи
+NOTIFICATION_OUTBOX_BATCH_SIZE = int(os.getenv("NOTIFICATION_OUTBOX_BATCH_SIZE", 500))
+NOTIFICATION_OUTBOX_MAX_BATCHES = int(os.getenv("NOTIFICATION_OUTBOX_MAX_BATCHES", 20))
+NOTIFICATION_OUTBOX_LEASE = int(os.getenv("NOTIFICATION_OUTBOX_LEASE", 10 * 60))
+NOTIFICATION_OUTBOX_RETENTION_DAYS = int(
+    os.getenv("NOTIFICATION_OUTBOX_RETENTION_DAYS", 7)
+)
+
+# Оплата: сессия Stripe создается задачей Celery, а запрос сразу отвечает 202
+# (для отдельного запроса - заголовок Prefer: respond-async). Повторы задачи,
+# пауза перед повтором (сек), максимальное ожидание ссылки в ?wait= (сек)
+PAYMENT_CHECKOUT_ASYNC = os.getenv("PAYMENT_CHECKOUT_ASYNC", "False") == "True"
+PAYMENT_CHECKOUT_MAX_RETRIES = int(os.getenv("PAYMENT_CHECKOUT_MAX_RETRIES", 3))
+PAYMENT_CHECKOUT_RETRY_DELAY = int(os.getenv("PAYMENT_CHECKOUT_RETRY_DELAY", 2))
+# Ожидание в ?wait= занимает воркер gunicorn: максимум - это секунды воркера
+# на каждый такой GET, поэтому он небольшой; дольше клиент опрашивает повторно
+PAYMENT_CHECKOUT_MAX_WAIT = float(os.getenv("PAYMENT_CHECKOUT_MAX_WAIT", 2))
+# Платеж, сессия оплаты которого не создана за это время (сек), помечается failed
+PAYMENT_CHECKOUT_TIMEOUT = int(os.getenv("PAYMENT_CHECKOUT_TIMEOUT", 10 * 60))
+
+# Статус оплаты приходит webhook'ом Stripe; неоплаченный статус старше
+# PAYMENT_STATUS_TTL (сек) перепроверяется запросом к Stripe
+PAYMENT_STATUS_TTL = int(os.getenv("PAYMENT_STATUS_TTL", 30))
+
+# Idempotency-Key для создания платежа: хранение ответа (сек), максимальное
+# время выполнения первого запроса (сек), ожидание его ответа повтором (сек).
+# Ожидание, как и ?wait=, занимает воркер, поэтому оно не длиннее
+# PAYMENT_CHECKOUT_MAX_WAIT; после него повтор получает 409 с Retry-After
+IDEMPOTENCY_TTL = int(os.getenv("IDEMPOTENCY_TTL", 60 * 60 * 24))
+IDEMPOTENCY_LOCK_TIMEOUT = int(os.getenv("IDEMPOTENCY_LOCK_TIMEOUT", 90))
+IDEMPOTENCY_WAIT = float(os.getenv("IDEMPOTENCY_WAIT", 2))
+
+# Сверка статусов платежей со Stripe: сессий на страницу Session.list,
+# страниц за запуск, запросов к Stripe в секунду, глубина сверки (дней)
+PAYMENT_RECONCILE_PAGE_SIZE = int(os.getenv("PAYMENT_RECONCILE_PAGE_SIZE", 100))
+PAYMENT_RECONCILE_MAX_PAGES = int(os.getenv("PAYMENT_RECONCILE_MAX_PAGES", 50))
+PAYMENT_RECONCILE_RATE = float(os.getenv("PAYMENT_RECONCILE_RATE", 5))
+PAYMENT_RECONCILE_DAYS = int(os.getenv("PAYMENT_RECONCILE_DAYS", 3))
 
 STATIC_URL = "static/"
 
@@ -127,9 +211,31 @@ SWAGGER_SETTINGS = {
     "USE_SESSION_AUTH": False,  # Важно, чтобы не мешала сессионная аутентификация
 }
 
+# Кэш: Redis, если он настроен, иначе локальная память процесса
+if REDIS_HOST:
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.redis.RedisCache",
+            "LOCATION": f"redis://{REDIS_HOST}:{REDIS_PORT}/2",
+        }
+    }
+else:
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        }
+    }
+
+# Stateless JWT: на чтение пользователь собирается из claims токена без запроса к БД
+JWT_STATELESS_AUTH = os.getenv("JWT_STATELESS_AUTH", "False") == "True"
+
 REST_FRAMEWORK = {
     "DEFAULT_AUTHENTICATION_CLASSES": (
-        "rest_framework_simplejwt.authentication.JWTAuthentication",
+        (
+            "users.authentication.StatelessJWTAuthentication"
+            if JWT_STATELESS_AUTH
+            else "rest_framework_simplejwt.authentication.JWTAuthentication"
+        ),
     ),
     "DEFAULT_PERMISSION_CLASSES": ("rest_framework.permissions.IsAuthenticated",),
 }
@@ -137,6 +243,10 @@ REST_FRAMEWORK = {
 SIMPLE_JWT = {
     "ACCESS_TOKEN_LIFETIME": timedelta(minutes=15),
     "REFRESH_TOKEN_LIFETIME": timedelta(days=1),
+    # Роль модератора кладется в access-токен (claim is_moderator)
+    # и пересчитывается по БД при каждом обновлении токена
+    "TOKEN_OBTAIN_SERIALIZER": "users.serializers.UserTokenObtainPairSerializer",
+    "TOKEN_REFRESH_SERIALIZER": "users.serializers.UserTokenRefreshSerializer",
 }
 
 
@@ -155,3 +265,22 @@ CELERY_TASK_TRACK_STARTED = True
 
 # Максимальное время на выполнение задачи
 CELERY_TASK_TIME_LIMIT = 30 * 60
+
+# Логирование: метрики приложения (config/metrics.py) пишутся в консоль
+LOGGING = {
+    "version": 1,
+    "disable_existing_loggers": False,
+    "formatters": {
+        "metrics": {"format": "%(asctime)s %(name)s %(message)s"},
+    },
+    "handlers": {
+        "metrics": {"class": "logging.StreamHandler", "formatter": "metrics"},
+    },
+    "loggers": {
+        "lms.metrics": {
+            "handlers": ["metrics"],
+            "level": os.getenv("METRICS_LOG_LEVEL", "INFO"),
+            "propagate": False,
+        },
+    },
+}
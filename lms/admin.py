@@ -1,5 +1,5 @@
 from django.contrib import admin
-from .models import Course, Lesson
+from .models import Course, Lesson, NotificationOutbox
 
 
 @admin.register(Course)
@@ -11,3 +11,9 @@ class CourseAdmin(admin.ModelAdmin):
 class LessonAdmin(admin.ModelAdmin):
     list_display = ("title", "course", "video_url")
     list_filter = ("course",)
+
+
+@admin.register(NotificationOutbox)
+class NotificationOutboxAdmin(admin.ModelAdmin):
+    list_display = ("course", "available_at", "claimed_at", "sent_at")
+    list_filter = ("sent_at",)
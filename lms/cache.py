@@ -0,0 +1,126 @@
+"""Версионированный кэш сериализованных представлений (фрагментов) объектов.
+
+У каждого объекта есть номер версии в кэше. Фрагмент хранится под ключом,
+включающим версию, поэтому при изменении объекта достаточно увеличить
+версию (bump_version) - старые фрагменты перестают читаться и вытесняются
+по таймауту.
+"""
+
+import time
+
+from django.core.cache import cache
+
+FRAGMENT_CACHE_TIMEOUT = 60 * 60 * 24
+
+
+def _version_key(name, pk):
+    return f"lms:{name}:{pk}:version"
+
+
+def _fragment_key(name, pk, version, signature):
+    return f"lms:{name}:{pk}:v{version}:{signature}"
+
+
+def get_versions(name, pks):
+    """Возвращает словарь {pk: версия}. Отсутствующие версии инициализируются
+    текущим временем, чтобы после вытеснения ключа версия не повторилась"""
+    keys = {_version_key(name, pk): pk for pk in pks}
+    found = cache.get_many(keys)
+
+    versions = {keys[key]: version for key, version in found.items()}
+    for key, pk in keys.items():
+        if pk not in versions:
+            version = time.time_ns()
+            if not cache.add(key, version, timeout=None):
+                version = cache.get(key, version)
+            versions[pk] = version
+    return versions
+
+
+def bump_version(name, pk):
+    """Инвалидирует все закэшированные фрагменты объекта"""
+    key = _version_key(name, pk)
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.set(key, time.time_ns(), timeout=None)
+
+
+def bump_versions(name, pks):
+    for pk in set(pks):
+        bump_version(name, pk)
+
+
+def get_fragments(name, pks, signature):
+    """Возвращает пару ({pk: фрагмент} для найденных, {pk: ключ} для всех)"""
+    versions = get_versions(name, pks)
+    keys = {pk: _fragment_key(name, pk, versions[pk], signature) for pk in pks}
+    found = cache.get_many(keys.values())
+    fragments = {pk: found[key] for pk, key in keys.items() if key in found}
+    return fragments, keys
+
+
+def set_fragments(keys, fragments):
+    """Сохраняет фрагменты {pk: данные} под ключами, полученными из get_fragments"""
+    cache.set_many(
+        {keys[pk]: data for pk, data in fragments.items()},
+        timeout=FRAGMENT_CACHE_TIMEOUT,
+    )
+
+
+def _subscriptions_changed_key(user_id):
+    return f"lms:user:{user_id}:subscriptions_changed"
+
+
+def touch_subscriptions(user_id):
+    """Запоминает время последнего изменения подписок пользователя"""
+    cache.set(_subscriptions_changed_key(user_id), time.time(), timeout=None)
+
+
+def get_subscriptions_changed_at(user_id):
+    """Время последнего изменения подписок пользователя (timestamp).
+    Если значение вытеснено из кэша, считаем, что подписки изменились сейчас"""
+    key = _subscriptions_changed_key(user_id)
+    changed_at = time.time()
+    if not cache.add(key, changed_at, timeout=None):
+        changed_at = cache.get(key, changed_at)
+    return changed_at
+
+
+NOTIFICATION_PROGRESS_TIMEOUT = 60 * 60 * 24
+NOTIFICATION_COUNTERS = ("recipients", "batches", "sent", "failed")
+
+
+def _notification_key(run_id, counter):
+    return f"lms:notify:{run_id}:{counter}"
+
+
+def start_notification_progress(run_id):
+    """Обнуляет счетчики прогресса рассылки"""
+    cache.set_many(
+        {_notification_key(run_id, counter): 0 for counter in NOTIFICATION_COUNTERS},
+        timeout=NOTIFICATION_PROGRESS_TIMEOUT,
+    )
+
+
+def add_notification_progress(run_id, **counters):
+    """Атомарно увеличивает счетчики прогресса: sent=10, failed=1 и т.д."""
+    for counter, delta in counters.items():
+        if not delta:
+            continue
+        key = _notification_key(run_id, counter)
+        try:
+            cache.incr(key, delta)
+        except ValueError:
+            # Счетчик вытеснен: начинаем заново, чтобы не терять прогресс
+            if not cache.add(key, delta, timeout=NOTIFICATION_PROGRESS_TIMEOUT):
+                cache.incr(key, delta)
+
+
+def get_notification_progress(run_id):
+    """Прогресс рассылки: {"recipients", "batches", "sent", "failed"}"""
+    keys = {
+        _notification_key(run_id, counter): counter for counter in NOTIFICATION_COUNTERS
+    }
+    found = cache.get_many(keys)
+    return {counter: found.get(key, 0) for key, counter in keys.items()}
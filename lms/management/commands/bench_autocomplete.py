@@ -0,0 +1,86 @@
+import random
+import statistics
+import string
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.test.utils import override_settings
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+from lms.models import Course
+from lms.views import CourseViewSet
+from users.models import User
+
+
+class Command(BaseCommand):
+    help = (
+        "Замеряет задержку автодополнения названий курсов на синтетическом "
+        "каталоге. Каталог создается в транзакции и по умолчанию откатывается"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--courses", type=int, default=100_000)
+        parser.add_argument("--queries", type=int, default=1000)
+        parser.add_argument(
+            "--keep", action="store_true", help="Не удалять созданные курсы"
+        )
+
+    def handle(self, *args, **options):
+        user = User.objects.first()
+        if not user:
+            raise CommandError("Сначала создайте хотя бы одного пользователя!")
+
+        with transaction.atomic():
+            self.fill_catalog(options["courses"])
+            with override_settings(
+                ALLOWED_HOSTS=[*settings.ALLOWED_HOSTS, "testserver"]
+            ):
+                self.run_queries(user, options["queries"])
+            if not options["keep"]:
+                transaction.set_rollback(True)
+
+    def fill_catalog(self, total):
+        words = [
+            "".join(random.choices(string.ascii_lowercase, k=random.randint(3, 10)))
+            for _ in range(5000)
+        ]
+        started = time.perf_counter()
+        Course.objects.bulk_create(
+            (
+                Course(title=" ".join(random.choices(words, k=random.randint(1, 4))))
+                for _ in range(total)
+            ),
+            batch_size=5000,
+        )
+        with connection.cursor() as cursor:
+            cursor.execute(f"ANALYZE {Course._meta.db_table}")
+        self.stdout.write(
+            f"Создано {total} курсов за {time.perf_counter() - started:.1f} c"
+        )
+
+    def run_queries(self, user, total):
+        factory = APIRequestFactory()
+        view = CourseViewSet.as_view({"get": "autocomplete"})
+
+        timings = []
+        for _ in range(total):
+            prefix = "".join(
+                random.choices(string.ascii_lowercase, k=random.randint(1, 4))
+            )
+            request = factory.get("/lms/courses/autocomplete/", {"q": prefix})
+            force_authenticate(request, user=user)
+
+            started = time.perf_counter()
+            view(request).render()
+            timings.append((time.perf_counter() - started) * 1000)
+
+        timings.sort()
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"{total} запросов: p50 {statistics.median(timings):.2f} мс, "
+                f"p95 {timings[int(len(timings) * 0.95) - 1]:.2f} мс, "
+                f"max {timings[-1]:.2f} мс"
+            )
+        )
@@ -0,0 +1,73 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import CaptureQueriesContext, override_settings
+from rest_framework.test import APIRequestFactory
+from rest_framework_simplejwt.authentication import JWTAuthentication
+
+from lms.views import CourseViewSet
+from users.authentication import StatelessJWTAuthentication
+from users.models import User
+from users.serializers import UserTokenObtainPairSerializer
+
+
+class Command(BaseCommand):
+    help = (
+        "Сравнивает запросы/сек для /lms/courses/ с обычной JWT-аутентификацией "
+        "и stateless-режимом (пользователь из claims токена)"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--requests", type=int, default=500)
+        parser.add_argument(
+            "--email", help="Пользователь, от имени которого идут запросы"
+        )
+
+    def handle(self, *args, **options):
+        users = User.objects.all()
+        if options["email"]:
+            users = users.filter(email=options["email"])
+        user = users.first()
+        if not user:
+            raise CommandError("Сначала создайте хотя бы одного пользователя!")
+
+        token = UserTokenObtainPairSerializer.get_token(user).access_token
+        factory = APIRequestFactory()
+        view = CourseViewSet.as_view({"get": "list"})
+
+        modes = (
+            ("JWTAuthentication", JWTAuthentication),
+            ("StatelessJWTAuthentication", StatelessJWTAuthentication),
+        )
+        original = CourseViewSet.authentication_classes
+        try:
+            with override_settings(
+                ALLOWED_HOSTS=[*settings.ALLOWED_HOSTS, "testserver"]
+            ):
+                for name, auth_class in modes:
+                    CourseViewSet.authentication_classes = [auth_class]
+                    self.run_mode(name, view, factory, token, options["requests"])
+        finally:
+            CourseViewSet.authentication_classes = original
+
+    def run_mode(self, name, view, factory, token, total):
+        def make_request():
+            return factory.get("/lms/courses/", HTTP_AUTHORIZATION=f"Bearer {token}")
+
+        view(make_request())  # Прогрев кэша представлений
+
+        with CaptureQueriesContext(connection) as queries:
+            started = time.perf_counter()
+            for _ in range(total):
+                response = view(make_request())
+                response.render()
+            elapsed = time.perf_counter() - started
+
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"{name}: {total / elapsed:.0f} запросов/сек, "
+                f"{len(queries) / total:.1f} SQL-запросов на запрос"
+            )
+        )
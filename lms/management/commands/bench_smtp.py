@@ -0,0 +1,87 @@
+import asyncio
+import socket
+import time
+
+from django.core.mail import EmailMessage
+from django.core.mail.backends.smtp import EmailBackend
+from django.core.management.base import BaseCommand, CommandError
+
+from config.mail import PooledSMTPEmailBackend
+
+
+class SinkHandler:
+    """Принимает письма и имитирует задержку установки соединения на EHLO"""
+
+    def __init__(self, handshake_delay):
+        self.handshake_delay = handshake_delay
+        self.peers = set()
+
+    async def handle_EHLO(self, server, session, envelope, hostname, responses):
+        await asyncio.sleep(self.handshake_delay)
+        session.host_name = hostname
+        return responses
+
+    async def handle_DATA(self, server, session, envelope):
+        self.peers.add(session.peer)
+        return "250 OK"
+
+
+class Command(BaseCommand):
+    help = (
+        "Сравнивает пропускную способность стандартного SMTP-бэкенда и "
+        "PooledSMTPEmailBackend. Каждое письмо отправляется через новый "
+        "экземпляр бэкенда, как из отдельной задачи Celery"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--messages", type=int, default=300)
+        parser.add_argument(
+            "--handshake-ms",
+            type=float,
+            default=50,
+            help="Имитация TCP/TLS/AUTH при открытии соединения (мс)",
+        )
+
+    def handle(self, *args, **options):
+        try:
+            from aiosmtpd.controller import Controller
+        except ImportError:
+            raise CommandError("Установите dev-зависимости: aiosmtpd")
+
+        with socket.socket() as sock:
+            sock.bind(("127.0.0.1", 0))
+            port = sock.getsockname()[1]
+
+        for name, backend_class in (
+            ("smtp", EmailBackend),
+            ("pooled", PooledSMTPEmailBackend),
+        ):
+            handler = SinkHandler(options["handshake_ms"] / 1000)
+            server = Controller(handler, hostname="127.0.0.1", port=port)
+            server.start()
+            try:
+                elapsed = self.send(backend_class, port, options["messages"])
+            finally:
+                server.stop()
+
+            self.stdout.write(
+                f"{name:>6}: {options['messages'] / elapsed:.0f} писем/с, "
+                f"соединений: {len(handler.peers)}"
+            )
+
+    def send(self, backend_class, port, total):
+        started = time.perf_counter()
+        for i in range(total):
+            backend = backend_class(host="127.0.0.1", port=port, use_tls=False)
+            backend.send_messages(
+                [
+                    EmailMessage(
+                        "Обновление курса", "Тело", "noreply@lms.com", [f"s{i}@lms.com"]
+                    )
+                ]
+            )
+        elapsed = time.perf_counter() - started
+
+        if backend_class is PooledSMTPEmailBackend:
+            backend.pool.clear()
+        return elapsed
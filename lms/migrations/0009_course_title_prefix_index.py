@@ -0,0 +1,27 @@
+# Generated by Django 5.2.9 on 2026-10-18 19:16
+
+import django.db.models.functions.comparison
+import django.db.models.functions.text
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("lms", "0008_search_vector"),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="course",
+            index=models.Index(
+                django.db.models.functions.comparison.Collate(
+                    django.db.models.functions.text.Lower("title"), "C"
+                ),
+                models.F("id"),
+                name="lms_course_title_prefix",
+            ),
+        ),
+    ]
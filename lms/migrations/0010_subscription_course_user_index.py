@@ -0,0 +1,37 @@
+# Generated by Django 5.2.9 on 2026-10-18 19:19
+
+import django.db.models.deletion
+from django.conf import settings
+from django.contrib.postgres.operations import AddIndexConcurrently
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    # Индексы строятся без блокировки записи в таблицы,
+    # старые индексы внешних ключей удаляются после этого
+    atomic = False
+
+    dependencies = [
+        ("lms", "0009_course_title_prefix_index"),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        AddIndexConcurrently(
+            model_name="subscription",
+            index=models.Index(
+                fields=["course", "user"], name="lms_subscription_course_user"
+            ),
+        ),
+        migrations.AlterField(
+            model_name="subscription",
+            name="course",
+            field=models.ForeignKey(
+                db_index=False,
+                on_delete=django.db.models.deletion.CASCADE,
+                related_name="subscribers",
+                to="lms.course",
+                verbose_name="Курс",
+            ),
+        ),
+    ]
@@ -0,0 +1,209 @@
+import hashlib
+
+from django.http import Http404
+from django.utils.cache import get_conditional_response, patch_vary_headers
+from django.utils.http import http_date, quote_etag
+from rest_framework.exceptions import ValidationError
+from rest_framework.generics import get_object_or_404
+from rest_framework.permissions import SAFE_METHODS
+from rest_framework.response import Response
+
+from .cache import get_fragments, set_fragments
+
+
+class SparseFieldsetMixin:
+    """Выборочный вывод полей для ViewSet:
+    ?fields=id,title - только перечисленные поля,
+    ?expand=lessons - добавить вложенные поля к выбранному набору.
+    Для list без ?fields= отдается краткое представление summary_fields"""
+
+    summary_fields = None  # Поля списка по умолчанию (None - все поля)
+
+    @staticmethod
+    def _parse_fields_param(value):
+        return [name.strip() for name in value.split(",") if name.strip()]
+
+    def get_available_fields(self):
+        return tuple(self.get_serializer_class()().fields)
+
+    def get_requested_fields(self):
+        """Кортеж полей, которые нужно вывести, или None, если нужны все поля.
+        Изменяющие запросы всегда получают полное представление"""
+        if hasattr(self, "_requested_fields"):
+            return self._requested_fields
+
+        requested = None
+        if self.request is not None and self.request.method in SAFE_METHODS:
+            available = self.get_available_fields()
+            fields_param = self.request.query_params.get("fields")
+            expand = self._parse_fields_param(
+                self.request.query_params.get("expand", "")
+            )
+
+            if fields_param:
+                requested = self._parse_fields_param(fields_param)
+            elif self.action == "list" and self.summary_fields is not None:
+                requested = list(self.summary_fields)
+
+            if requested is not None:
+                requested += [name for name in expand if name not in requested]
+                unknown = [name for name in requested if name not in available]
+                if unknown:
+                    raise ValidationError(
+                        {"fields": f"Неизвестные поля: {', '.join(unknown)}"}
+                    )
+                requested = tuple(requested)
+
+        self._requested_fields = requested
+        return requested
+
+    def is_field_requested(self, name):
+        fields = self.get_requested_fields()
+        return fields is None or name in fields
+
+    def get_only_fields(self):
+        """Колонки модели для queryset.only() или None, если нужны все"""
+        fields = self.get_requested_fields()
+        if fields is None:
+            return None
+
+        model = self.queryset.model
+        concrete = {field.name for field in model._meta.concrete_fields}
+        return ["id"] + [name for name in fields if name in concrete and name != "id"]
+
+    def get_serializer(self, *args, **kwargs):
+        fields = self.get_requested_fields()
+        if fields is not None:
+            kwargs.setdefault("fields", fields)
+        return super().get_serializer(*args, **kwargs)
+
+
+class CachedRepresentationMixin:
+    """Отдает list/retrieve из версионированного кэша фрагментов (lms.cache).
+    Из БД читаются только id страницы и объекты, которых нет в кэше.
+    Поля из per_user_fields зависят от пользователя: они не попадают
+    в общий фрагмент и накладываются после чтения из кэша.
+    Используется вместе с SparseFieldsetMixin"""
+
+    fragment_cache_name = None
+    per_user_fields = ()
+
+    def get_id_queryset(self):
+        """Легкий queryset для пагинации и поиска объекта - только первичный ключ"""
+        return self.queryset.model.objects.only("id").order_by("id")
+
+    def get_per_user_values(self, pks):
+        """Возвращает {pk: {поле: значение}} для полей из per_user_fields"""
+        return {}
+
+    def get_fragment_signature(self):
+        requested = self.get_requested_fields()
+        fields = ",".join(requested) if requested is not None else "__all__"
+        # Ссылки на файлы строятся с учетом хоста запроса
+        return f"{self.request.get_host()}:{fields}"
+
+    def get_cached_representations(self, pks):
+        fragments, keys = get_fragments(
+            self.fragment_cache_name, pks, self.get_fragment_signature()
+        )
+        per_user_fields = [
+            name for name in self.per_user_fields if self.is_field_requested(name)
+        ]
+
+        per_user = {}
+        hit_pks = [pk for pk in pks if pk in fragments]
+        if hit_pks and per_user_fields:
+            per_user = self.get_per_user_values(hit_pks)
+
+        miss_pks = [pk for pk in pks if pk not in fragments]
+        if miss_pks:
+            missing = list(self.get_queryset().filter(pk__in=miss_pks))
+            fresh = {}
+            for obj, item in zip(missing, self.get_serializer(missing, many=True).data):
+                per_user[obj.pk] = {name: item.pop(name) for name in per_user_fields}
+                fresh[obj.pk] = item
+            set_fragments(keys, fresh)
+            fragments.update(fresh)
+
+        data = []
+        for pk in pks:
+            if pk not in fragments:  # Объект удален между запросами
+                continue
+            item = dict(fragments[pk])
+            item.update(per_user.get(pk, {}))
+            data.append(item)
+        return data
+
+    def list(self, request, *args, **kwargs):
+        queryset = self.filter_queryset(self.get_id_queryset())
+
+        page = self.paginate_queryset(queryset)
+        objects = page if page is not None else queryset
+        data = self.get_cached_representations([obj.pk for obj in objects])
+
+        if page is not None:
+            return self.get_paginated_response(data)
+        return Response(data)
+
+    def retrieve(self, request, *args, **kwargs):
+        lookup_url_kwarg = self.lookup_url_kwarg or self.lookup_field
+        instance = get_object_or_404(
+            self.get_id_queryset(),
+            **{self.lookup_field: self.kwargs[lookup_url_kwarg]},
+        )
+        self.check_object_permissions(request, instance)
+
+        data = self.get_cached_representations([instance.pk])
+        if not data:  # Объект удален между запросами
+            raise Http404
+        return Response(data[0])
+
+
+class ConditionalGetMixin:
+    """ETag и Last-Modified для list/retrieve. Условный запрос
+    (If-None-Match / If-Modified-Since) получает 304 до выборки
+    и сериализации объектов: валидаторы строятся по get_freshness()"""
+
+    def get_freshness(self):
+        """Возвращает (last_modified: datetime | None, token: str) - дешево
+        вычисляемое состояние данных ответа - или None, если его нет"""
+        return None
+
+    def get_conditional_validators(self):
+        freshness = self.get_freshness()
+        if freshness is None:
+            return None
+
+        last_modified, token = freshness
+        # Представление зависит от параметров запроса (страница, поля) и хоста
+        source = f"{self.request.get_host()}{self.request.get_full_path()}:{token}"
+        etag = quote_etag(hashlib.sha1(source.encode()).hexdigest())
+        return etag, last_modified
+
+    def conditional_response(self, handler, request, *args, **kwargs):
+        validators = self.get_conditional_validators()
+        if validators is None:
+            return handler(request, *args, **kwargs)
+
+        etag, last_modified = validators
+        timestamp = int(last_modified.timestamp()) if last_modified else None
+
+        response = get_conditional_response(
+            request._request, etag=etag, last_modified=timestamp
+        )
+        if response is None:
+            response = handler(request, *args, **kwargs)
+            if response.status_code != 200:
+                return response
+
+        response["ETag"] = etag
+        if timestamp is not None:
+            response["Last-Modified"] = http_date(timestamp)
+        patch_vary_headers(response, ("Authorization",))
+        return response
+
+    def list(self, request, *args, **kwargs):
+        return self.conditional_response(super().list, request, *args, **kwargs)
+
+    def retrieve(self, request, *args, **kwargs):
+        return self.conditional_response(super().retrieve, request, *args, **kwargs)
@@ -1,5 +1,29 @@
 from django.conf import settings
-from django.db import models
+from django.contrib.postgres.indexes import GinIndex
+from django.contrib.postgres.search import SearchVector, SearchVectorField
+from django.db import connections, models, transaction
+from django.db.models.functions import Collate, Lower
+from django.utils import timezone
+
+from .cache import bump_versions, touch_subscriptions
+
+# Конфигурация полнотекстового поиска PostgreSQL
+SEARCH_CONFIG = "russian"
+
+
+def search_vector_expression():
+    """Название важнее описания: вес A для title, B для description"""
+    return SearchVector("title", weight="A", config=SEARCH_CONFIG) + SearchVector(
+        "description", weight="B", config=SEARCH_CONFIG
+    )
+
+
+class SearchableManager(models.Manager):
+    """Поисковый вектор нужен только в запросах поиска,
+    поэтому по умолчанию он не выбирается"""
+
+    def get_queryset(self):
+        return super().get_queryset().defer("search_vector")
 
 
 class Course(models.Model):
@@ -12,6 +36,13 @@ class Course(models.Model):
 
     updated_at = models.DateTimeField(auto_now=True, verbose_name='Дата обновления', null=True, blank=True)
 
+    # Хранимый поисковый вектор, пересчитывается самой БД при изменении строки
+    search_vector = models.GeneratedField(
+        expression=search_vector_expression(),
+        output_field=SearchVectorField(),
+        db_persist=True,
+    )
+
     owner = models.ForeignKey(
         settings.AUTH_USER_MODEL,
         on_delete=models.SET_NULL,
@@ -20,12 +51,85 @@ class Course(models.Model):
         verbose_name="Владелец",
     )
 
+    objects = SearchableManager()
+
     def __str__(self):
         return self.title
 
     class Meta:
         verbose_name = "Курс"
         verbose_name_plural = "Курсы"
+        indexes = [
+            GinIndex(fields=["search_vector"], name="lms_course_search_gin"),
+            # Префиксный поиск по названию (автодополнение): LIKE 'abc%'
+            # по LOWER(title) в побайтовом порядке "C" использует B-tree
+            # и сразу отдает строки в нужной сортировке
+            models.Index(
+                Collate(Lower("title"), "C"), "id", name="lms_course_title_prefix"
+            ),
+        ]
+
+
+class SubscriptionManager(models.Manager):
+    """Подписка и отписка одним SQL-запросом без предварительных SELECT.
+    Сигналы моделей при этом не отправляются, поэтому кэш представлений
+    инвалидируется здесь же"""
+
+    def _execute(self, sql, params):
+        connection = connections[self.db]
+        with connection.cursor() as cursor:
+            cursor.execute(
+                sql.format(
+                    table=connection.ops.quote_name(self.model._meta.db_table),
+                    course_table=connection.ops.quote_name(Course._meta.db_table),
+                ),
+                params,
+            )
+            return [row[0] for row in cursor.fetchall()]
+
+    def _changed(self, user_id, course_ids):
+        if course_ids:
+            bump_versions("course", course_ids)
+            touch_subscriptions(user_id)
+
+    def subscribe(self, user_id, course_ids):
+        """Подписывает на существующие курсы из course_ids:
+        INSERT ... SELECT ... ON CONFLICT DO NOTHING.
+        Возвращает id курсов, подписка на которые создана"""
+        created = self._execute(
+            "INSERT INTO {table} (user_id, course_id) "
+            "SELECT %s, id FROM {course_table} WHERE id = ANY(%s) "
+            "ON CONFLICT (user_id, course_id) DO NOTHING RETURNING course_id",
+            [user_id, list(course_ids)],
+        )
+        self._changed(user_id, created)
+        return created
+
+    def unsubscribe(self, user_id, course_ids):
+        """Удаляет подписки одним DELETE ... RETURNING.
+        Возвращает id курсов, подписка на которые удалена"""
+        deleted = self._execute(
+            "DELETE FROM {table} WHERE user_id = %s AND course_id = ANY(%s) "
+            "RETURNING course_id",
+            [user_id, list(course_ids)],
+        )
+        self._changed(user_id, deleted)
+        return deleted
+
+    def toggle(self, user_id, course_id):
+        """Переключает подписку: True - подписка создана, False - удалена.
+        Двойной запрос не приводит к ошибке уникальности.
+        Если курса нет, выбрасывает Course.DoesNotExist"""
+        if self.unsubscribe(user_id, [course_id]):
+            return False
+        if self.subscribe(user_id, [course_id]):
+            return True
+
+        # Ничего не вставлено: либо курса нет, либо параллельный запрос
+        # уже создал подписку
+        if not Course.objects.filter(pk=course_id).exists():
+            raise Course.DoesNotExist
+        return True
 
 
 class Subscription(models.Model):
@@ -40,8 +144,11 @@ class Subscription(models.Model):
         on_delete=models.CASCADE,
         verbose_name="Курс",
         related_name="subscribers",
+        db_index=False,
     )
 
+    objects = SubscriptionManager()
+
     def __str__(self):
         return f"{self.user} - {self.course}"
 
@@ -49,6 +156,13 @@ class Subscription(models.Model):
         verbose_name = "Подписка"
         verbose_name_plural = "Подписки"
         unique_together = ("user", "course")
+        indexes = [
+            # Рассылка по подписчикам курса читает user_id прямо из индекса,
+            # отдельный индекс по course_id стал лишним
+            models.Index(
+                fields=["course", "user"], name="lms_subscription_course_user"
+            ),
+        ]
 
 
 class Lesson(models.Model):
@@ -63,6 +177,12 @@ class Lesson(models.Model):
     description = models.TextField(blank=True, null=True, verbose_name="Описание")
     video_url = models.URLField(max_length=200, verbose_name="Ссылка на видео")
 
+    search_vector = models.GeneratedField(
+        expression=search_vector_expression(),
+        output_field=SearchVectorField(),
+        db_persist=True,
+    )
+
     owner = models.ForeignKey(
         settings.AUTH_USER_MODEL,
         on_delete=models.SET_NULL,
@@ -71,9 +191,106 @@ class Lesson(models.Model):
         verbose_name="Владелец",
     )
 
+    objects = SearchableManager()
+
     def __str__(self):
         return f"{self.title} ({self.course})"
 
     class Meta:
         verbose_name = "Урок"
         verbose_name_plural = "Уроки"
+        indexes = [GinIndex(fields=["search_vector"], name="lms_lesson_search_gin")]
+
+
+class NotificationOutboxManager(models.Manager):
+    """Outbox рассылок об обновлении курсов"""
+
+    def enqueue(self, course_ids, delay):
+        """Ставит рассылку по курсам через delay. Вызывается в транзакции
+        изменения курса, поэтому при откате запись не появится. Если для
+        курса уже есть ожидающая запись, новая не создается - все изменения
+        до отправки объединяются в одно письмо"""
+        available_at = timezone.now() + delay
+        self.bulk_create(
+            [self.model(course_id=pk, available_at=available_at) for pk in course_ids],
+            ignore_conflicts=True,
+        )
+
+    def claim(self, limit, lease):
+        """Забирает до limit созревших записей: SELECT ... FOR UPDATE SKIP LOCKED
+        и отметка claimed_at в короткой транзакции. Параллельные диспетчеры
+        получают разные записи. Записи, взятые больше lease назад и так
+        и не отправленные (воркер упал), забираются повторно.
+        Возвращает список пар (id, course_id)"""
+        now = timezone.now()
+        with transaction.atomic(using=self.db):
+            rows = list(
+                self.select_for_update(skip_locked=True)
+                .filter(
+                    models.Q(claimed_at__isnull=True)
+                    | models.Q(claimed_at__lt=now - lease),
+                    sent_at__isnull=True,
+                    available_at__lte=now,
+                )
+                .order_by("available_at")
+                .values_list("id", "course_id")[:limit]
+            )
+            if rows:
+                self.filter(pk__in=[pk for pk, _ in rows]).update(claimed_at=now)
+        return rows
+
+    def mark_sent(self, ids):
+        self.filter(pk__in=ids).update(sent_at=timezone.now())
+
+    def purge(self, older_than):
+        """Удаляет отправленные записи старше older_than"""
+        return self.filter(sent_at__lt=timezone.now() - older_than).delete()[0]
+
+    def stats(self):
+        """Глубина очереди (все неотправленные записи) и возраст (сек) самой
+        старой созревшей записи - насколько диспетчер отстает"""
+        now = timezone.now()
+        result = self.filter(sent_at__isnull=True).aggregate(
+            depth=models.Count("id"),
+            oldest=models.Min("available_at", filter=models.Q(available_at__lte=now)),
+        )
+        age = (now - result["oldest"]).total_seconds() if result["oldest"] else 0
+        return {"depth": result["depth"], "age": age}
+
+
+class NotificationOutbox(models.Model):
+    """Запись outbox: рассылка об обновлении курса, которую нужно отправить
+    не раньше available_at. Пишется в одной транзакции с изменением курса"""
+
+    course = models.ForeignKey(
+        Course, on_delete=models.CASCADE, db_index=False, verbose_name="Курс"
+    )
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name="Создана")
+    available_at = models.DateTimeField(verbose_name="Отправить после")
+    claimed_at = models.DateTimeField(null=True, blank=True, verbose_name="Взята")
+    sent_at = models.DateTimeField(null=True, blank=True, verbose_name="Отправлена")
+
+    objects = NotificationOutboxManager()
+
+    def __str__(self):
+        return f"{self.course_id} - {self.available_at}"
+
+    class Meta:
+        verbose_name = "Рассылка в очереди"
+        verbose_name_plural = "Очередь рассылок"
+        constraints = [
+            # Не больше одной ожидающей (еще не взятой) записи на курс
+            models.UniqueConstraint(
+                fields=["course"],
+                condition=models.Q(claimed_at__isnull=True),
+                name="lms_outbox_one_pending_per_course",
+            ),
+        ]
+        indexes = [
+            # Выборка диспетчера: только неотправленные записи
+            models.Index(
+                fields=["available_at"],
+                condition=models.Q(sent_at__isnull=True),
+                name="lms_outbox_pending",
+            ),
+        ]
@@ -1,7 +1,62 @@
-from rest_framework.pagination import PageNumberPagination
+from rest_framework.pagination import CursorPagination, PageNumberPagination
 
 
 class CustomPagination(PageNumberPagination):
     page_size = 5
     page_size_query_param = "page_size"  # Параметр запроса для выбора кол-ва элементов
     max_page_size = 100
+
+
+class CustomCursorPagination(CursorPagination):
+    """Курсорная (keyset) пагинация: без COUNT(*) и OFFSET, страница
+    выбирается по индексу первичного ключа. id уникален и растет монотонно,
+    поэтому новые записи не сдвигают уже выданные страницы"""
+
+    page_size = 5
+    page_size_query_param = "page_size"
+    max_page_size = 100
+    ordering = "id"
+
+    def get_ordering(self, request, queryset, view):
+        # ?ordering= (OrderingFilter) не меняет ключ курсора: по неуникальному
+        # полю (например, дате) страницы пропускали бы и повторяли записи
+        return (self.ordering,)
+
+
+class SearchCursorPagination(CursorPagination):
+    """Курсорная пагинация результатов поиска по убыванию релевантности"""
+
+    page_size = 10
+    page_size_query_param = "page_size"
+    max_page_size = 50
+    ordering = ("-rank", "id")
+
+
+class SelectablePaginationMixin:
+    """Выбор пагинации для view: ?pagination=cursor (или наличие ?cursor=)
+    включает курсорную пагинацию, ?pagination=page - постраничную.
+    Режим по умолчанию задается атрибутом pagination_mode"""
+
+    cursor_pagination_class = CustomCursorPagination
+    pagination_mode = "page"
+    pagination_query_param = "pagination"
+
+    def get_pagination_mode(self):
+        params = self.request.query_params if self.request is not None else {}
+        mode = params.get(self.pagination_query_param)
+        if mode in ("page", "cursor"):
+            return mode
+        if self.cursor_pagination_class.cursor_query_param in params:
+            return "cursor"
+        return self.pagination_mode
+
+    @property
+    def paginator(self):
+        if not hasattr(self, "_paginator"):
+            if self.get_pagination_mode() == "cursor":
+                self._paginator = self.cursor_pagination_class()
+            elif self.pagination_class is None:
+                self._paginator = None
+            else:
+                self._paginator = self.pagination_class()
+        return self._paginator
@@ -1,17 +1,42 @@
+from django.utils.html import escape
 from rest_framework import serializers
 from rest_framework.fields import SerializerMethodField
 from .validators import YouTubeValidator
 from .models import Course, Lesson, Subscription
 
 
-class LessonSerializer(serializers.ModelSerializer):
+class SparseFieldsSerializerMixin:
+    """Позволяет ограничить набор полей сериализатора: fields=("id", "title")"""
+
+    def __init__(self, *args, **kwargs):
+        fields = kwargs.pop("fields", None)
+        super().__init__(*args, **kwargs)
+
+        if fields is not None:
+            for name in set(self.fields) - set(fields):
+                self.fields.pop(name)
+
+
+class LessonSerializer(SparseFieldsSerializerMixin, serializers.ModelSerializer):
     class Meta:
         model = Lesson
-        fields = "__all__"
+        exclude = ("search_vector",)
         validators = [YouTubeValidator(field="video_url")]
 
 
-class CourseSerializer(serializers.ModelSerializer):
+class LessonBulkItemSerializer(serializers.ModelSerializer):
+    """Элемент массовой загрузки уроков. Курс принимается как id и
+    проверяется одним запросом на всю пачку, а не запросом на каждый элемент"""
+
+    course = serializers.IntegerField(source="course_id", min_value=1)
+
+    class Meta:
+        model = Lesson
+        fields = ("course", "title", "description", "video_url")
+        validators = [YouTubeValidator(field="video_url")]
+
+
+class CourseSerializer(SparseFieldsSerializerMixin, serializers.ModelSerializer):
     lesson_count = SerializerMethodField()
 
     is_subscribed = serializers.SerializerMethodField()
@@ -19,6 +44,10 @@ class CourseSerializer(serializers.ModelSerializer):
     lessons = LessonSerializer(many=True, read_only=True)
 
     def get_is_subscribed(self, obj):
+        # Если queryset уже посчитал флаг аннотацией (CourseViewSet), берем его
+        if hasattr(obj, "is_subscribed"):
+            return obj.is_subscribed
+
         # Получаем текущего пользователя из контекста запроса
         request = self.context.get("request")
         if request and request.user.is_authenticated:
@@ -28,7 +57,51 @@ class CourseSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = Course
-        fields = "__all__"
+        exclude = ("search_vector",)
 
     def get_lesson_count(self, obj):
+        # Аннотация из queryset избавляет от COUNT на каждый курс
+        if hasattr(obj, "lesson_count"):
+            return obj.lesson_count
         return obj.lessons.count()
+
+
+class SubscriptionToggleSerializer(serializers.Serializer):
+    course_id = serializers.IntegerField(min_value=1)
+
+
+class BulkSubscriptionSerializer(serializers.Serializer):
+    """Список курсов для массовой подписки или отписки"""
+
+    course_ids = serializers.ListField(
+        child=serializers.IntegerField(min_value=1), allow_empty=False, max_length=1000
+    )
+    action = serializers.ChoiceField(choices=("subscribe", "unsubscribe"))
+
+
+# Маркеры подсветки для ts_headline: управляющие символы, которые не
+# меняются при экранировании HTML и не встречаются в обычном тексте
+HIGHLIGHT_START = "\x02"
+HIGHLIGHT_STOP = "\x03"
+
+
+class HighlightField(serializers.CharField):
+    """Фрагмент с подсветкой: текст курса/урока экранируется как HTML,
+    размечены только совпадения (<mark>)"""
+
+    def to_representation(self, value):
+        return (
+            escape(super().to_representation(value))
+            .replace(HIGHLIGHT_START, "<mark>")
+            .replace(HIGHLIGHT_STOP, "</mark>")
+        )
+
+
+class SearchResultSerializer(serializers.Serializer):
+    """Результат полнотекстового поиска с подсвеченными фрагментами"""
+
+    id = serializers.IntegerField()
+    title = serializers.CharField()
+    rank = serializers.FloatField()
+    title_highlight = HighlightField()
+    snippet = HighlightField(allow_null=True)
@@ -0,0 +1,159 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from .cache import bump_versions
+from .models import Course, Lesson, NotificationOutbox
+from .serializers import LessonBulkItemSerializer
+
+# Поля, изменение которых видно подписчикам и требует рассылки
+COURSE_NOTIFY_FIELDS = ("title", "description", "preview")
+LESSON_NOTIFY_FIELDS = ("title", "description", "preview", "video_url", "course")
+
+
+def changed_fields(instance, data, fields):
+    """Поля из fields, значения которых в data отличаются от текущих
+    значений объекта. Сравнение в памяти, без запросов к БД: для внешних
+    ключей сравниваются id (data может содержать "course" или "course_id")"""
+    changed = []
+    for name in fields:
+        field = instance._meta.get_field(name)
+        if name in data:
+            value = data[name]
+        elif field.attname in data:
+            value = data[field.attname]
+        else:
+            continue
+
+        if field.is_relation:
+            current, value = getattr(instance, field.attname), getattr(
+                value, "pk", value
+            )
+        else:
+            current = getattr(instance, name)
+        if current != value:
+            changed.append(name)
+    return changed
+
+
+def schedule_course_notifications(course_ids):
+    """Ставит рассылку об обновлении курсов в outbox с задержкой
+    COURSE_NOTIFY_DEBOUNCE. Вызывается в транзакции изменения: при откате
+    рассылки не будет. Все изменения курса до отправки объединяются
+    в одну рассылку (одна ожидающая запись outbox на курс)"""
+    course_ids = set(course_ids) - {None}
+    if course_ids:
+        NotificationOutbox.objects.enqueue(
+            course_ids, timedelta(seconds=settings.COURSE_NOTIFY_DEBOUNCE)
+        )
+
+
+def touch_courses(course_ids):
+    """Отмечает курсы обновленными после массовых операций с уроками,
+    которые не отправляют сигналы моделей (bulk_create / bulk_update)"""
+    course_ids = set(course_ids)
+    if course_ids:
+        Course.objects.filter(pk__in=course_ids).update(updated_at=timezone.now())
+        transaction.on_commit(lambda: bump_versions("course", course_ids))
+
+
+def bulk_save_lessons(items, user_id, is_moderator):
+    """Создает и обновляет уроки пачкой.
+
+    Элементы с "id" обновляют существующий урок (частично), без "id" -
+    создают новый. Все элементы валидируются за один проход, курсы
+    и обновляемые уроки загружаются двумя запросами, а сохранение
+    выполняется через bulk_create / bulk_update в одной транзакции.
+    Возвращает список результатов по каждому элементу в исходном порядке"""
+    results = [None] * len(items)
+    validated = []
+
+    for index, item in enumerate(items):
+        if not isinstance(item, dict):
+            results[index] = {
+                "index": index,
+                "errors": {"non_field_errors": ["Ожидается объект"]},
+            }
+            continue
+
+        lesson_id = item.get("id")
+        if lesson_id is not None and (
+            not isinstance(lesson_id, int) or isinstance(lesson_id, bool)
+        ):
+            results[index] = {"index": index, "errors": {"id": ["Ожидается число"]}}
+            continue
+
+        serializer = LessonBulkItemSerializer(data=item, partial=lesson_id is not None)
+        if serializer.is_valid():
+            validated.append((index, lesson_id, serializer.validated_data))
+        else:
+            results[index] = {"index": index, "errors": serializer.errors}
+
+    lesson_ids = {lesson_id for _, lesson_id, _ in validated if lesson_id is not None}
+    lessons = Lesson.objects.in_bulk(lesson_ids)
+    course_ids = {data["course_id"] for _, _, data in validated if "course_id" in data}
+    course_owners = dict(
+        Course.objects.filter(pk__in=course_ids).values_list("id", "owner_id")
+    )
+
+    to_create, to_update, update_fields = [], [], set()
+    affected_courses, notify_courses = set(), set()
+    for index, lesson_id, data in validated:
+        errors = {}
+        course_id = data.get("course_id")
+
+        if course_id is not None:
+            if course_id not in course_owners:
+                errors["course"] = ["Курс не найден"]
+            elif course_owners[course_id] != user_id and not is_moderator:
+                errors["course"] = ["Можно добавлять уроки только в свои курсы"]
+
+        if lesson_id is None:
+            if is_moderator:
+                errors["non_field_errors"] = ["Модераторы не могут создавать уроки"]
+        else:
+            lesson = lessons.get(lesson_id)
+            if lesson is None:
+                errors["id"] = ["Урок не найден"]
+            elif lesson.owner_id != user_id and not is_moderator:
+                errors["id"] = ["Можно изменять только свои уроки"]
+
+        if errors:
+            results[index] = {"index": index, "errors": errors}
+            continue
+
+        if lesson_id is None:
+            lesson = Lesson(owner_id=user_id, **data)
+            to_create.append((index, lesson))
+            notify_courses.add(lesson.course_id)
+        else:
+            # При переносе урока в другой курс изменились оба курса
+            affected_courses.add(lesson.course_id)
+            if changed_fields(lesson, data, LESSON_NOTIFY_FIELDS):
+                notify_courses.update((lesson.course_id, data.get("course_id")))
+            for field, value in data.items():
+                setattr(lesson, field, value)
+            update_fields.update(data)
+            to_update.append((index, lesson))
+        affected_courses.add(lesson.course_id)
+
+    with transaction.atomic():
+        if to_create:
+            Lesson.objects.bulk_create([lesson for _, lesson in to_create])
+        if to_update and update_fields:
+            Lesson.objects.bulk_update(
+                [lesson for _, lesson in to_update], fields=sorted(update_fields)
+            )
+
+        touch_courses(affected_courses)
+        schedule_course_notifications(notify_courses)
+
+    for index, lesson in to_create:
+        results[index] = {"index": index, "id": lesson.pk, "status": "created"}
+    for index, lesson in to_update:
+        results[index] = {"index": index, "id": lesson.pk, "status": "updated"}
+
+    bump_versions("lesson", [lesson.pk for _, lesson in to_update])
+    return results
@@ -0,0 +1,45 @@
+from django.db import transaction
+from django.db.models.signals import post_delete, post_init, post_save
+from django.dispatch import receiver
+from django.utils import timezone
+
+from .cache import bump_version, bump_versions, touch_subscriptions
+from .models import Course, Lesson, Subscription
+
+
+@receiver([post_save, post_delete], sender=Course)
+def invalidate_course_fragments(sender, instance, **kwargs):
+    """Изменение курса инвалидирует его закэшированное представление.
+    Версия сдвигается после коммита: иначе читатель, пришедший до коммита,
+    закэшировал бы старую строку под новой версией"""
+    course_id = instance.pk
+    transaction.on_commit(lambda: bump_version("course", course_id))
+
+
+@receiver(post_init, sender=Lesson)
+def remember_lesson_course(sender, instance, **kwargs):
+    """Запоминает курс урока, чтобы при переносе урока обновить и старый курс.
+    Читается только загруженное значение: обращение к отложенному полю
+    (queryset.only) стоило бы отдельного запроса на каждый урок"""
+    instance._loaded_course_id = instance.__dict__.get("course_id")
+
+
+@receiver([post_save, post_delete], sender=Lesson)
+def invalidate_lesson_fragments(sender, instance, **kwargs):
+    """Урок входит в представление курса, поэтому курс тоже считается
+    обновленным: сдвигаем updated_at (ETag/Last-Modified) и версию фрагмента.
+    При переносе урока в другой курс обновляются оба курса (старый курс
+    неизвестен, только если урок загружен без course_id)"""
+    course_ids = {instance.course_id, instance._loaded_course_id} - {None}
+    instance._loaded_course_id = instance.course_id
+    Course.objects.filter(pk__in=course_ids).update(updated_at=timezone.now())
+    lesson_id = instance.pk
+    transaction.on_commit(lambda: bump_version("lesson", lesson_id))
+    transaction.on_commit(lambda: bump_versions("course", course_ids))
+
+
+@receiver([post_save, post_delete], sender=Subscription)
+def invalidate_subscription_fragments(sender, instance, **kwargs):
+    course_id, user_id = instance.course_id, instance.user_id
+    transaction.on_commit(lambda: bump_version("course", course_id))
+    transaction.on_commit(lambda: touch_subscriptions(user_id))
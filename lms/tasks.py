@@ -1,27 +1,188 @@
+from datetime import timedelta
+from itertools import islice
+from smtplib import SMTPException, SMTPRecipientsRefused
+
 from celery import shared_task
-from django.core.mail import send_mail
+from django.contrib.auth import get_user_model
+from django.contrib.postgres.aggregates import ArrayAgg
+from django.core.mail import EmailMessage, get_connection
 from django.conf import settings
-from .models import Course, Subscription
+from django.db.models import F, Value
+from django.db.models.functions import Coalesce
+from django.utils import timezone
 
+from config.metrics import gauge, incr
+from .cache import add_notification_progress, start_notification_progress
+from .models import Course, NotificationOutbox, Subscription
 
-@shared_task
-def send_course_update_email(course_id):
-    """ Асинхронная задача для отправки писем об обновлении курса """
-    try:
-        course = Course.objects.get(pk=course_id)
-        subscriptions = Subscription.objects.filter(course=course)
-
-        recipient_list = [sub.user.email for sub in subscriptions if sub.user.email]
-
-        if recipient_list:
-            send_mail(
-                subject=f'Обновление курса: {course.title}',
-                message=f'Курс "{course.title}" был обновлен. Зайдите посмотреть новые материалы!',
-                from_email=settings.EMAIL_HOST_USER if hasattr(settings, 'EMAIL_HOST_USER') else 'noreply@lms.com',
-                recipient_list=recipient_list,
-                fail_silently=False
-            )
-            print(f"Письма отправлены подписчикам курса {course.title}")
 
+def _chunks(iterable, size):
+    """Разбивает поток на списки по size элементов"""
+    iterator = iter(iterable)
+    while chunk := list(islice(iterator, size)):
+        yield chunk
+
+
+@shared_task(bind=True)
+def send_course_update_email(self, course_id):
+    """Асинхронная задача для отправки писем об обновлении курса.
+    Адреса подписчиков читаются из БД потоком и раздаются пачками
+    по подзадачам send_course_update_batch"""
+    try:
+        course = Course.objects.only("title").get(pk=course_id)
     except Course.DoesNotExist:
         print(f"Курс с id {course_id} не найден.")
+        return None
+
+    run_id = self.request.id or f"course-{course_id}"
+    batch_size = settings.COURSE_NOTIFY_BATCH_SIZE
+    start_notification_progress(run_id)
+
+    emails = (
+        Subscription.objects.filter(
+            course_id=course_id,
+            # Пользователи в режиме сводки получат курс в send_daily_digest
+            user__notification_mode=get_user_model().NOTIFY_INSTANT,
+        )
+        .exclude(user__email="")
+        .order_by()
+        .values_list("user__email", flat=True)
+        .iterator(chunk_size=batch_size)
+    )
+    recipients = batches = 0
+    for batch in _chunks(emails, batch_size):
+        recipients += len(batch)
+        batches += 1
+        add_notification_progress(run_id, recipients=len(batch), batches=1)
+        send_course_update_batch.delay(run_id, course.title, batch)
+
+    print(f"Рассылка по курсу {course.title}: {recipients} адресов, {batches} пачек")
+    return {"run_id": run_id, "recipients": recipients, "batches": batches}
+
+
+@shared_task(
+    bind=True,
+    max_retries=settings.COURSE_NOTIFY_MAX_RETRIES,
+    default_retry_delay=settings.COURSE_NOTIFY_RETRY_DELAY,
+)
+def send_course_update_batch(self, run_id, course_title, emails):
+    """Отправляет пачку писем (по одному на получателя) через одно
+    SMTP-соединение. При обрыве соединения пачка повторяется только
+    для адресов, которым письмо еще не ушло"""
+    from_email = getattr(settings, "EMAIL_HOST_USER", None) or "noreply@lms.com"
+    subject = f"Обновление курса: {course_title}"
+    body = f'Курс "{course_title}" был обновлен. Зайдите посмотреть новые материалы!'
+
+    sent = failed = 0
+    try:
+        with get_connection() as connection:
+            for email in emails:
+                message = EmailMessage(
+                    subject, body, from_email, [email], connection=connection
+                )
+                try:
+                    message.send()
+                except SMTPRecipientsRefused:
+                    # Адрес отклонен сервером - повтор не поможет
+                    failed += 1
+                else:
+                    sent += 1
+    except (SMTPException, OSError) as exc:
+        remaining = emails[sent + failed :]
+        add_notification_progress(run_id, sent=sent, failed=failed)
+        if self.request.retries >= self.max_retries:
+            add_notification_progress(run_id, failed=len(remaining))
+            raise
+        raise self.retry(args=(run_id, course_title, remaining), exc=exc)
+
+    add_notification_progress(run_id, sent=sent, failed=failed)
+    return {"sent": sent, "failed": failed}
+
+
+@shared_task
+def dispatch_notification_outbox():
+    """Диспетчер outbox: забирает созревшие записи пачками (FOR UPDATE SKIP
+    LOCKED, поэтому несколько воркеров работают параллельно без дублей),
+    запускает рассылку по каждому курсу один раз на пачку и отмечает
+    записи отправленными. Пишет метрики глубины и возраста очереди"""
+    batch_size = settings.NOTIFICATION_OUTBOX_BATCH_SIZE
+    lease = timedelta(seconds=settings.NOTIFICATION_OUTBOX_LEASE)
+
+    dispatched = 0
+    for _ in range(settings.NOTIFICATION_OUTBOX_MAX_BATCHES):
+        rows = NotificationOutbox.objects.claim(batch_size, lease)
+        if not rows:
+            break
+        for course_id in {course_id for _, course_id in rows}:
+            send_course_update_email.delay(course_id)
+        NotificationOutbox.objects.mark_sent([pk for pk, _ in rows])
+        dispatched += len(rows)
+
+    NotificationOutbox.objects.purge(
+        timedelta(days=settings.NOTIFICATION_OUTBOX_RETENTION_DAYS)
+    )
+
+    stats = NotificationOutbox.objects.stats()
+    gauge("outbox.depth", stats["depth"])
+    gauge("outbox.age_seconds", round(stats["age"], 1))
+    incr("outbox.dispatched", dispatched)
+    return dispatched
+
+
+@shared_task
+def send_daily_digest():
+    """Ежедневная сводка для пользователей в режиме digest: одно письмо
+    со всеми курсами, рассылка по которым прошла после предыдущей сводки.
+    Получатели и списки курсов выбираются одним сгруппированным запросом
+    (подписки + outbox отправленных рассылок), читаются потоком и
+    обрабатываются пачками: письма пачки идут через одно соединение,
+    затем last_digest_at пачки обновляется одним UPDATE"""
+    User = get_user_model()
+    started = timezone.now()
+    batch_size = settings.DIGEST_BATCH_SIZE
+    outbox = "subscriptions__course__notificationoutbox__sent_at"
+
+    digests = (
+        User.objects.filter(notification_mode=User.NOTIFY_DIGEST, is_active=True)
+        .exclude(email="")
+        .filter(
+            **{
+                f"{outbox}__gt": Coalesce(
+                    F("last_digest_at"), Value(started - timedelta(days=1))
+                ),
+                f"{outbox}__lte": started,
+            }
+        )
+        .values("id", "email")
+        .annotate(
+            courses=ArrayAgg(
+                "subscriptions__course__title",
+                distinct=True,
+                order_by="subscriptions__course__title",
+            )
+        )
+        .order_by("id")
+        .iterator(chunk_size=batch_size)
+    )
+
+    from_email = getattr(settings, "EMAIL_HOST_USER", None) or "noreply@lms.com"
+    sent = 0
+    for batch in _chunks(digests, batch_size):
+        messages = [
+            EmailMessage(
+                "Обновления ваших курсов",
+                "Обновились курсы:\n"
+                + "\n".join(f"- {title}" for title in digest["courses"]),
+                from_email,
+                [digest["email"]],
+            )
+            for digest in batch
+        ]
+        with get_connection() as connection:
+            sent += connection.send_messages(messages)
+        User.objects.filter(pk__in=[digest["id"] for digest in batch]).update(
+            last_digest_at=started
+        )
+
+    incr("digest.sent", sent)
+    return sent
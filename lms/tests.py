@@ -1,9 +1,34 @@
+import socket
+from datetime import timedelta
+from smtplib import SMTPException, SMTPRecipientsRefused, SMTPServerDisconnected
+from unittest import mock
+
+from aiosmtpd.controller import Controller
 from rest_framework.test import APITestCase
 from rest_framework import status
+from django.core import mail
+from django.core.mail import EmailMessage, send_mail
+from django.core.cache import cache
+from django.core.mail.backends import locmem
+from django.db import transaction
+from django.test import SimpleTestCase, override_settings
+from django.utils import timezone
 from django.urls import reverse
 from django.contrib.auth.models import Group
 from users.models import User
-from lms.models import Course, Lesson, Subscription
+from lms.models import Course, Lesson, NotificationOutbox, Subscription
+from lms.cache import get_notification_progress, get_versions
+from lms.paginators import CustomPagination
+from lms.serializers import HighlightField
+from lms.services import schedule_course_notifications
+from lms.tasks import (
+    dispatch_notification_outbox,
+    send_course_update_email,
+    send_daily_digest,
+)
+from config.celery import app as celery_app
+from config.mail import PooledSMTPEmailBackend
+from config.metrics import get_metric
 
 MODERATOR_GROUP_NAME = "Moderators"
 
@@ -133,6 +158,373 @@ class CourseTestCase(LMSPermissionsTestCase):
         self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
 
 
+class CourseCatalogTestCase(APITestCase):
+    """Базовый класс: каталог из нескольких страниц курсов с уроками"""
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create(email="queries@lms.com")
+        self.page_size = CustomPagination.page_size
+
+        for i in range(self.page_size * 2):
+            course = Course.objects.create(title=f"Course {i}", owner=self.user)
+            for j in range(3):
+                Lesson.objects.create(
+                    title=f"Lesson {i}.{j}",
+                    course=course,
+                    video_url="https://www.youtube.com/watch?v=1",
+                    owner=self.user,
+                )
+            if i % 2:
+                Subscription.objects.create(user=self.user, course=course)
+
+        self.client.force_authenticate(user=self.user)
+
+
+class CourseQueryCountTestCase(CourseCatalogTestCase):
+    """Число запросов к БД при выводе курсов не зависит от размера страницы"""
+
+    def test_course_list_query_count(self):
+        """Свежесть для ETag + COUNT + id страницы, затем при холодном кэше
+        выборка курсов + пакет уроков, при горячем - подписки пользователя"""
+        url = reverse("lms:course-list")
+
+        params = {"page_size": self.page_size, "expand": "lessons"}
+        with self.assertNumQueries(5):
+            response = self.client.get(url, params)
+        self.assertEqual(len(response.data["results"]), self.page_size)
+
+        params["page_size"] = self.page_size * 2
+        with self.assertNumQueries(6):  # Половина страницы уже в кэше
+            response = self.client.get(url, params)
+        self.assertEqual(len(response.data["results"]), self.page_size * 2)
+
+        with self.assertNumQueries(4):
+            response = self.client.get(url, params)
+
+        first, second = response.data["results"][:2]
+        self.assertEqual(first["lesson_count"], 3)
+        self.assertEqual(len(first["lessons"]), 3)
+        self.assertFalse(first["is_subscribed"])
+        self.assertTrue(second["is_subscribed"])
+
+    def test_course_retrieve_query_count(self):
+        """Свежесть + поиск id + выборка курса + пакет уроков,
+        из кэша - свежесть + id + подписка"""
+        course = Course.objects.order_by("id").last()
+        url = reverse("lms:course-detail", args=[course.pk])
+        with self.assertNumQueries(4):
+            response = self.client.get(url)
+        self.assertEqual(response.data["lesson_count"], 3)
+        self.assertTrue(response.data["is_subscribed"])
+
+        with self.assertNumQueries(3):
+            response = self.client.get(url)
+        self.assertEqual(response.data["lesson_count"], 3)
+        self.assertTrue(response.data["is_subscribed"])
+
+
+class LessonQueryCountTestCase(CourseCatalogTestCase):
+    """Число запросов к БД при выводе уроков не зависит от размера страницы"""
+
+    def test_lesson_list_query_count(self):
+        """При горячем кэше - COUNT + id страницы. Уроки, загруженные
+        только с id, не догружают course_id по одному"""
+        url = reverse("lms:lesson-list")
+        self.client.get(url, {"page_size": 20})
+
+        for page_size in (5, 20):
+            with self.assertNumQueries(2):
+                response = self.client.get(url, {"page_size": page_size})
+            self.assertEqual(len(response.data["results"]), page_size)
+
+    def test_lesson_sparse_fields_query_count(self):
+        """?fields= без course: COUNT + id страницы + выборка уроков"""
+        url = reverse("lms:lesson-list")
+        for page_size in (5, 20):
+            cache.clear()
+            with self.assertNumQueries(3):
+                response = self.client.get(
+                    url, {"page_size": page_size, "fields": "id,title"}
+                )
+            self.assertEqual(len(response.data["results"]), page_size)
+
+    def test_lesson_search_query_count(self):
+        """Поиск по урокам - один запрос на страницу результатов"""
+        with self.assertNumQueries(1):
+            response = self.client.get(
+                reverse("lms:search"), {"q": "lesson", "type": "lessons"}
+            )
+        self.assertEqual(len(response.data["results"]), 10)
+
+
+class CourseFragmentCacheTestCase(CourseCatalogTestCase):
+    """Версионированный кэш представлений курсов и уроков"""
+
+    def setUp(self):
+        super().setUp()
+        self.course = Course.objects.order_by("id").first()
+        self.url = reverse("lms:course-detail", args=[self.course.pk])
+        self.client.get(self.url)  # Прогреваем кэш
+
+    def test_course_change_invalidates_fragment(self):
+        """Сохранение курса инвалидирует закэшированное представление"""
+        self.course.title = "Renamed"
+        with self.captureOnCommitCallbacks(execute=True):
+            self.course.save()
+        self.assertEqual(self.client.get(self.url).data["title"], "Renamed")
+
+    def test_version_bumped_after_commit(self):
+        """До коммита версия фрагмента не меняется, иначе читатель
+        закэшировал бы старую строку под новой версией"""
+        version = get_versions("course", [self.course.pk])[self.course.pk]
+        with self.captureOnCommitCallbacks() as callbacks:
+            self.course.title = "Renamed"
+            self.course.save()
+        self.assertEqual(
+            get_versions("course", [self.course.pk])[self.course.pk], version
+        )
+
+        for callback in callbacks:
+            callback()
+        self.assertNotEqual(
+            get_versions("course", [self.course.pk])[self.course.pk], version
+        )
+
+    def test_lesson_change_invalidates_course_fragment(self):
+        """Новый урок инвалидирует представление своего курса"""
+        with self.captureOnCommitCallbacks(execute=True):
+            Lesson.objects.create(
+                title="Extra",
+                course=self.course,
+                video_url="https://www.youtube.com/watch?v=2",
+                owner=self.user,
+            )
+        response = self.client.get(self.url)
+        self.assertEqual(response.data["lesson_count"], 4)
+        self.assertEqual(len(response.data["lessons"]), 4)
+
+    def test_is_subscribed_overlaid_per_user(self):
+        """Общий фрагмент не содержит флаг подписки другого пользователя"""
+        other = User.objects.create(email="other-reader@lms.com")
+        Subscription.objects.create(user=other, course=self.course)
+
+        self.assertFalse(self.client.get(self.url).data["is_subscribed"])
+        self.client.force_authenticate(user=other)
+        self.assertTrue(self.client.get(self.url).data["is_subscribed"])
+
+
+class CourseSparseFieldsTestCase(CourseCatalogTestCase):
+    """Выборочный вывод полей курсов и уроков"""
+
+    def test_course_list_summary_by_default(self):
+        """Список курсов по умолчанию - краткое представление без уроков"""
+        with self.assertNumQueries(4):  # Свежесть + COUNT + id + курсы без уроков
+            response = self.client.get(reverse("lms:course-list"))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            set(response.data["results"][0]),
+            {"id", "title", "preview", "lesson_count", "is_subscribed"},
+        )
+
+    def test_course_list_fields_and_expand(self):
+        """?fields= ограничивает поля, ?expand=lessons добавляет уроки"""
+        response = self.client.get(
+            reverse("lms:course-list"), {"fields": "id,title", "expand": "lessons"}
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(set(response.data["results"][0]), {"id", "title", "lessons"})
+        self.assertEqual(len(response.data["results"][0]["lessons"]), 3)
+
+    def test_course_retrieve_full_by_default(self):
+        """Детальный просмотр курса по умолчанию отдает все поля"""
+        course = Course.objects.first()
+        response = self.client.get(reverse("lms:course-detail", args=[course.pk]))
+        self.assertIn("description", response.data)
+        self.assertIn("lessons", response.data)
+
+    def test_unknown_field_rejected(self):
+        """Неизвестное поле в ?fields= - ошибка 400"""
+        response = self.client.get(reverse("lms:course-list"), {"fields": "id,price"})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_lesson_list_fields(self):
+        """?fields= работает и для уроков"""
+        response = self.client.get(reverse("lms:lesson-list"), {"fields": "id,title"})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(set(response.data["results"][0]), {"id", "title"})
+
+
+class CourseConditionalGetTestCase(CourseCatalogTestCase):
+    """ETag / Last-Modified и ответы 304 для курсов"""
+
+    def setUp(self):
+        super().setUp()
+        self.course = Course.objects.order_by("id").first()
+        self.detail_url = reverse("lms:course-detail", args=[self.course.pk])
+        self.list_url = reverse("lms:course-list")
+
+    def test_retrieve_not_modified(self):
+        """Повторный запрос с If-None-Match - 304 за один запрос к БД"""
+        response = self.client.get(self.detail_url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertIn("Last-Modified", response)
+        etag = response["ETag"]
+
+        with self.assertNumQueries(1):
+            response = self.client.get(self.detail_url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+    def test_retrieve_if_modified_since(self):
+        """If-Modified-Since с текущим Last-Modified - 304"""
+        response = self.client.get(self.detail_url)
+        response = self.client.get(
+            self.detail_url, HTTP_IF_MODIFIED_SINCE=response["Last-Modified"]
+        )
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+    def test_lesson_change_refreshes_course_etag(self):
+        """Изменение урока меняет ETag курса"""
+        etag = self.client.get(self.detail_url)["ETag"]
+
+        lesson = self.course.lessons.first()
+        lesson.title = "Changed lesson"
+        lesson.save()
+
+        response = self.client.get(self.detail_url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(response["ETag"], etag)
+
+    def test_moved_lesson_refreshes_both_courses(self):
+        """Перенос урока в другой курс меняет ETag и содержимое старого курса"""
+        etag = self.client.get(self.detail_url)["ETag"]
+        other = Course.objects.order_by("id").last()
+        other_url = reverse("lms:course-detail", args=[other.pk])
+        self.client.get(other_url)  # Прогреваем кэш
+        lesson = self.course.lessons.first()
+
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.patch(
+                reverse("lms:lesson-detail", args=[lesson.pk]), {"course": other.pk}
+            )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        response = self.client.get(self.detail_url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data["lesson_count"], 2)
+        self.assertEqual(self.client.get(other_url).data["lesson_count"], 4)
+
+    def test_list_not_modified_until_subscription_changes(self):
+        """ETag списка учитывает подписки текущего пользователя"""
+        etag = self.client.get(self.list_url)["ETag"]
+
+        with self.assertNumQueries(1):
+            response = self.client.get(self.list_url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Subscription.objects.create(user=self.user, course=self.course)
+        response = self.client.get(self.list_url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response.data["results"][0]["is_subscribed"])
+
+    def test_list_etag_depends_on_page(self):
+        """Разные страницы - разные ETag"""
+        first = self.client.get(self.list_url)["ETag"]
+        second = self.client.get(self.list_url, {"page": 2})["ETag"]
+        self.assertNotEqual(first, second)
+
+
+class CursorPaginationTestCase(CourseCatalogTestCase):
+    """Курсорная пагинация курсов и уроков"""
+
+    def test_course_cursor_pages_without_count(self):
+        """Без COUNT(*): свежесть + id страницы (page_size + 1) + выборка курсов"""
+        url = reverse("lms:course-list")
+        with self.assertNumQueries(3):
+            response = self.client.get(url, {"pagination": "cursor"})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotIn("count", response.data)
+        self.assertEqual(len(response.data["results"]), self.page_size)
+        self.assertIsNotNone(response.data["next"])
+
+    def test_course_cursor_stable_under_inserts(self):
+        """Новые курсы не сдвигают следующую страницу"""
+        response = self.client.get(reverse("lms:course-list"), {"pagination": "cursor"})
+        first_page = [item["id"] for item in response.data["results"]]
+
+        Course.objects.create(title="Inserted meanwhile", owner=self.user)
+
+        response = self.client.get(response.data["next"])
+        second_page = [item["id"] for item in response.data["results"]]
+
+        expected = list(
+            Course.objects.order_by("id").values_list("id", flat=True)[
+                self.page_size : self.page_size * 2
+            ]
+        )
+        self.assertEqual(second_page, expected)
+        self.assertFalse(set(first_page) & set(second_page))
+
+    def test_lesson_cursor_pagination(self):
+        """Курсорная пагинация уроков проходит весь список"""
+        url = reverse("lms:lesson-list")
+        seen = []
+        params = {"pagination": "cursor", "page_size": 10}
+        while url:
+            response = self.client.get(url, params)
+            params = None
+            seen += [item["id"] for item in response.data["results"]]
+            url = response.data["next"]
+        self.assertEqual(
+            seen, list(Lesson.objects.order_by("id").values_list("id", flat=True))
+        )
+
+
+class CourseAutocompleteTestCase(CourseCatalogTestCase):
+    """Автодополнение названий курсов по префиксу"""
+
+    def setUp(self):
+        super().setUp()
+        self.url = reverse("lms:course-autocomplete")
+        Course.objects.create(title="Python для начинающих", owner=self.user)
+        Course.objects.create(title="pytest на практике", owner=self.user)
+        Course.objects.create(title="Основы Django", owner=self.user)
+
+    def test_prefix_is_case_insensitive_and_sorted(self):
+        """Префикс ищется без учета регистра, результат отсортирован"""
+        with self.assertNumQueries(1):
+            response = self.client.get(self.url, {"q": "PYT"})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            [item["title"] for item in response.data],
+            ["pytest на практике", "Python для начинающих"],
+        )
+        self.assertEqual(set(response.data[0]), {"id", "title"})
+
+    def test_cyrillic_prefix(self):
+        """Кириллица тоже приводится к нижнему регистру"""
+        response = self.client.get(self.url, {"q": "осн"})
+        self.assertEqual([item["title"] for item in response.data], ["Основы Django"])
+
+    def test_limit(self):
+        """limit ограничивает выдачу и не превышает максимум"""
+        response = self.client.get(self.url, {"q": "course", "limit": 3})
+        self.assertEqual(len(response.data), 3)
+
+        response = self.client.get(self.url, {"q": "course", "limit": 1000})
+        self.assertEqual(len(response.data), self.page_size * 2)
+
+        response = self.client.get(self.url, {"q": "course", "limit": "x"})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_empty_prefix(self):
+        """Пустой запрос не обращается к базе"""
+        with self.assertNumQueries(0):
+            response = self.client.get(self.url, {"q": "  "})
+        self.assertEqual(response.data, [])
+
+
 class LessonTestCase(LMSPermissionsTestCase):
     """Тесты CRUD и прав доступа для модели Lesson"""
 
@@ -194,6 +586,182 @@ class LessonTestCase(LMSPermissionsTestCase):
         self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
 
 
+class LessonBulkTestCase(LMSPermissionsTestCase):
+    """Массовое создание и обновление уроков"""
+
+    def setUp(self):
+        super().setUp()
+        self.bulk_url = reverse("lms:lesson-bulk")
+        self.foreign_course = Course.objects.create(
+            title="Foreign", owner=self.non_owner_user
+        )
+
+    def test_bulk_create_and_update(self):
+        """Все элементы корректны - один INSERT и один UPDATE"""
+        self.authenticate_as_user(self.owner_user)
+        items = [
+            {
+                "course": self.course.pk,
+                "title": f"Bulk {i}",
+                "video_url": "https://www.youtube.com/watch?v=b",
+            }
+            for i in range(50)
+        ]
+        items.append({"id": self.lesson.pk, "title": "Bulk updated"})
+
+        # роль + уроки для обновления + курсы +
+        # SAVEPOINT/INSERT/UPDATE/курсы/outbox/RELEASE
+        with self.assertNumQueries(9):
+            response = self.client.post(self.bulk_url, items, format="json")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(self.course.lessons.count(), 51)
+
+        self.lesson.refresh_from_db()
+        self.assertEqual(self.lesson.title, "Bulk updated")
+        self.assertEqual(response.data["results"][-1]["status"], "updated")
+
+    def test_bulk_partial_failure(self):
+        """Ошибочные элементы описываются по индексу, остальные сохраняются"""
+        self.authenticate_as_user(self.owner_user)
+        items = [
+            {
+                "course": self.course.pk,
+                "title": "Valid",
+                "video_url": "https://www.youtube.com/watch?v=ok",
+            },
+            {
+                "course": self.course.pk,
+                "title": "Bad url",
+                "video_url": "https://vimeo.com/1",
+            },
+            {
+                "course": self.foreign_course.pk,
+                "title": "Foreign",
+                "video_url": "https://www.youtube.com/watch?v=f",
+            },
+            {"id": 999999, "title": "Missing"},
+        ]
+        response = self.client.post(self.bulk_url, items, format="json")
+        self.assertEqual(response.status_code, status.HTTP_207_MULTI_STATUS)
+
+        results = response.data["results"]
+        self.assertEqual(results[0]["status"], "created")
+        self.assertIn("non_field_errors", results[1]["errors"])
+        self.assertIn("course", results[2]["errors"])
+        self.assertIn("id", results[3]["errors"])
+        self.assertFalse(Lesson.objects.filter(title="Foreign").exists())
+
+    def test_bulk_create_by_moderator_rejected(self):
+        """Модератор может обновлять, но не создавать уроки"""
+        self.authenticate_as_user(self.moderator_user)
+        items = [
+            {"id": self.lesson.pk, "title": "Moderated"},
+            {
+                "course": self.course.pk,
+                "title": "By moderator",
+                "video_url": "https://www.youtube.com/watch?v=m",
+            },
+        ]
+        response = self.client.post(self.bulk_url, items, format="json")
+        self.assertEqual(response.status_code, status.HTTP_207_MULTI_STATUS)
+        self.assertEqual(response.data["results"][0]["status"], "updated")
+        self.assertIn("errors", response.data["results"][1])
+
+    def test_bulk_requires_list(self):
+        """Тело запроса должно быть непустым списком"""
+        self.authenticate_as_user(self.owner_user)
+        response = self.client.post(self.bulk_url, {"title": "x"}, format="json")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class SearchTestCase(APITestCase):
+    """Полнотекстовый поиск по курсам и урокам"""
+
+    def setUp(self):
+        self.user = User.objects.create(email="search@lms.com")
+        self.client.force_authenticate(user=self.user)
+        self.url = reverse("lms:search")
+
+        self.title_match = Course.objects.create(
+            title="Программирование на Python", description="Основы языка"
+        )
+        self.description_match = Course.objects.create(
+            title="Анализ данных", description="Используем Python и pandas"
+        )
+        Course.objects.create(title="Рисование", description="Акварель и гуашь")
+        Lesson.objects.create(
+            course=self.description_match,
+            title="Графики",
+            description="Строим графики в Python",
+            video_url="https://www.youtube.com/watch?v=s",
+        )
+
+    def test_search_ranks_title_higher(self):
+        """Совпадение в названии ранжируется выше совпадения в описании"""
+        response = self.client.get(self.url, {"q": "python"})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        results = response.data["results"]
+        self.assertEqual(
+            [item["id"] for item in results],
+            [self.title_match.pk, self.description_match.pk],
+        )
+        self.assertIn("<mark>Python</mark>", results[0]["title_highlight"])
+        self.assertIn("<mark>Python</mark>", results[1]["snippet"])
+
+    def test_highlight_escapes_markup(self):
+        """Разметка из названия и описания экранируется, остается только <mark>"""
+        Course.objects.create(
+            title="<script>alert(1)</script> Безопасность",
+            description='<img src=x onerror="alert(1)"> Безопасность',
+        )
+        response = self.client.get(self.url, {"q": "безопасность"})
+
+        result = response.data["results"][0]
+        for text in (result["title_highlight"], result["snippet"]):
+            self.assertNotIn("<script", text)
+            self.assertNotIn("<img", text)
+            self.assertIn("<mark>", text)
+
+        field = HighlightField()
+        self.assertEqual(
+            field.to_representation("<b>\x02Python\x03</b>"),
+            "&lt;b&gt;<mark>Python</mark>&lt;/b&gt;",
+        )
+
+    def test_search_uses_stemming(self):
+        """Словоформы находятся по основе слова"""
+        response = self.client.get(self.url, {"q": "программированию"})
+        self.assertEqual(
+            [item["id"] for item in response.data["results"]], [self.title_match.pk]
+        )
+
+    def test_search_lessons(self):
+        """?type=lessons ищет по урокам"""
+        response = self.client.get(self.url, {"q": "графики", "type": "lessons"})
+        self.assertEqual(len(response.data["results"]), 1)
+        self.assertEqual(response.data["results"][0]["title"], "Графики")
+
+    def test_search_cursor_pagination(self):
+        """Курсорная пагинация проходит все результаты без повторов"""
+        for i in range(5):
+            Course.objects.create(title=f"Python {i}", description="Python python")
+
+        seen, url, params = [], self.url, {"q": "python", "page_size": 2}
+        while url:
+            response = self.client.get(url, params)
+            params = None
+            seen += [item["id"] for item in response.data["results"]]
+            url = response.data["next"]
+        self.assertEqual(len(seen), 7)
+        self.assertEqual(len(set(seen)), 7)
+
+    def test_search_requires_query(self):
+        """Без ?q= - ошибка 400"""
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
 class SubscriptionTestCase(APITestCase):
     """Тесты для эндпоинта подписки"""
 
@@ -227,3 +795,417 @@ class SubscriptionTestCase(APITestCase):
         data = {"course_id": self.course.pk}
         response = self.client.post(self.subscribe_url, data)
         self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_subscribe_toggle_query_count(self):
+        """Подписка - DELETE + INSERT, отписка - один DELETE"""
+        self.client.force_authenticate(user=self.user)
+        data = {"course_id": self.course.pk}
+
+        with self.assertNumQueries(2):
+            response = self.client.post(self.subscribe_url, data)
+        self.assertEqual(response.data["message"], "Подписка добавлена")
+
+        with self.assertNumQueries(1):
+            response = self.client.post(self.subscribe_url, data)
+        self.assertEqual(response.data["message"], "Подписка удалена")
+
+    def test_subscribe_missing_course(self):
+        """Подписка на несуществующий курс - 404"""
+        self.client.force_authenticate(user=self.user)
+        response = self.client.post(self.subscribe_url, {"course_id": 999999})
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_subscribe_refreshes_is_subscribed(self):
+        """После переключения подписки курс отдается с новым флагом"""
+        self.client.force_authenticate(user=self.user)
+        url = reverse("lms:course-detail", args=[self.course.pk])
+        self.assertFalse(self.client.get(url).data["is_subscribed"])
+
+        self.client.post(self.subscribe_url, {"course_id": self.course.pk})
+        self.assertTrue(self.client.get(url).data["is_subscribed"])
+
+    def test_bulk_subscribe_unsubscribe(self):
+        """Массовая подписка пропускает несуществующие курсы и дубли"""
+        self.client.force_authenticate(user=self.user)
+        other = Course.objects.create(title="Other", owner=self.user)
+        Subscription.objects.create(user=self.user, course=self.course)
+        url = reverse("lms:course_subscribe_bulk")
+        course_ids = [self.course.pk, other.pk, 999999]
+
+        with self.assertNumQueries(1):
+            response = self.client.post(
+                url, {"course_ids": course_ids, "action": "subscribe"}, format="json"
+            )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data["course_ids"], [other.pk])
+        self.assertEqual(Subscription.objects.filter(user=self.user).count(), 2)
+
+        with self.assertNumQueries(1):
+            response = self.client.post(
+                url, {"course_ids": course_ids, "action": "unsubscribe"}, format="json"
+            )
+        self.assertEqual(
+            response.data["course_ids"], sorted([self.course.pk, other.pk])
+        )
+        self.assertFalse(Subscription.objects.filter(user=self.user).exists())
+
+
+class FlakyEmailBackend(locmem.EmailBackend):
+    """Почтовый бэкенд, который обрывает соединение на заданном письме"""
+
+    fail_on = {3}
+    sent_total = 0
+
+    def send_messages(self, messages):
+        FlakyEmailBackend.sent_total += 1
+        if FlakyEmailBackend.sent_total in self.fail_on:
+            raise SMTPServerDisconnected("Connection unexpectedly closed")
+        if messages[0].to == ["refused@test.com"]:
+            raise SMTPRecipientsRefused({"refused@test.com": (550, b"No such user")})
+        return super().send_messages(messages)
+
+
+@override_settings(COURSE_NOTIFY_BATCH_SIZE=3)
+class CourseUpdateNotificationTestCase(APITestCase):
+    """Рассылка об обновлении курса пачками"""
+
+    def setUp(self):
+        celery_app.conf.task_always_eager = True
+        self.addCleanup(setattr, celery_app.conf, "task_always_eager", False)
+        cache.clear()
+        FlakyEmailBackend.sent_total = 0
+
+        owner = User.objects.create(email="owner@test.com")
+        self.course = Course.objects.create(title="Notify Course", owner=owner)
+        self.emails = [f"student{i}@test.com" for i in range(7)]
+        for email in self.emails:
+            user = User.objects.create(email=email)
+            Subscription.objects.create(user=user, course=self.course)
+
+    def test_individual_messages_in_batches(self):
+        """Каждому подписчику уходит отдельное письмо, запросов к БД - константа"""
+        with self.assertNumQueries(2):
+            result = send_course_update_email.delay(self.course.pk).get()
+
+        self.assertEqual(result["recipients"], 7)
+        self.assertEqual(result["batches"], 3)
+        self.assertEqual(len(mail.outbox), 7)
+        self.assertTrue(all(len(message.to) == 1 for message in mail.outbox))
+        self.assertCountEqual([m.to[0] for m in mail.outbox], self.emails)
+        self.assertEqual(
+            get_notification_progress(result["run_id"]),
+            {"recipients": 7, "batches": 3, "sent": 7, "failed": 0},
+        )
+
+    @override_settings(EMAIL_BACKEND="lms.tests.FlakyEmailBackend")
+    def test_batch_retry_resends_only_remaining(self):
+        """После обрыва пачка повторяется без уже отправленных адресов,
+        отклоненный сервером адрес не повторяется"""
+        user = User.objects.create(email="refused@test.com")
+        Subscription.objects.create(user=user, course=self.course)
+
+        result = send_course_update_email.delay(self.course.pk).get()
+
+        self.assertCountEqual([m.to[0] for m in mail.outbox], self.emails)
+        self.assertEqual(
+            get_notification_progress(result["run_id"]),
+            {"recipients": 8, "batches": 3, "sent": 7, "failed": 1},
+        )
+
+    def test_missing_course(self):
+        """Несуществующий курс - ничего не отправляется"""
+        self.assertIsNone(send_course_update_email.delay(0).get())
+        self.assertEqual(mail.outbox, [])
+
+
+@override_settings(COURSE_NOTIFY_DEBOUNCE=600)
+class CourseNotificationDebounceTestCase(LMSPermissionsTestCase):
+    """Отложенная рассылка: правки за окно объединяются, пустые правки игнорируются"""
+
+    def setUp(self):
+        super().setUp()
+        self.authenticate_as_user(self.owner_user)
+
+    def patch(self, url, data):
+        response = self.client.patch(url, data)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return response
+
+    def pending(self):
+        return list(
+            NotificationOutbox.objects.filter(sent_at__isnull=True).values_list(
+                "course_id", flat=True
+            )
+        )
+
+    def test_edits_within_window_coalesce(self):
+        """Серия правок курса и уроков дает одну запись outbox с задержкой"""
+        started = timezone.now()
+        self.patch(self.course_detail_url, {"title": "New title"})
+        self.patch(self.course_detail_url, {"description": "New description"})
+        self.patch(self.lesson_detail_url, {"title": "New lesson title"})
+
+        self.assertEqual(self.pending(), [self.course.pk])
+        entry = NotificationOutbox.objects.get()
+        self.assertGreaterEqual(entry.available_at, started + timedelta(seconds=600))
+
+    def test_noop_update_does_not_notify(self):
+        """PATCH без изменений видимых полей рассылку не ставит"""
+        self.patch(self.course_detail_url, {"title": self.course.title})
+        self.patch(self.lesson_detail_url, {"video_url": self.lesson.video_url})
+        self.assertEqual(self.pending(), [])
+
+    def test_single_insert_for_change(self):
+        """Изменение добавляет к запросу только INSERT в outbox"""
+        with self.assertNumQueries(7):
+            self.patch(self.course_detail_url, {"title": self.course.title})
+        with self.assertNumQueries(8):
+            self.patch(self.course_detail_url, {"title": "Changed"})
+
+    def test_rollback_discards_notification(self):
+        """Если транзакция изменения откатилась, рассылки нет"""
+        with self.assertRaises(RuntimeError):
+            with transaction.atomic():
+                schedule_course_notifications([self.course.pk])
+                raise RuntimeError
+        self.assertEqual(self.pending(), [])
+
+    def test_new_notification_after_claim(self):
+        """После того как диспетчер взял запись, следующая правка ставит новую"""
+        self.patch(self.course_detail_url, {"title": "First"})
+        NotificationOutbox.objects.update(available_at=timezone.now())
+        self.assertEqual(
+            len(NotificationOutbox.objects.claim(10, timedelta(minutes=5))), 1
+        )
+
+        self.patch(self.course_detail_url, {"title": "Second"})
+        self.assertEqual(NotificationOutbox.objects.count(), 2)
+
+    def test_bulk_lessons_notify_course(self):
+        """Массовое создание уроков тоже ставит рассылку курса"""
+        response = self.client.post(
+            reverse("lms:lesson-bulk"),
+            [
+                {
+                    "title": "Bulk lesson",
+                    "course": self.course.pk,
+                    "video_url": "https://www.youtube.com/watch?v=1",
+                }
+            ],
+            format="json",
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(self.pending(), [self.course.pk])
+
+
+class NotificationOutboxDispatchTestCase(APITestCase):
+    """Диспетчер outbox рассылок"""
+
+    def setUp(self):
+        cache.clear()
+        owner = User.objects.create(email="outbox@test.com")
+        self.courses = [
+            Course.objects.create(title=f"Outbox {i}", owner=owner) for i in range(3)
+        ]
+        past = timezone.now() - timedelta(minutes=1)
+        for course in self.courses[:2]:
+            NotificationOutbox.objects.create(course=course, available_at=past)
+        NotificationOutbox.objects.create(
+            course=self.courses[2], available_at=timezone.now() + timedelta(hours=1)
+        )
+        patcher = mock.patch.object(send_course_update_email, "delay")
+        self.delay = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_dispatches_ready_entries(self):
+        """Отправляются только созревшие записи, по одной рассылке на курс"""
+        self.assertEqual(dispatch_notification_outbox(), 2)
+        self.assertCountEqual(
+            [call.args[0] for call in self.delay.call_args_list],
+            [course.pk for course in self.courses[:2]],
+        )
+        self.assertEqual(get_metric("outbox.depth"), 1)
+        self.assertEqual(get_metric("outbox.age_seconds"), 0)
+
+        # Повторный запуск ничего не отправляет
+        self.assertEqual(dispatch_notification_outbox(), 0)
+        self.assertEqual(self.delay.call_count, 2)
+
+    def test_claim_skips_claimed_entries(self):
+        """Взятые записи не достаются другому диспетчеру до истечения lease"""
+        lease = timedelta(minutes=5)
+        self.assertEqual(len(NotificationOutbox.objects.claim(1, lease)), 1)
+        self.assertEqual(len(NotificationOutbox.objects.claim(10, lease)), 1)
+        self.assertEqual(NotificationOutbox.objects.claim(10, lease), [])
+
+        # Воркер "упал": после lease записи забираются повторно
+        NotificationOutbox.objects.update(claimed_at=timezone.now() - lease * 2)
+        self.assertEqual(len(NotificationOutbox.objects.claim(10, lease)), 2)
+
+    def test_stats(self):
+        """Глубина - все неотправленные записи, возраст - самой старой созревшей"""
+        stats = NotificationOutbox.objects.stats()
+        self.assertEqual(stats["depth"], 3)
+        self.assertGreaterEqual(stats["age"], 60)
+
+
+class SMTPSinkHandler:
+    """Обработчик aiosmtpd: запоминает письма и соединения, по которым они пришли"""
+
+    def __init__(self):
+        self.recipients = []
+        self.peers = set()
+
+    async def handle_DATA(self, server, session, envelope):
+        self.peers.add(session.peer)
+        self.recipients.extend(envelope.rcpt_tos)
+        return "250 Message accepted for delivery"
+
+
+class PooledSMTPEmailBackendTestCase(SimpleTestCase):
+    """Пул SMTP-соединений на локальном сервере aiosmtpd"""
+
+    def setUp(self):
+        with socket.socket() as sock:
+            sock.bind(("127.0.0.1", 0))
+            self.port = sock.getsockname()[1]
+        self.handler = SMTPSinkHandler()
+        self.start_server()
+        self.addCleanup(lambda: self.server.stop())
+
+    def start_server(self):
+        self.server = Controller(self.handler, hostname="127.0.0.1", port=self.port)
+        self.server.start()
+
+    def get_backend(self, **kwargs):
+        backend = PooledSMTPEmailBackend(
+            host="127.0.0.1", port=self.port, use_tls=False, timeout=5, **kwargs
+        )
+        self.addCleanup(backend.pool.clear)
+        return backend
+
+    def send(self, count, **kwargs):
+        """Каждое письмо через новый экземпляр бэкенда, как в отдельных задачах"""
+        for i in range(count):
+            send_mail(
+                "Subject",
+                "Body",
+                "noreply@lms.com",
+                [f"student{i}@test.com"],
+                connection=self.get_backend(**kwargs),
+            )
+
+    def test_connection_reused_between_backends(self):
+        """Все письма уходят через одно соединение"""
+        self.send(10)
+        self.assertEqual(len(self.handler.recipients), 10)
+        self.assertEqual(len(self.handler.peers), 1)
+
+    def test_max_messages_per_connection(self):
+        """После max_messages писем соединение открывается заново"""
+        with self.get_backend(max_messages=3) as backend:
+            backend.send_messages(
+                [
+                    EmailMessage(
+                        "Subject", "Body", "noreply@lms.com", [f"s{i}@test.com"]
+                    )
+                    for i in range(7)
+                ]
+            )
+        self.assertEqual(len(self.handler.recipients), 7)
+        self.assertEqual(len(self.handler.peers), 3)
+
+    def test_reconnect_after_server_restart(self):
+        """Оборванное сервером соединение из пула заменяется прозрачно"""
+        self.send(1)
+        self.server.stop()
+        self.start_server()
+
+        self.send(1)
+        self.assertEqual(len(self.handler.recipients), 2)
+        self.assertEqual(len(self.handler.peers), 2)
+
+    def test_reconnect_when_all_pooled_connections_dead(self):
+        """Повтор идет через новое соединение, а не через другое
+        оборванное соединение из пула"""
+        first, second = self.get_backend(), self.get_backend()
+        first.open()
+        second.open()
+        first.close()
+        second.close()
+        self.assertEqual(len(first.pool), 2)
+        self.server.stop()
+        self.start_server()
+
+        self.send(1)
+        self.assertEqual(len(self.handler.recipients), 1)
+        self.assertEqual(len(self.handler.peers), 1)
+
+    def test_failed_connection_not_pooled(self):
+        """Соединение, на котором отправка не удалась, не возвращается в пул"""
+        self.send(1)
+        self.server.stop()
+
+        with self.assertRaises((SMTPException, OSError)):
+            self.send(1)
+        self.assertEqual(len(self.get_backend().pool), 0)
+        self.start_server()
+
+    def test_idle_connections_expire(self):
+        """Соединения, простаивавшие дольше max_idle, не переиспользуются"""
+        self.send(2, max_idle=0)
+        self.assertEqual(len(self.handler.peers), 2)
+
+
+class DailyDigestTestCase(APITestCase):
+    """Ежедневная сводка для пользователей в режиме digest"""
+
+    def setUp(self):
+        celery_app.conf.task_always_eager = True
+        self.addCleanup(setattr, celery_app.conf, "task_always_eager", False)
+        cache.clear()
+
+        owner = User.objects.create(email="owner@digest.com")
+        self.courses = [
+            Course.objects.create(title=f"Digest {i}", owner=owner) for i in range(3)
+        ]
+        self.digest_user = User.objects.create(
+            email="digest@test.com", notification_mode=User.NOTIFY_DIGEST
+        )
+        self.instant_user = User.objects.create(email="instant@test.com")
+        for course in self.courses:
+            Subscription.objects.create(user=self.digest_user, course=course)
+            Subscription.objects.create(user=self.instant_user, course=course)
+
+        # Рассылки по первым двум курсам уже прошли
+        sent_at = timezone.now() - timedelta(hours=1)
+        for course in self.courses[:2]:
+            NotificationOutbox.objects.create(
+                course=course, available_at=sent_at, claimed_at=sent_at, sent_at=sent_at
+            )
+
+    def test_one_message_per_user(self):
+        """Одно письмо со всеми обновленными курсами, одним запросом на выборку"""
+        # выборка + UPDATE last_digest_at
+        with self.assertNumQueries(2):
+            self.assertEqual(send_daily_digest(), 1)
+
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(mail.outbox[0].to, ["digest@test.com"])
+        self.assertIn("Digest 0", mail.outbox[0].body)
+        self.assertIn("Digest 1", mail.outbox[0].body)
+        self.assertNotIn("Digest 2", mail.outbox[0].body)
+
+        self.digest_user.refresh_from_db()
+        self.assertIsNotNone(self.digest_user.last_digest_at)
+
+    def test_no_repeat_after_digest(self):
+        """Повторный запуск не присылает уже вошедшие в сводку курсы"""
+        send_daily_digest()
+        self.assertEqual(send_daily_digest(), 0)
+        self.assertEqual(len(mail.outbox), 1)
+
+    def test_instant_fanout_skips_digest_users(self):
+        """Мгновенная рассылка не отправляется пользователям в режиме digest"""
+        send_course_update_email.delay(self.courses[0].pk)
+        self.assertEqual([m.to for m in mail.outbox], [["instant@test.com"]])
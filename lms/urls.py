@@ -1,8 +1,13 @@
 from django.urls import path
 from rest_framework.routers import DefaultRouter
 
-from .views import CourseViewSet, LessonViewSet, SubscriptionAPIView
-
+from .views import (
+    BulkSubscriptionAPIView,
+    CourseViewSet,
+    LessonViewSet,
+    SearchAPIView,
+    SubscriptionAPIView,
+)
 
 app_name = "lms"
 
@@ -14,6 +19,12 @@ router.register(r"lessons", LessonViewSet, basename="lesson")
 
 urlpatterns = [
     path("courses/subscribe/", SubscriptionAPIView.as_view(), name="course_subscribe"),
+    path(
+        "courses/subscribe/bulk/",
+        BulkSubscriptionAPIView.as_view(),
+        name="course_subscribe_bulk",
+    ),
+    path("search/", SearchAPIView.as_view(), name="search"),
 ]
 
 urlpatterns += router.urls
@@ -1,24 +1,151 @@
-from datetime import timedelta
+from datetime import datetime
+from datetime import timezone as dt_timezone
 
-from django.utils import timezone
-from .tasks import send_course_update_email
-from django.shortcuts import get_object_or_404
-from rest_framework import viewsets
+from django.contrib.postgres.search import SearchHeadline, SearchQuery, SearchRank
+from django.db.models import (
+    Count,
+    Exists,
+    F,
+    FloatField,
+    Max,
+    OuterRef,
+    Prefetch,
+    Value,
+)
+from django.db.models.functions import Cast, Collate, Lower
+from django.db import transaction
+from django.http import Http404
+from rest_framework import generics, status, viewsets
+from rest_framework.decorators import action
+from rest_framework.exceptions import ValidationError
 from rest_framework.response import Response
-from .paginators import CustomPagination
-from .models import Course, Lesson, Subscription
+from .cache import get_subscriptions_changed_at
+from .mixins import (
+    CachedRepresentationMixin,
+    ConditionalGetMixin,
+    SparseFieldsetMixin,
+)
+from .paginators import (
+    CustomPagination,
+    SearchCursorPagination,
+    SelectablePaginationMixin,
+)
+from .models import SEARCH_CONFIG, Course, Lesson, Subscription
+from .services import (
+    COURSE_NOTIFY_FIELDS,
+    LESSON_NOTIFY_FIELDS,
+    bulk_save_lessons,
+    changed_fields,
+    schedule_course_notifications,
+)
 from rest_framework.permissions import IsAuthenticated, AllowAny
-from users.permissions import IsModerator, IsOwner
-from .serializers import CourseSerializer, LessonSerializer
+from users.permissions import IsModerator, IsOwner, is_moderator
+from .serializers import (
+    HIGHLIGHT_START,
+    HIGHLIGHT_STOP,
+    BulkSubscriptionSerializer,
+    CourseSerializer,
+    LessonSerializer,
+    SearchResultSerializer,
+    SubscriptionToggleSerializer,
+)
 from rest_framework.views import APIView
 
 
-class CourseViewSet(viewsets.ModelViewSet):
+class CourseViewSet(
+    ConditionalGetMixin,
+    CachedRepresentationMixin,
+    SparseFieldsetMixin,
+    SelectablePaginationMixin,
+    viewsets.ModelViewSet,
+):
     queryset = Course.objects.all()
     serializer_class = CourseSerializer
 
     pagination_class = CustomPagination
 
+    # Краткое представление для списка, остальное - через ?fields= / ?expand=
+    summary_fields = ("id", "title", "preview", "lesson_count", "is_subscribed")
+
+    fragment_cache_name = "course"
+    per_user_fields = ("is_subscribed",)
+
+    autocomplete_limit = 10
+    autocomplete_max_limit = 50
+
+    def get_queryset(self):
+        """Счетчик уроков и флаг подписки считаются в том же запросе,
+        а уроки подгружаются одним пакетом, чтобы число запросов
+        не зависело от размера страницы. Выбираются только запрошенные поля"""
+        queryset = super().get_queryset().order_by("id")
+
+        only_fields = self.get_only_fields()
+        if only_fields is not None:
+            queryset = queryset.only(*only_fields)
+
+        if self.is_field_requested("lesson_count"):
+            queryset = queryset.annotate(lesson_count=Count("lessons", distinct=True))
+
+        if self.is_field_requested("is_subscribed"):
+            user = self.request.user
+            if user.is_authenticated:
+                is_subscribed = Exists(
+                    Subscription.objects.filter(user_id=user.id, course=OuterRef("pk"))
+                )
+            else:
+                is_subscribed = Value(False)
+            queryset = queryset.annotate(is_subscribed=is_subscribed)
+
+        if self.is_field_requested("lessons"):
+            queryset = queryset.prefetch_related(
+                Prefetch("lessons", queryset=Lesson.objects.order_by("id"))
+            )
+
+        return queryset
+
+    def get_per_user_values(self, pks):
+        user = self.request.user
+        subscribed = set()
+        if user.is_authenticated:
+            subscribed = set(
+                Subscription.objects.filter(
+                    user_id=user.id, course_id__in=pks
+                ).values_list("course_id", flat=True)
+            )
+        return {pk: {"is_subscribed": pk in subscribed} for pk in pks}
+
+    def get_freshness(self):
+        """Свежесть курса - его updated_at (уроки сдвигают его сигналом),
+        для списка - агрегат по всем курсам. Флаг подписки учитывается
+        по времени последнего изменения подписок пользователя"""
+        if self.action == "retrieve":
+            lookup_url_kwarg = self.lookup_url_kwarg or self.lookup_field
+            rows = list(
+                Course.objects.filter(
+                    **{self.lookup_field: self.kwargs[lookup_url_kwarg]}
+                ).values_list("updated_at", flat=True)[:1]
+            )
+            if not rows:
+                return None
+            last_modified = rows[0]
+            token = f"{last_modified}"
+        else:
+            state = self.filter_queryset(Course.objects.all()).aggregate(
+                last_modified=Max("updated_at"), count=Count("id"), max_id=Max("id")
+            )
+            last_modified = state["last_modified"]
+            token = f"{last_modified}:{state['count']}:{state['max_id']}"
+
+        user = self.request.user
+        if self.is_field_requested("is_subscribed") and user.is_authenticated:
+            changed_at = get_subscriptions_changed_at(user.id)
+            token += f":{user.id}:{changed_at}"
+            changed_at = datetime.fromtimestamp(changed_at, tz=dt_timezone.utc)
+            if last_modified is None or changed_at > last_modified:
+                last_modified = changed_at
+
+        return last_modified, token
+
     def get_permissions(self):
         if self.action in ["list", "retrieve"]:  # Просмотр доступен всем авторизованным
             self.permission_classes = [IsAuthenticated]
@@ -45,65 +172,113 @@ class CourseViewSet(viewsets.ModelViewSet):
         return [permission() for permission in self.permission_classes]
 
     def perform_create(self, serializer):
+        # Рассылка не планируется: у нового курса нет подписчиков, а при
+        # удалении курса его подписки и outbox удаляются вместе с ним.
+        # Уведомления - только об изменении курса и его уроков
         serializer.save(owner=self.request.user)
 
+    @action(detail=False, methods=["get"])
+    def autocomplete(self, request, *args, **kwargs):
+        """Подсказки по началу названия курса: ?q=pyt&limit=10.
+        Запрос идет по индексу lms_course_title_prefix и читает
+        ровно limit строк в уже отсортированном порядке"""
+        prefix = request.query_params.get("q", "").strip().lower()
+        try:
+            limit = int(request.query_params.get("limit", self.autocomplete_limit))
+        except ValueError:
+            raise ValidationError({"limit": ["Ожидается число"]})
+        limit = max(1, min(limit, self.autocomplete_max_limit))
+
+        if not prefix:
+            return Response([])
+
+        courses = (
+            Course.objects.annotate(title_key=Collate(Lower("title"), "C"))
+            .filter(title_key__startswith=prefix)
+            .order_by("title_key", "id")
+            .values("id", "title")[:limit]
+        )
+        return Response(list(courses))
+
     def perform_update(self, serializer):
-        # Получаем текущий курс до обновления
-        course = serializer.instance
-
-        # Получаем дату последнего обновления (или None, если не было)
-        last_updated = course.updated_at
-
-        # Сохраняем изменения
-        updated_course = serializer.save()
-
-        # Логика рассылки
-        if last_updated:
-            now = timezone.now()
-            # Проверяем, прошло ли 4 часа
-            if now - last_updated > timedelta(hours=4):
-                send_course_update_email.delay(updated_course.pk)
-                print(f"Курс {updated_course.title} обновлен. Задача на отправку писем создана.")
-            else:
-                print(f"Курс {updated_course.title} обновлен. Письма НЕ отправлены (слишком часто).")
-        else:
-            # Если course.updated_at был None (никогда не обновлялся), можно отправить
-            send_course_update_email.delay(updated_course.pk)
-            print("Первое обновление курса. Задача создана.")
+        """Рассылка ставится с задержкой и только если изменились поля,
+        видимые подписчикам. Правки за окно объединяются в одно письмо"""
+        changed = changed_fields(
+            serializer.instance, serializer.validated_data, COURSE_NOTIFY_FIELDS
+        )
+        with transaction.atomic():
+            course = serializer.save()
+            if changed:
+                schedule_course_notifications([course.pk])
 
 
 class SubscriptionAPIView(APIView):
     permission_classes = [IsAuthenticated]
 
     def post(self, request, *args, **kwargs):
-        user = request.user
         # Получаем id курса из тела запроса
-        course_id = request.data.get("course_id")
+        serializer = SubscriptionToggleSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+
+        # Переключаем подписку атомарно: DELETE ... RETURNING,
+        # а если удалять нечего - INSERT ... ON CONFLICT DO NOTHING
+        try:
+            subscribed = Subscription.objects.toggle(
+                request.user.id, serializer.validated_data["course_id"]
+            )
+        except Course.DoesNotExist:
+            raise Http404
+
+        message = "Подписка добавлена" if subscribed else "Подписка удалена"
+        return Response({"message": message})
 
-        # Получаем объект курса, если нет - 404
-        course_item = get_object_or_404(Course, id=course_id)
 
-        # Ищем объект подписки
-        subs_item = Subscription.objects.filter(user=user, course=course_item)
+class BulkSubscriptionAPIView(APIView):
+    """Подписка или отписка сразу на список курсов одним запросом к БД"""
 
-        # Если подписка есть - удаляем
-        if subs_item.exists():
-            subs_item.delete()
-            message = "Подписка удалена"
-        # Если нет - создаем
+    permission_classes = [IsAuthenticated]
+
+    def post(self, request, *args, **kwargs):
+        serializer = BulkSubscriptionSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+
+        course_ids = serializer.validated_data["course_ids"]
+        if serializer.validated_data["action"] == "subscribe":
+            changed = Subscription.objects.subscribe(request.user.id, course_ids)
         else:
-            Subscription.objects.create(user=user, course=course_item)
-            message = "Подписка добавлена"
+            changed = Subscription.objects.unsubscribe(request.user.id, course_ids)
 
-        return Response({"message": message})
+        return Response(
+            {
+                "action": serializer.validated_data["action"],
+                "course_ids": sorted(changed),
+            }
+        )
 
 
-class LessonViewSet(viewsets.ModelViewSet):
+class LessonViewSet(
+    CachedRepresentationMixin,
+    SparseFieldsetMixin,
+    SelectablePaginationMixin,
+    viewsets.ModelViewSet,
+):
     queryset = Lesson.objects.all()
     serializer_class = LessonSerializer
 
     pagination_class = CustomPagination
 
+    fragment_cache_name = "lesson"
+
+    bulk_max_items = 1000
+
+    def get_queryset(self):
+        queryset = super().get_queryset().order_by("id")
+
+        only_fields = self.get_only_fields()
+        if only_fields is not None:
+            queryset = queryset.only(*only_fields)
+        return queryset
+
     def get_permissions(self):
         if self.action in ["list", "retrieve"]:  # Просмотр
             self.permission_classes = [IsAuthenticated]
@@ -127,4 +302,90 @@ class LessonViewSet(viewsets.ModelViewSet):
         return [permission() for permission in self.permission_classes]
 
     def perform_create(self, serializer):
-        serializer.save(owner=self.request.user)
+        with transaction.atomic():
+            lesson = serializer.save(owner=self.request.user)
+            schedule_course_notifications([lesson.course_id])
+
+    def perform_update(self, serializer):
+        lesson = serializer.instance
+        old_course_id = lesson.course_id
+        changed = changed_fields(
+            lesson, serializer.validated_data, LESSON_NOTIFY_FIELDS
+        )
+        with transaction.atomic():
+            lesson = serializer.save()
+            if changed:
+                schedule_course_notifications([old_course_id, lesson.course_id])
+
+    def perform_destroy(self, instance):
+        with transaction.atomic():
+            course_id = instance.course_id
+            instance.delete()
+            schedule_course_notifications([course_id])
+
+    @action(detail=False, methods=["post"], url_path="bulk")
+    def bulk(self, request, *args, **kwargs):
+        """Массовое создание (без "id") и обновление (с "id") уроков.
+        Ошибки возвращаются по каждому элементу, корректные элементы сохраняются"""
+        if not isinstance(request.data, list) or not request.data:
+            raise ValidationError({"non_field_errors": ["Ожидается непустой список"]})
+        if len(request.data) > self.bulk_max_items:
+            raise ValidationError(
+                {"non_field_errors": [f"Не более {self.bulk_max_items} элементов"]}
+            )
+
+        results = bulk_save_lessons(
+            request.data, request.user.id, is_moderator(request)
+        )
+
+        failed = sum("errors" in result for result in results)
+        if failed == len(results):
+            response_status = status.HTTP_400_BAD_REQUEST
+        elif failed:
+            response_status = status.HTTP_207_MULTI_STATUS
+        else:
+            response_status = status.HTTP_200_OK
+        return Response({"results": results}, status=response_status)
+
+
+class SearchAPIView(generics.ListAPIView):
+    """Полнотекстовый поиск: /lms/search/?q=...&type=courses|lessons.
+    Результаты ранжируются по релевантности (название важнее описания)
+    и содержат подсвеченные фрагменты: HTML-экранированный текст,
+    в котором размечены только совпадения (<mark>)"""
+
+    serializer_class = SearchResultSerializer
+    pagination_class = SearchCursorPagination
+
+    search_models = {"courses": Course, "lessons": Lesson}
+
+    def get_queryset(self):
+        params = self.request.query_params
+        text = params.get("q", "").strip()
+        if not text:
+            raise ValidationError({"q": ["Укажите поисковый запрос"]})
+
+        model = self.search_models.get(params.get("type", "courses"))
+        if model is None:
+            raise ValidationError(
+                {"type": [f"Допустимо: {', '.join(self.search_models)}"]}
+            )
+
+        query = SearchQuery(text, config=SEARCH_CONFIG, search_type="websearch")
+        highlight = {
+            "config": SEARCH_CONFIG,
+            "start_sel": HIGHLIGHT_START,
+            "stop_sel": HIGHLIGHT_STOP,
+        }
+        return (
+            model.objects.filter(search_vector=query)
+            .only("id", "title")
+            .annotate(
+                # float8, чтобы позиция курсора точно совпадала со значением в БД
+                rank=Cast(SearchRank(F("search_vector"), query), FloatField()),
+                title_highlight=SearchHeadline("title", query, **highlight),
+                snippet=SearchHeadline(
+                    "description", query, max_words=35, min_words=15, **highlight
+                ),
+            )
+        )
@@ -0,0 +1,68 @@
+"""Буфер активности пользователей (last_seen) в кэше.
+
+Запись last_seen на каждый запрос превратила бы любой GET в UPDATE.
+Вместо этого активность пишется в кэш не чаще раза в LAST_SEEN_INTERVAL
+на пользователя, а периодическая задача flush_last_seen переносит ее
+в БД пачками.
+
+Кэш не умеет атомарно добавлять в множество, поэтому буфер устроен как
+журнал: номер записи выдает атомарный incr счетчика, сама запись
+(user_id, timestamp) лежит под ключом с этим номером. Задача читает
+журнал от последнего перенесенного номера до текущего значения счетчика.
+"""
+
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+LAST_SEEN_SEQ_KEY = "users:last_seen:seq"
+LAST_SEEN_FLUSHED_KEY = "users:last_seen:flushed"
+LAST_SEEN_LOG_TIMEOUT = 60 * 60 * 24
+
+
+def _throttle_key(user_id):
+    return f"users:last_seen:{user_id}:recent"
+
+
+def _log_key(seq):
+    return f"users:last_seen:log:{seq}"
+
+
+def record_activity(user_id, seen_at=None):
+    """Отмечает активность пользователя. Возвращает False, если активность
+    уже записана в течение LAST_SEEN_INTERVAL"""
+    if not cache.add(_throttle_key(user_id), 1, timeout=settings.LAST_SEEN_INTERVAL):
+        return False
+
+    cache.add(LAST_SEEN_SEQ_KEY, 0, timeout=None)
+    seq = cache.incr(LAST_SEEN_SEQ_KEY)
+    cache.set(
+        _log_key(seq),
+        (user_id, seen_at or time.time()),
+        timeout=LAST_SEEN_LOG_TIMEOUT,
+    )
+    return True
+
+
+def pending_range():
+    """Номера еще не перенесенных в БД записей журнала"""
+    flushed = cache.get(LAST_SEEN_FLUSHED_KEY, 0)
+    last = cache.get(LAST_SEEN_SEQ_KEY, 0)
+    return range(flushed + 1, last + 1)
+
+
+def read_activity(seqs):
+    """Записи журнала с номерами seqs: {user_id: последний timestamp}.
+    Записи, вытесненные из кэша или еще не дописанные, пропускаются -
+    активность пользователя будет записана снова через LAST_SEEN_INTERVAL"""
+    seen = {}
+    for user_id, seen_at in cache.get_many([_log_key(seq) for seq in seqs]).values():
+        seen[user_id] = max(seen_at, seen.get(user_id, 0))
+    return seen
+
+
+def mark_flushed(seqs):
+    """Удаляет перенесенные записи журнала и сдвигает указатель"""
+    cache.delete_many([_log_key(seq) for seq in seqs])
+    cache.set(LAST_SEEN_FLUSHED_KEY, seqs[-1], timeout=None)
@@ -1,5 +1,5 @@
 from django.contrib import admin
-from .models import User, Payment
+from .models import User, Payment, StripePrice
 
 
 @admin.register(User)
@@ -10,5 +10,23 @@ class UserAdmin(admin.ModelAdmin):
 
 @admin.register(Payment)
 class PaymentAdmin(admin.ModelAdmin):
-    list_display = ("user", "payment_date", "amount", "payment_method")
-    list_filter = ("payment_method", "payment_date")
+    list_display = (
+        "user",
+        "payment_date",
+        "amount",
+        "payment_method",
+        "checkout_status",
+        "payment_status",
+    )
+    list_filter = (
+        "payment_method",
+        "payment_date",
+        "checkout_status",
+        "payment_status",
+    )
+
+
+@admin.register(StripePrice)
+class StripePriceAdmin(admin.ModelAdmin):
+    list_display = ("item_key", "amount", "currency", "price_id")
+    search_fields = ("item_key",)
@@ -0,0 +1,58 @@
+from django.utils.functional import cached_property
+from rest_framework.permissions import SAFE_METHODS
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import AuthenticationFailed
+from rest_framework_simplejwt.models import TokenUser
+from rest_framework_simplejwt.settings import api_settings
+
+from .models import User
+
+# Claims, которые UserTokenObtainPairSerializer кладет в токен
+USER_CLAIMS = ("email", "is_active")
+
+
+class ClaimsUser(TokenUser):
+    """Пользователь, собранный из claims access-токена без запроса к БД.
+    Полная модель доступна через instance и загружается только по требованию"""
+
+    @cached_property
+    def id(self):
+        return int(self.token[api_settings.USER_ID_CLAIM])
+
+    @cached_property
+    def email(self):
+        return self.token["email"]
+
+    @cached_property
+    def is_active(self):
+        return self.token["is_active"]
+
+    @cached_property
+    def instance(self):
+        return User.objects.get(pk=self.id)
+
+
+class StatelessJWTAuthentication(JWTAuthentication):
+    """JWT-аутентификация без загрузки User на безопасных (читающих) запросах:
+    пользователь строится из claims токена. Изменяющие запросы и токены
+    без нужных claims (выданные до их появления) получают модель из БД"""
+
+    def authenticate(self, request):
+        header = self.get_header(request)
+        if header is None:
+            return None
+
+        raw_token = self.get_raw_token(header)
+        if raw_token is None:
+            return None
+
+        validated_token = self.get_validated_token(raw_token)
+
+        if request.method in SAFE_METHODS and all(
+            claim in validated_token for claim in USER_CLAIMS
+        ):
+            if not validated_token["is_active"]:
+                raise AuthenticationFailed("User is inactive", code="user_inactive")
+            return ClaimsUser(validated_token), validated_token
+
+        return self.get_user(validated_token), validated_token
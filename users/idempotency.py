@@ -0,0 +1,145 @@
+"""Идемпотентные POST-запросы по заголовку Idempotency-Key.
+
+Клиент, не дождавшийся ответа, повторяет запрос с тем же ключом. Первый
+запрос занимает ключ в кэше (cache.add), а после выполнения сохраняет под
+ним ответ на IDEMPOTENCY_TTL. Повтор, пришедший во время выполнения, ждет
+ответа первого запроса до IDEMPOTENCY_WAIT секунд (ожидание занимает воркер,
+поэтому оно короткое), затем получает 409 с Retry-After и повторяет запрос
+позже; повтор после выполнения сразу получает сохраненный ответ. Ключ действует в пределах пользователя
+и запроса: тот же ключ с другим телом запроса отклоняется.
+"""
+
+import hashlib
+import json
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from rest_framework import status
+from rest_framework.response import Response
+
+IDEMPOTENCY_HEADER = "Idempotency-Key"
+IDEMPOTENCY_KEY_MAX_LENGTH = 255
+IDEMPOTENCY_POLL_INTERVAL = 0.1
+# Через сколько секунд повторить запрос, получивший 409
+IDEMPOTENCY_RETRY_AFTER = 1
+# Заголовки ответа, которые повторяются вместе с ним
+IDEMPOTENCY_REPLAY_HEADERS = ("Location",)
+
+IN_FLIGHT = "in_flight"
+COMPLETED = "completed"
+
+
+def _cache_key(user_id, key):
+    return f"users:idempotency:{user_id}:{key}"
+
+
+def request_fingerprint(method, path, data):
+    """Отпечаток запроса: метод, путь и тело"""
+    body = json.dumps(data, sort_keys=True, default=str)
+    return hashlib.sha256(f"{method} {path} {body}".encode()).hexdigest()
+
+
+def acquire(cache_key, fingerprint):
+    """Занимает ключ на время выполнения запроса. False - ключ уже занят"""
+    return cache.add(
+        cache_key,
+        {"state": IN_FLIGHT, "fingerprint": fingerprint},
+        timeout=settings.IDEMPOTENCY_LOCK_TIMEOUT,
+    )
+
+
+def save_response(cache_key, fingerprint, status_code, data, headers):
+    cache.set(
+        cache_key,
+        {
+            "state": COMPLETED,
+            "fingerprint": fingerprint,
+            "status": status_code,
+            "data": data,
+            "headers": headers,
+        },
+        timeout=settings.IDEMPOTENCY_TTL,
+    )
+
+
+def release(cache_key):
+    """Освобождает ключ запроса, завершившегося ошибкой, чтобы его
+    можно было повторить"""
+    cache.delete(cache_key)
+
+
+def wait_completed(cache_key, timeout):
+    """Ждет до timeout секунд, пока запрос с ключом завершится.
+    Возвращает запись ключа (None - ключ освобожден)"""
+    deadline = time.monotonic() + timeout
+    while True:
+        entry = cache.get(cache_key)
+        remaining = deadline - time.monotonic()
+        if entry is None or entry["state"] == COMPLETED or remaining <= 0:
+            return entry
+        time.sleep(min(IDEMPOTENCY_POLL_INTERVAL, remaining))
+
+
+class IdempotencyMixin:
+    """Делает POST представления идемпотентным по заголовку Idempotency-Key.
+    Ответы с кодом 5xx и исключения не сохраняются: ключ освобождается"""
+
+    def post(self, request, *args, **kwargs):
+        key = request.headers.get(IDEMPOTENCY_HEADER)
+        if not key:
+            return super().post(request, *args, **kwargs)
+        if len(key) > IDEMPOTENCY_KEY_MAX_LENGTH:
+            return Response(
+                data={"error": "Слишком длинный Idempotency-Key."},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
+        cache_key = _cache_key(request.user.pk, key)
+        fingerprint = request_fingerprint(request.method, request.path, request.data)
+
+        while not acquire(cache_key, fingerprint):
+            entry = cache.get(cache_key)
+            if entry and entry["fingerprint"] == fingerprint:
+                # Ждем ответа, только если выполняется тот же самый запрос
+                entry = wait_completed(cache_key, settings.IDEMPOTENCY_WAIT)
+            if entry is None:
+                # Первый запрос завершился ошибкой - выполняем заново
+                continue
+            if entry["fingerprint"] != fingerprint:
+                return Response(
+                    data={
+                        "error": "Idempotency-Key уже использован с другим запросом."
+                    },
+                    status=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                )
+            if entry["state"] != COMPLETED:
+                return Response(
+                    data={"error": "Запрос с этим Idempotency-Key еще выполняется."},
+                    status=status.HTTP_409_CONFLICT,
+                    headers={"Retry-After": str(IDEMPOTENCY_RETRY_AFTER)},
+                )
+            return Response(
+                entry["data"],
+                status=entry["status"],
+                headers={**entry["headers"], "Idempotent-Replayed": "true"},
+            )
+
+        try:
+            response = super().post(request, *args, **kwargs)
+        except Exception:
+            release(cache_key)
+            raise
+
+        if response.status_code >= 500:
+            release(cache_key)
+        else:
+            headers = {
+                name: response[name]
+                for name in IDEMPOTENCY_REPLAY_HEADERS
+                if response.has_header(name)
+            }
+            save_response(
+                cache_key, fingerprint, response.status_code, response.data, headers
+            )
+        return response
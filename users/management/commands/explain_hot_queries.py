@@ -0,0 +1,119 @@
+import json
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.db.models.functions import Collate, Lower
+from django.utils import timezone
+
+from lms.models import Course, Lesson, Subscription
+from users.models import Payment, User
+
+
+def hot_queries():
+    """Запросы горячих путей: имя -> queryset.
+    Параметры берутся из существующих строк, чтобы план был реалистичным"""
+    course_id = Course.objects.values_list("id", flat=True).first() or 0
+    lesson_id = Lesson.objects.values_list("id", flat=True).first() or 0
+    user_id = User.objects.values_list("id", flat=True).first() or 0
+
+    return {
+        "Рассылка подписчикам курса": Subscription.objects.filter(
+            course_id=course_id
+        ).values_list("user__email", flat=True),
+        "Подписка пользователя на курс": Subscription.objects.filter(
+            user_id=user_id, course_id=course_id
+        ),
+        "Уроки курса": Lesson.objects.filter(course_id=course_id).order_by("id"),
+        "Платежи по курсу": Payment.objects.filter(course_id=course_id).order_by(
+            "payment_date"
+        ),
+        "Платежи по уроку": Payment.objects.filter(lesson_id=lesson_id).order_by(
+            "payment_date"
+        ),
+        "Платежи по способу оплаты": Payment.objects.filter(
+            payment_method="cash"
+        ).order_by("payment_date"),
+        "Неактивные пользователи": User.objects.filter(
+            last_seen__lt=timezone.now() - timedelta(days=30),
+            is_active=True,
+            is_staff=False,
+            is_superuser=False,
+        ),
+        "Автодополнение курсов": Course.objects.annotate(
+            title_key=Collate(Lower("title"), "C")
+        )
+        .filter(title_key__startswith="py")
+        .order_by("title_key", "id")
+        .values("id", "title")[:10],
+    }
+
+
+def seq_scans(plan):
+    """Все узлы Seq Scan плана (рекурсивно)"""
+    if plan.get("Node Type") == "Seq Scan":
+        yield plan
+    for child in plan.get("Plans", ()):
+        yield from seq_scans(child)
+
+
+def table_sizes(tables):
+    """Оценка числа строк в таблицах по статистике планировщика
+    (-1 у еще не проанализированных таблиц считается нулем)"""
+    if not tables:
+        return {}
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT relname, GREATEST(reltuples, 0) FROM pg_class WHERE relname = ANY(%s)",
+            [list(tables)],
+        )
+        return dict(cursor.fetchall())
+
+
+class Command(BaseCommand):
+    help = (
+        "Выполняет EXPLAIN для горячих запросов и помечает последовательные "
+        "сканирования таблиц, в которых больше --threshold строк"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--threshold", type=int, default=10_000)
+        parser.add_argument(
+            "--analyze", action="store_true", help="EXPLAIN ANALYZE (выполняет запрос)"
+        )
+        parser.add_argument(
+            "--strict",
+            action="store_true",
+            help="Завершиться с ошибкой, если найдены проблемные запросы",
+        )
+
+    def handle(self, *args, **options):
+        if connection.vendor != "postgresql":
+            raise CommandError("Команда поддерживает только PostgreSQL")
+
+        flagged = []
+        for name, queryset in hot_queries().items():
+            plan = json.loads(
+                queryset.explain(format="json", analyze=options["analyze"])
+            )[0]["Plan"]
+            scans = list(seq_scans(plan))
+            sizes = table_sizes({scan["Relation Name"] for scan in scans})
+            large = [
+                scan["Relation Name"]
+                for scan in scans
+                if sizes.get(scan["Relation Name"], 0) > options["threshold"]
+            ]
+
+            line = f"{name}: {plan['Node Type']}, cost {plan['Total Cost']}"
+            if options["analyze"]:
+                line += f", {plan['Actual Total Time']} мс"
+            if large:
+                flagged.append(name)
+                self.stdout.write(
+                    self.style.WARNING(f"{line} - Seq Scan по {', '.join(large)}")
+                )
+            else:
+                self.stdout.write(self.style.SUCCESS(line))
+
+        if flagged and options["strict"]:
+            raise CommandError(f"Seq Scan в запросах: {', '.join(flagged)}")
@@ -0,0 +1,23 @@
+from django.utils.functional import SimpleLazyObject, empty
+
+from .activity import record_activity
+
+
+class LastSeenMiddleware:
+    """Отмечает активность аутентифицированного пользователя после ответа.
+    Пользователь берется из request.user, который DRF заполняет при
+    JWT-аутентификации. Ленивый пользователь сессии, к которому запрос
+    не обращался, не вычисляется, чтобы не добавлять запросов к БД"""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        response = self.get_response(request)
+
+        user = getattr(request, "user", None)
+        if isinstance(user, SimpleLazyObject) and user._wrapped is empty:
+            return response
+        if user is not None and user.is_authenticated:
+            record_activity(user.id)
+        return response
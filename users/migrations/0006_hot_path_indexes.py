@@ -0,0 +1,73 @@
+# Generated by Django 5.2.9 on 2026-10-18 19:19
+
+import django.db.models.deletion
+from django.contrib.postgres.operations import AddIndexConcurrently
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    # Индексы строятся без блокировки записи в таблицы,
+    # старые индексы внешних ключей удаляются после этого
+    atomic = False
+
+    dependencies = [
+        ("auth", "0012_alter_user_first_name_max_length"),
+        ("lms", "0010_subscription_course_user_index"),
+        ("users", "0005_alter_payment_link"),
+    ]
+
+    operations = [
+        AddIndexConcurrently(
+            model_name="payment",
+            index=models.Index(
+                fields=["course", "payment_date"], name="users_payment_course_date"
+            ),
+        ),
+        AddIndexConcurrently(
+            model_name="payment",
+            index=models.Index(
+                fields=["lesson", "payment_date"], name="users_payment_lesson_date"
+            ),
+        ),
+        AddIndexConcurrently(
+            model_name="payment",
+            index=models.Index(
+                fields=["payment_method", "payment_date"],
+                name="users_payment_method_date",
+            ),
+        ),
+        AddIndexConcurrently(
+            model_name="user",
+            index=models.Index(
+                condition=models.Q(
+                    ("is_active", True), ("is_staff", False), ("is_superuser", False)
+                ),
+                fields=["last_login"],
+                name="users_user_blockable_login",
+            ),
+        ),
+        migrations.AlterField(
+            model_name="payment",
+            name="course",
+            field=models.ForeignKey(
+                blank=True,
+                db_index=False,
+                null=True,
+                on_delete=django.db.models.deletion.CASCADE,
+                to="lms.course",
+                verbose_name="Оплаченный курс",
+            ),
+        ),
+        migrations.AlterField(
+            model_name="payment",
+            name="lesson",
+            field=models.ForeignKey(
+                blank=True,
+                db_index=False,
+                null=True,
+                on_delete=django.db.models.deletion.CASCADE,
+                to="lms.lesson",
+                verbose_name="Оплаченный урок",
+            ),
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 5.2.9 on 2026-10-18 19:33
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("users", "0006_hot_path_indexes"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="user",
+            name="last_digest_at",
+            field=models.DateTimeField(
+                blank=True, null=True, verbose_name="Последняя сводка"
+            ),
+        ),
+        migrations.AddField(
+            model_name="user",
+            name="notification_mode",
+            field=models.CharField(
+                choices=[
+                    ("instant", "Письмо на каждое обновление курса"),
+                    ("digest", "Ежедневная сводка"),
+                ],
+                default="instant",
+                max_length=10,
+                verbose_name="Уведомления об обновлениях",
+            ),
+        ),
+    ]
@@ -0,0 +1,48 @@
+# Generated by Django 5.2.9 on 2026-10-18 19:36
+
+from django.contrib.postgres.operations import (
+    AddIndexConcurrently,
+    RemoveIndexConcurrently,
+)
+from django.db import migrations, models
+
+
+def copy_last_login(apps, schema_editor):
+    """До появления буфера активности единственным источником был last_login"""
+    User = apps.get_model("users", "User")
+    User.objects.filter(last_seen__isnull=True).update(last_seen=models.F("last_login"))
+
+
+class Migration(migrations.Migration):
+    # Индексы строятся и удаляются без блокировки записи в таблицу
+    atomic = False
+
+    dependencies = [
+        ("auth", "0012_alter_user_first_name_max_length"),
+        ("users", "0007_notification_mode"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="user",
+            name="last_seen",
+            field=models.DateTimeField(
+                blank=True, null=True, verbose_name="Последняя активность"
+            ),
+        ),
+        migrations.RunPython(copy_last_login, migrations.RunPython.noop),
+        AddIndexConcurrently(
+            model_name="user",
+            index=models.Index(
+                condition=models.Q(
+                    ("is_active", True), ("is_staff", False), ("is_superuser", False)
+                ),
+                fields=["last_seen"],
+                name="users_user_blockable_seen",
+            ),
+        ),
+        RemoveIndexConcurrently(
+            model_name="user",
+            name="users_user_blockable_login",
+        ),
+    ]
@@ -0,0 +1,64 @@
+# Generated by Django 5.2.9 on 2026-10-18 19:38
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("users", "0008_user_last_seen"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="StripePrice",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "item_key",
+                    models.CharField(
+                        help_text="course:<id> или lesson:<id>",
+                        max_length=50,
+                        verbose_name="Объект оплаты",
+                    ),
+                ),
+                (
+                    "amount",
+                    models.DecimalField(
+                        decimal_places=2, max_digits=10, verbose_name="Сумма"
+                    ),
+                ),
+                ("currency", models.CharField(max_length=3, verbose_name="Валюта")),
+                (
+                    "product_id",
+                    models.CharField(max_length=255, verbose_name="ID продукта Stripe"),
+                ),
+                (
+                    "price_id",
+                    models.CharField(max_length=255, verbose_name="ID цены Stripe"),
+                ),
+                (
+                    "created_at",
+                    models.DateTimeField(auto_now_add=True, verbose_name="Создана"),
+                ),
+            ],
+            options={
+                "verbose_name": "Цена Stripe",
+                "verbose_name_plural": "Цены Stripe",
+                "constraints": [
+                    models.UniqueConstraint(
+                        fields=("item_key", "amount", "currency"),
+                        name="users_stripe_price_item",
+                    )
+                ],
+            },
+        ),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 5.2.9 on 2026-10-18 19:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("users", "0009_stripe_price"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="payment",
+            name="checkout_status",
+            field=models.CharField(
+                choices=[
+                    ("pending", "Сессия оплаты создается"),
+                    ("ready", "Ссылка на оплату готова"),
+                    ("failed", "Не удалось создать сессию оплаты"),
+                ],
+                default="ready",
+                max_length=20,
+                verbose_name="Статус сессии оплаты",
+            ),
+        ),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 5.2.9 on 2026-10-18 19:43
+
+from django.contrib.postgres.operations import AddIndexConcurrently
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    # Индекс по session_id строится без блокировки записи в таблицу платежей
+    atomic = False
+
+    dependencies = [
+        ("users", "0010_payment_checkout_status"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="payment",
+            name="payment_status",
+            field=models.CharField(
+                blank=True,
+                max_length=30,
+                null=True,
+                verbose_name="Статус оплаты Stripe",
+            ),
+        ),
+        migrations.AddField(
+            model_name="payment",
+            name="status_updated_at",
+            field=models.DateTimeField(
+                blank=True, null=True, verbose_name="Время статуса оплаты"
+            ),
+        ),
+        AddIndexConcurrently(
+            model_name="payment",
+            index=models.Index(fields=["session_id"], name="users_payment_session"),
+        ),
+    ]
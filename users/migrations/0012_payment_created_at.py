@@ -0,0 +1,31 @@
+# Generated by Django 5.2.9 on 2026-10-18 20:05
+
+from django.contrib.postgres.operations import AddIndexConcurrently
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    # Индекс строится без блокировки записи в таблицу платежей
+    atomic = False
+
+    dependencies = [
+        ("users", "0011_payment_status"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="payment",
+            name="created_at",
+            field=models.DateTimeField(
+                auto_now_add=True, null=True, verbose_name="Время создания"
+            ),
+        ),
+        AddIndexConcurrently(
+            model_name="payment",
+            index=models.Index(
+                condition=models.Q(("checkout_status", "pending")),
+                fields=["created_at"],
+                name="users_payment_checkout_pending",
+            ),
+        ),
+    ]
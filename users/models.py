@@ -53,6 +53,27 @@ class User(AbstractUser):
         help_text="Загрузите аватар",
     )
 
+    NOTIFY_INSTANT = "instant"
+    NOTIFY_DIGEST = "digest"
+    NOTIFICATION_MODE_CHOICES = [
+        (NOTIFY_INSTANT, "Письмо на каждое обновление курса"),
+        (NOTIFY_DIGEST, "Ежедневная сводка"),
+    ]
+
+    notification_mode = models.CharField(
+        max_length=10,
+        choices=NOTIFICATION_MODE_CHOICES,
+        default=NOTIFY_INSTANT,
+        verbose_name="Уведомления об обновлениях",
+    )
+    last_digest_at = models.DateTimeField(
+        blank=True, null=True, verbose_name="Последняя сводка"
+    )
+    # Обновляется из буфера активности (users/activity.py) задачей flush_last_seen
+    last_seen = models.DateTimeField(
+        blank=True, null=True, verbose_name="Последняя активность"
+    )
+
     USERNAME_FIELD = "email"
     REQUIRED_FIELDS = []
 
@@ -61,11 +82,29 @@ class User(AbstractUser):
     class Meta:
         verbose_name = "Пользователь"
         verbose_name_plural = "Пользователи"
+        indexes = [
+            # Частичный индекс для block_inactive_users: в него попадают
+            # только пользователи, которых задача вообще может заблокировать
+            models.Index(
+                fields=["last_seen"],
+                name="users_user_blockable_seen",
+                condition=models.Q(is_active=True, is_staff=False, is_superuser=False),
+            ),
+        ]
 
 
 class Payment(models.Model):
     PAYMENT_METHOD_CHOICES = [("cash", "Наличные"), ("transfer", "Перевод на счет")]
 
+    CHECKOUT_PENDING = "pending"
+    CHECKOUT_READY = "ready"
+    CHECKOUT_FAILED = "failed"
+    CHECKOUT_STATUS_CHOICES = [
+        (CHECKOUT_PENDING, "Сессия оплаты создается"),
+        (CHECKOUT_READY, "Ссылка на оплату готова"),
+        (CHECKOUT_FAILED, "Не удалось создать сессию оплаты"),
+    ]
+
     user = models.ForeignKey(
         User,
         on_delete=models.CASCADE,
@@ -79,6 +118,7 @@ class Payment(models.Model):
         verbose_name="Оплаченный курс",
         blank=True,
         null=True,
+        db_index=False,
     )
     lesson = models.ForeignKey(
         Lesson,
@@ -86,6 +126,7 @@ class Payment(models.Model):
         verbose_name="Оплаченный урок",
         blank=True,
         null=True,
+        db_index=False,
     )
     amount = models.DecimalField(
         max_digits=10, decimal_places=2, verbose_name="Сумма оплаты"
@@ -99,6 +140,22 @@ class Payment(models.Model):
     link = models.URLField(
         max_length=1012, verbose_name="Ссылка на оплату", blank=True, null=True
     )
+    checkout_status = models.CharField(
+        max_length=20,
+        choices=CHECKOUT_STATUS_CHOICES,
+        default=CHECKOUT_READY,
+        verbose_name="Статус сессии оплаты",
+    )
+    created_at = models.DateTimeField(
+        auto_now_add=True, verbose_name="Время создания", null=True
+    )
+    # Статус оплаты из webhook Stripe (или из запроса к Stripe, если он устарел)
+    payment_status = models.CharField(
+        max_length=30, verbose_name="Статус оплаты Stripe", blank=True, null=True
+    )
+    status_updated_at = models.DateTimeField(
+        verbose_name="Время статуса оплаты", blank=True, null=True
+    )
 
     def __str__(self):
         return f"{self.user} - {self.amount}"
@@ -106,3 +163,55 @@ class Payment(models.Model):
     class Meta:
         verbose_name = "Платеж"
         verbose_name_plural = "Платежи"
+        # Фильтры списка платежей + сортировка по дате. Индексы по course и
+        # lesson заменяют одноколоночные индексы внешних ключей
+        indexes = [
+            models.Index(
+                fields=["course", "payment_date"], name="users_payment_course_date"
+            ),
+            models.Index(
+                fields=["lesson", "payment_date"], name="users_payment_lesson_date"
+            ),
+            models.Index(
+                fields=["payment_method", "payment_date"],
+                name="users_payment_method_date",
+            ),
+            # Поиск платежа по сессии Stripe в webhook
+            models.Index(fields=["session_id"], name="users_payment_session"),
+            # Платежи, сессия оплаты которых создается слишком долго
+            models.Index(
+                fields=["created_at"],
+                name="users_payment_checkout_pending",
+                condition=models.Q(checkout_status="pending"),
+            ),
+        ]
+
+
+class StripePrice(models.Model):
+    """Продукт и цена Stripe для оплачиваемого объекта и суммы.
+    Повторные оплаты того же курса/урока на ту же сумму используют
+    сохраненную цену и создают в Stripe только сессию оплаты"""
+
+    item_key = models.CharField(
+        max_length=50,
+        verbose_name="Объект оплаты",
+        help_text="course:<id> или lesson:<id>",
+    )
+    amount = models.DecimalField(max_digits=10, decimal_places=2, verbose_name="Сумма")
+    currency = models.CharField(max_length=3, verbose_name="Валюта")
+    product_id = models.CharField(max_length=255, verbose_name="ID продукта Stripe")
+    price_id = models.CharField(max_length=255, verbose_name="ID цены Stripe")
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name="Создана")
+
+    def __str__(self):
+        return f"{self.item_key} - {self.amount} {self.currency}"
+
+    class Meta:
+        verbose_name = "Цена Stripe"
+        verbose_name_plural = "Цены Stripe"
+        constraints = [
+            models.UniqueConstraint(
+                fields=["item_key", "amount", "currency"],
+                name="users_stripe_price_item",
+            ),
+        ]
@@ -3,6 +3,30 @@ from rest_framework import permissions
 
 MODERATOR_GROUP_NAME = "Moderators"
 
+# Claim JWT-токена, в котором при выдаче токена сохраняется роль модератора
+MODERATOR_CLAIM = "is_moderator"
+
+
+def is_moderator(request):
+    """Проверяет роль модератора один раз за запрос.
+    Роль берется из claim токена, а если его нет - одним запросом к БД"""
+    cached = getattr(request, "_is_moderator", None)
+    if cached is not None:
+        return cached
+
+    token = getattr(request, "auth", None)
+    claim = token.get(MODERATOR_CLAIM) if hasattr(token, "get") else None
+
+    if claim is not None:
+        cached = bool(claim)
+    elif not request.user or not request.user.is_authenticated:
+        cached = False
+    else:
+        cached = request.user.groups.filter(name=MODERATOR_GROUP_NAME).exists()
+
+    request._is_moderator = cached
+    return cached
+
 
 class IsOwnerOrReadOnly(permissions.BasePermission):
     """Разрешает доступ к объекту, если:
@@ -20,14 +44,15 @@ class IsOwner(permissions.BasePermission):
     """разрешает доступ только владельцу объекта"""
 
     def has_object_permission(self, request, view, obj):
-        return obj.owner == request.user
+        # Сравниваем id, чтобы не загружать объект владельца из БД
+        return obj.owner_id is not None and obj.owner_id == request.user.id
 
 
 class IsModerator(permissions.BasePermission):
     """Разрешает доступ только пользователям из группы Moderators"""
 
     def has_permission(self, request, view):
-        return request.user.groups.filter(name=MODERATOR_GROUP_NAME).exists()
+        return is_moderator(request)
 
     def has_object_permission(self, request, view, obj):
-        return request.user.groups.filter(name=MODERATOR_GROUP_NAME).exists()
+        return is_moderator(request)
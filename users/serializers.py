@@ -1,7 +1,14 @@
 from rest_framework import serializers
 from rest_framework.fields import CurrentUserDefault
+from rest_framework_simplejwt.serializers import (
+    TokenObtainPairSerializer,
+    TokenRefreshSerializer,
+)
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.tokens import AccessToken
 
 from .models import User, Payment
+from .permissions import MODERATOR_CLAIM, MODERATOR_GROUP_NAME
 
 
 class PaymentSerializer(serializers.ModelSerializer):
@@ -20,7 +27,9 @@ class PaymentSerializer(serializers.ModelSerializer):
             "payment_method",
             "session_id",
             "link",
+            "checkout_status",
         )
+        read_only_fields = ("session_id", "link", "checkout_status")
 
 
 class UserProfileSerializer(serializers.ModelSerializer):
@@ -36,6 +45,7 @@ class UserProfileSerializer(serializers.ModelSerializer):
             "phone",
             "city",
             "avatar",
+            "notification_mode",
             "payments",
         )
         read_only_fields = ("email",)  # Запрещаем менять email через профиль
@@ -63,3 +73,38 @@ class UserRegisterSerializer(serializers.ModelSerializer):
             avatar=validated_data.get("avatar"),
         )
         return user
+
+
+def add_user_claims(access, user):
+    """Кладет в access-токен роль модератора и данные пользователя из БД,
+    чтобы проверка прав и stateless-аутентификация не обращались к БД"""
+    access["email"] = user.email
+    access["is_active"] = user.is_active
+    access[MODERATOR_CLAIM] = user.groups.filter(name=MODERATOR_GROUP_NAME).exists()
+    return access
+
+
+class UserTokenObtainPairSerializer(TokenObtainPairSerializer):
+    """Выдает access-токен с данными пользователя (add_user_claims).
+    В refresh-токен они не попадают: simplejwt копирует claims refresh-токена
+    в каждый новый access-токен, и снятая роль модератора жила бы до конца
+    срока refresh-токена"""
+
+    def validate(self, attrs):
+        data = super().validate(attrs)
+        access = AccessToken(data["access"])
+        data["access"] = str(add_user_claims(access, self.user))
+        return data
+
+
+class UserTokenRefreshSerializer(TokenRefreshSerializer):
+    """Пересчитывает данные пользователя в новом access-токене по БД"""
+
+    def validate(self, attrs):
+        data = super().validate(attrs)
+        access = AccessToken(data["access"])
+        user = User.objects.get(
+            **{api_settings.USER_ID_FIELD: access[api_settings.USER_ID_CLAIM]}
+        )
+        data["access"] = str(add_user_claims(access, user))
+        return data
@@ -1,37 +1,185 @@
-import stripe
+import time
+from datetime import timedelta
+from email.utils import parsedate_to_datetime
+
 from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Q
+from django.utils import timezone
+
+from config.metrics import incr
+from .models import Payment, StripePrice
+from .stripe_client import stripe_request
 
+STRIPE_CURRENCY = "rub"
 
-stripe.api_key = settings.STRIPE_API_KEY
+CHECKOUT_STATUS_TIMEOUT = 60 * 10
+CHECKOUT_POLL_INTERVAL = 0.1
+
+# Статусы оплаты, которые уже не изменятся
+FINAL_PAYMENT_STATUSES = ("paid", "no_payment_required")
 
 
 def create_stripe_product(name):
     """Создает продукт в Stripe"""
-    product = stripe.Product.create(name=name)
+    product = stripe_request(
+        "create_stripe_product",
+        lambda client: client.v1.products.create(params={"name": name}),
+    )
     return product.get("id")
 
 
-def create_stripe_price(product_id, amount):
+def create_stripe_price(product_id, amount, currency=STRIPE_CURRENCY):
     """Создает цену в Stripe"""
-    price = stripe.Price.create(
-        product=product_id,
-        currency="rub",
-        unit_amount=int(amount * 100),  # Цена в копейках
+    params = {
+        "product": product_id,
+        "currency": currency,
+        "unit_amount": int(amount * 100),  # Цена в копейках
+    }
+    price = stripe_request(
+        "create_stripe_price", lambda client: client.v1.prices.create(params=params)
     )
     return price.get("id")
 
 
+def get_stripe_price_id(course, lesson, amount, currency=STRIPE_CURRENCY):
+    """ID цены Stripe для оплаты курса или урока на сумму amount.
+    Цена создается в Stripe один раз и сохраняется в StripePrice;
+    продукт переиспользуется для всех сумм одного курса/урока"""
+    if course:
+        item_key, product_name = f"course:{course.pk}", course.title
+    elif lesson:
+        item_key, product_name = f"lesson:{lesson.pk}", lesson.title
+    else:
+        item_key, product_name = "other", "Oplata"
+
+    prices = StripePrice.objects.filter(item_key=item_key)
+    price_id = (
+        prices.filter(amount=amount, currency=currency)
+        .values_list("price_id", flat=True)
+        .first()
+    )
+    if price_id:
+        return price_id
+
+    product_id = prices.values_list("product_id", flat=True).first()
+    if not product_id:
+        product_id = create_stripe_product(product_name)
+    price_id = create_stripe_price(product_id, amount, currency)
+
+    # При параллельной первой оплате сохранится цена, созданная первой
+    stripe_price, _ = StripePrice.objects.get_or_create(
+        item_key=item_key,
+        amount=amount,
+        currency=currency,
+        defaults={"product_id": product_id, "price_id": price_id},
+    )
+    return stripe_price.price_id
+
+
 def create_stripe_session(price_id):
     """Создает сессию оплаты в Stripe"""
-    session = stripe.checkout.Session.create(
-        success_url="http://127.0.0.1:8000/",  # Куда вернуть юзера после оплаты
-        line_items=[{"price": price_id, "quantity": 1}],
-        mode="payment",
+    params = {
+        "success_url": "http://127.0.0.1:8000/",  # Куда вернуть юзера после оплаты
+        "line_items": [{"price": price_id, "quantity": 1}],
+        "mode": "payment",
+    }
+    session = stripe_request(
+        "create_stripe_session",
+        lambda client: client.v1.checkout.sessions.create(params=params),
     )
     return session.get("id"), session.get("url")
 
 
 def check_payment_status(session_id):
     """Проверяет статус сессии в Stripe"""
-    session = stripe.checkout.Session.retrieve(session_id)
+    session = stripe_request(
+        "check_payment_status",
+        lambda client: client.v1.checkout.sessions.retrieve(session_id),
+    )
     return session.get("payment_status")
+
+
+def list_stripe_sessions(**params):
+    """Страница сессий оплаты Stripe (Session.list)"""
+    return stripe_request(
+        "list_stripe_sessions",
+        lambda client: client.v1.checkout.sessions.list(params=params),
+    )
+
+
+def stripe_response_time(stripe_object):
+    """Время ответа Stripe (заголовок Date) - по часам Stripe, как и
+    created событий webhook. Если заголовка нет, берется текущее время"""
+    response = getattr(stripe_object, "last_response", None)
+    date = response.headers.get("Date") if response else None
+    if not date:
+        return timezone.now()
+    return parsedate_to_datetime(date)
+
+
+def record_payment_status(session_id, payment_status, updated_at):
+    """Сохраняет статус оплаты сессии Stripe. Повторная доставка события
+    ничего не меняет, а событие старше уже записанного статуса
+    (доставленное не по порядку) не перезаписывает его"""
+    return (
+        Payment.objects.filter(session_id=session_id)
+        .filter(
+            Q(status_updated_at__isnull=True) | Q(status_updated_at__lte=updated_at)
+        )
+        .update(payment_status=payment_status, status_updated_at=updated_at)
+    )
+
+
+def get_payment_status(payment):
+    """Статус оплаты из БД. В Stripe запрос уходит, только если статус
+    еще не пришел webhook'ом или не окончателен и старше PAYMENT_STATUS_TTL"""
+    if payment.payment_status in FINAL_PAYMENT_STATUSES:
+        return payment.payment_status
+    now = timezone.now()
+    ttl = timedelta(seconds=settings.PAYMENT_STATUS_TTL)
+    if payment.status_updated_at and now - payment.status_updated_at < ttl:
+        return payment.payment_status
+
+    incr("payments.status.stripe_fallback")
+    payment_status = check_payment_status(payment.session_id)
+    record_payment_status(payment.session_id, payment_status, now)
+    return payment_status
+
+
+def _checkout_status_key(payment_id):
+    return f"users:payment:{payment_id}:checkout"
+
+
+def publish_checkout_status(payment_id, checkout_status):
+    """Сообщает ожидающим запросам (?wait=), что сессия оплаты создана
+    или создать ее не удалось"""
+    cache.set(
+        _checkout_status_key(payment_id),
+        checkout_status,
+        timeout=CHECKOUT_STATUS_TIMEOUT,
+    )
+
+
+def fail_checkouts(payment_ids):
+    """Помечает failed платежи, сессию оплаты которых создать не удалось.
+    Платежи, которые уже не pending, не меняются"""
+    payment_ids = list(payment_ids)
+    failed = Payment.objects.filter(
+        pk__in=payment_ids, checkout_status=Payment.CHECKOUT_PENDING
+    ).update(checkout_status=Payment.CHECKOUT_FAILED)
+    for payment_id in payment_ids:
+        publish_checkout_status(payment_id, Payment.CHECKOUT_FAILED)
+    return failed
+
+
+def wait_checkout_status(payment_id, timeout):
+    """Ждет до timeout секунд, пока задача опубликует статус сессии оплаты.
+    Опрашивается только кэш; None - статус за это время не появился"""
+    deadline = time.monotonic() + timeout
+    while True:
+        checkout_status = cache.get(_checkout_status_key(payment_id))
+        remaining = deadline - time.monotonic()
+        if checkout_status is not None or remaining <= 0:
+            return checkout_status
+        time.sleep(min(CHECKOUT_POLL_INTERVAL, remaining))
@@ -0,0 +1,139 @@
+"""Клиент Stripe с пулом HTTP-соединений и предохранителем.
+
+Глобальный клиент библиотеки stripe открывает соединение без явных
+таймаутов (до 80 секунд на ответ) и не дает управлять повторами, поэтому
+медленный Stripe мог надолго занять воркер. Здесь у каждого процесса свой
+StripeClient поверх requests.Session: соединения (TCP + TLS) переиспользуются,
+таймауты подключения и чтения задаются в настройках, а сетевые сбои
+повторяются самой библиотекой stripe с экспоненциальной паузой и jitter.
+
+Предохранитель (circuit breaker) после STRIPE_BREAKER_THRESHOLD сбоев подряд
+отклоняет вызовы без запроса к Stripe на STRIPE_BREAKER_RESET секунд, затем
+пропускает один пробный запрос.
+"""
+
+import os
+import threading
+import time
+
+import requests
+import stripe
+from django.conf import settings
+from django.core.signals import setting_changed
+from requests.adapters import HTTPAdapter
+
+from config.metrics import incr, timing
+
+# Сбои, по которым Stripe считается недоступным: сеть, таймауты и ответы 5xx.
+# Ответы 4xx означают, что Stripe работает, и предохранитель не размыкают
+BREAKER_ERRORS = (stripe.APIConnectionError, stripe.APIError)
+
+
+class CircuitOpenError(stripe.APIConnectionError):
+    """Предохранитель разомкнут: вызов отклонен без запроса к Stripe.
+    Наследуется от APIConnectionError, чтобы обрабатываться как сетевой сбой"""
+
+
+class CircuitBreaker:
+    """Предохранитель для вызовов одного внешнего сервиса в процессе"""
+
+    def __init__(self, threshold, reset_timeout):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._lock = threading.Lock()
+
+    def before_call(self):
+        with self._lock:
+            if self.opened_at is None:
+                return
+            if time.monotonic() - self.opened_at < self.reset_timeout:
+                raise CircuitOpenError("Stripe временно недоступен")
+            # Пробный запрос; остальные отклоняются, пока он не завершится
+            self.opened_at = time.monotonic()
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.failures >= self.threshold:
+                self.opened_at = time.monotonic()
+
+
+_state = {}
+_state_lock = threading.Lock()
+
+# Соединения нельзя делить между процессами: после fork (prefork-воркеры
+# Celery, gunicorn) дочерний процесс создает свой клиент
+os.register_at_fork(after_in_child=_state.clear)
+
+
+def _build_client():
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=settings.STRIPE_POOL_SIZE)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    http_client = stripe.RequestsClient(
+        timeout=(settings.STRIPE_CONNECT_TIMEOUT, settings.STRIPE_READ_TIMEOUT),
+        session=session,
+    )
+    return stripe.StripeClient(
+        settings.STRIPE_API_KEY or "",
+        base_addresses={"api": settings.STRIPE_API_BASE},
+        max_network_retries=settings.STRIPE_MAX_NETWORK_RETRIES,
+        http_client=http_client,
+    )
+
+
+def _get_state():
+    with _state_lock:
+        if not _state:
+            _state["client"] = _build_client()
+            _state["breaker"] = CircuitBreaker(
+                settings.STRIPE_BREAKER_THRESHOLD, settings.STRIPE_BREAKER_RESET
+            )
+        return _state["client"], _state["breaker"]
+
+
+def reset():
+    """Сбрасывает клиент и предохранитель процесса"""
+    with _state_lock:
+        _state.clear()
+
+
+def _reset_on_setting_changed(setting, **kwargs):
+    if setting.startswith("STRIPE_"):
+        reset()
+
+
+setting_changed.connect(_reset_on_setting_changed)
+
+
+def stripe_request(operation, make_call):
+    """Выполняет make_call(client) через клиент процесса. Длительность
+    пишется в метрику stripe.<operation>.duration_ms, сбои - в
+    stripe.<operation>.errors"""
+    client, breaker = _get_state()
+    breaker.before_call()
+
+    started = time.monotonic()
+    try:
+        result = make_call(client)
+    except BREAKER_ERRORS:
+        breaker.record_failure()
+        incr(f"stripe.{operation}.errors")
+        raise
+    except stripe.StripeError:
+        breaker.record_success()
+        incr(f"stripe.{operation}.errors")
+        raise
+    finally:
+        timing(f"stripe.{operation}.duration_ms", (time.monotonic() - started) * 1000)
+
+    breaker.record_success()
+    return result
@@ -1,26 +1,284 @@
+import time
+
+import stripe
 from celery import shared_task
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Case, CharField, Max, Min, Q, Value, When
 from django.utils import timezone
-from datetime import timedelta
-from .models import User
+from datetime import datetime, timedelta
+from datetime import timezone as dt_timezone
+
+from config.metrics import gauge, incr, timing
+from .activity import mark_flushed, pending_range, read_activity
+from .models import Payment, User
+from .services import (
+    FINAL_PAYMENT_STATUSES,
+    create_stripe_session,
+    fail_checkouts,
+    get_stripe_price_id,
+    list_stripe_sessions,
+    publish_checkout_status,
+    stripe_response_time,
+)
+
+BLOCK_INACTIVE_CHECKPOINT_KEY = "users:block_inactive:checkpoint"
+BLOCK_INACTIVE_CHECKPOINT_TIMEOUT = 60 * 60 * 24
+PAYMENT_RECONCILE_CURSOR_KEY = "users:payment_reconcile:cursor"
+PAYMENT_RECONCILE_CURSOR_TIMEOUT = 60 * 60 * 24
 
 
 @shared_task
 def block_inactive_users():
-    """ Блокирует пользователей, которые не заходили больше месяца """
-    # Вычисляем дату
-    one_month_ago = timezone.now() - timedelta(days=30)
-    # Находим активных пользователей, у которых last_login старее месяца
-    inactive_users = User.objects.filter(
-        last_login__lt=one_month_ago,
-        is_active=True,
-        is_staff=False,
-        is_superuser=False
-    )
+    """Блокирует пользователей, которые не проявляли активности больше месяца
+    (last_seen, см. flush_last_seen).
+    UPDATE выполняется диапазонами id по BLOCK_INACTIVE_BATCH_SIZE строк,
+    каждый в своей короткой транзакции, с паузой между диапазонами, чтобы
+    не держать блокировки строк и не мешать входу пользователей.
+    После каждого диапазона в кэш пишется контрольная точка: если воркер
+    упал, следующий запуск продолжит с нее с той же датой отсечения"""
+    started = time.monotonic()
+    batch_size = settings.BLOCK_INACTIVE_BATCH_SIZE
+
+    bounds = User.objects.aggregate(min_id=Min("id"), max_id=Max("id"))
+    max_id = bounds["max_id"] or 0
 
-    count = inactive_users.count()
+    checkpoint = cache.get(BLOCK_INACTIVE_CHECKPOINT_KEY)
+    if checkpoint:
+        one_month_ago = datetime.fromisoformat(checkpoint["cutoff"])
+        last_id = checkpoint["last_id"]
+    else:
+        # Вычисляем дату
+        one_month_ago = timezone.now() - timedelta(days=30)
+        last_id = (bounds["min_id"] or 1) - 1
+
+    count = 0
+    while last_id < max_id:
+        upper = last_id + batch_size
+        # Число заблокированных возвращает сам UPDATE, без отдельного count()
+        count += User.objects.filter(
+            pk__gt=last_id,
+            pk__lte=upper,
+            last_seen__lt=one_month_ago,
+            is_active=True,
+            is_staff=False,
+            is_superuser=False,
+        ).update(is_active=False)
+        last_id = upper
+
+        cache.set(
+            BLOCK_INACTIVE_CHECKPOINT_KEY,
+            {"cutoff": one_month_ago.isoformat(), "last_id": last_id},
+            timeout=BLOCK_INACTIVE_CHECKPOINT_TIMEOUT,
+        )
+        if last_id < max_id and settings.BLOCK_INACTIVE_SLEEP:
+            time.sleep(settings.BLOCK_INACTIVE_SLEEP)
+
+    cache.delete(BLOCK_INACTIVE_CHECKPOINT_KEY)
+
+    timing("users.block_inactive.duration_ms", (time.monotonic() - started) * 1000)
+    incr("users.block_inactive.blocked", count)
     if count > 0:
-        # Массовое обновление (быстрее, чем цикл)
-        inactive_users.update(is_active=False)
         print(f"Заблокировано {count} пользователей за неактивность.")
     else:
         print("Неактивных пользователей для блокировки не найдено.")
+    return count
+
+
+@shared_task
+def flush_last_seen():
+    """Переносит активность пользователей из буфера в кэше в User.last_seen:
+    один bulk_update на LAST_SEEN_FLUSH_BATCH записей журнала"""
+    started = time.monotonic()
+    batch_size = settings.LAST_SEEN_FLUSH_BATCH
+    seqs = pending_range()
+
+    updated = 0
+    for start in range(0, len(seqs), batch_size):
+        batch = seqs[start : start + batch_size]
+        seen = read_activity(batch)
+        if seen:
+            User.objects.bulk_update(
+                [
+                    User(
+                        pk=user_id,
+                        last_seen=datetime.fromtimestamp(ts, tz=dt_timezone.utc),
+                    )
+                    for user_id, ts in seen.items()
+                ],
+                fields=["last_seen"],
+            )
+            updated += len(seen)
+        mark_flushed(batch)
+
+    timing("users.last_seen.flush_ms", (time.monotonic() - started) * 1000)
+    gauge("users.last_seen.flushed", updated)
+    return updated
+
+
+# Сбои Stripe, после которых запрос имеет смысл повторить
+STRIPE_RETRY_ERRORS = (
+    stripe.APIConnectionError,
+    stripe.RateLimitError,
+    stripe.APIError,
+)
+
+
+@shared_task(
+    bind=True,
+    max_retries=settings.PAYMENT_CHECKOUT_MAX_RETRIES,
+    default_retry_delay=settings.PAYMENT_CHECKOUT_RETRY_DELAY,
+)
+def create_checkout_session(self, payment_id):
+    """Создает сессию оплаты Stripe для платежа, принятого с ответом 202,
+    и сохраняет session_id и ссылку. Временные сбои Stripe повторяются
+    с растущей паузой, после последней попытки платеж помечается failed"""
+    payment = (
+        Payment.objects.select_related("course", "lesson")
+        .filter(pk=payment_id, checkout_status=Payment.CHECKOUT_PENDING)
+        .first()
+    )
+    if payment is None:
+        return None
+
+    started = time.monotonic()
+    try:
+        price_id = get_stripe_price_id(payment.course, payment.lesson, payment.amount)
+        session_id, link = create_stripe_session(price_id)
+    except STRIPE_RETRY_ERRORS as exc:
+        if self.request.retries < self.max_retries:
+            raise self.retry(
+                exc=exc, countdown=self.default_retry_delay * 2**self.request.retries
+            )
+        checkout_status, session_id, link = Payment.CHECKOUT_FAILED, None, None
+    except stripe.StripeError:
+        checkout_status, session_id, link = Payment.CHECKOUT_FAILED, None, None
+    except Exception:
+        # Непредвиденная ошибка (БД, ошибка в коде): платеж не должен
+        # навсегда остаться pending
+        fail_checkouts([payment_id])
+        raise
+    else:
+        checkout_status = Payment.CHECKOUT_READY
+
+    Payment.objects.filter(pk=payment_id).update(
+        checkout_status=checkout_status, session_id=session_id, link=link
+    )
+    publish_checkout_status(payment_id, checkout_status)
+
+    timing("payments.checkout.duration_ms", (time.monotonic() - started) * 1000)
+    incr(f"payments.checkout.{checkout_status}")
+    return checkout_status
+
+
+@shared_task
+def expire_pending_checkouts():
+    """Помечает failed платежи, сессия оплаты которых не создана за
+    PAYMENT_CHECKOUT_TIMEOUT: задача create_checkout_session потеряна
+    (брокер недоступен, воркер упал). Без этого клиент ждал бы ссылку вечно"""
+    cutoff = timezone.now() - timedelta(seconds=settings.PAYMENT_CHECKOUT_TIMEOUT)
+    payment_ids = list(
+        Payment.objects.filter(
+            checkout_status=Payment.CHECKOUT_PENDING, created_at__lt=cutoff
+        ).values_list("id", flat=True)
+    )
+    expired = fail_checkouts(payment_ids) if payment_ids else 0
+    incr("payments.checkout.expired", expired)
+    return expired
+
+
+def _reconcile_page(pending, sessions, updated_at):
+    """Сохраняет статусы сессий одной страницы Stripe одним UPDATE.
+    Условия проверяются в самом UPDATE: окончательный статус и статус,
+    записанный позже updated_at (webhook, пришедший во время сверки),
+    не перезаписываются. Возвращает число платежей, статус которых изменился"""
+    statuses = {session.id: session.get("payment_status") for session in sessions}
+    changed = {
+        payment_id: session_id
+        for payment_id, session_id, payment_status in pending.filter(
+            session_id__in=statuses
+        ).values_list("id", "session_id", "payment_status")
+        if payment_status != statuses[session_id]
+    }
+    if not changed:
+        return 0
+    return (
+        pending.filter(pk__in=changed)
+        .filter(
+            Q(status_updated_at__isnull=True) | Q(status_updated_at__lte=updated_at)
+        )
+        .update(
+            payment_status=Case(
+                *(
+                    When(session_id=session_id, then=Value(statuses[session_id]))
+                    for session_id in set(changed.values())
+                ),
+                output_field=CharField(),
+            ),
+            status_updated_at=updated_at,
+        )
+    )
+
+
+@shared_task
+def reconcile_payments():
+    """Сверяет со Stripe статусы платежей, для которых не дошел webhook.
+    Сессии читаются страницами Session.list (а не по одной), статусы
+    страницы сохраняются одним UPDATE. Запросы к Stripe идут не чаще
+    PAYMENT_RECONCILE_RATE в секунду. После каждой страницы курсор пишется
+    в кэш: запуск, упавший или дошедший до PAYMENT_RECONCILE_MAX_PAGES,
+    следующий продолжит с него"""
+    started = time.monotonic()
+    since = timezone.localdate() - timedelta(days=settings.PAYMENT_RECONCILE_DAYS)
+    pending = Payment.objects.filter(
+        session_id__isnull=False, payment_date__gte=since
+    ).exclude(payment_status__in=FINAL_PAYMENT_STATUSES)
+
+    cursor = cache.get(PAYMENT_RECONCILE_CURSOR_KEY)
+    if cursor is None:
+        first_date = pending.aggregate(first=Min("payment_date"))["first"]
+        if first_date is None:
+            return 0
+        # Сессии создаются не раньше дня платежа (с запасом на часовой пояс)
+        created_gte = datetime.combine(
+            first_date - timedelta(days=1), datetime.min.time(), tzinfo=dt_timezone.utc
+        )
+        cursor = {"created_gte": int(created_gte.timestamp()), "starting_after": None}
+
+    interval = 1 / settings.PAYMENT_RECONCILE_RATE
+    next_request = 0
+    reconciled = pages = 0
+    has_more = True
+    while has_more and pages < settings.PAYMENT_RECONCILE_MAX_PAGES:
+        # Ограничение частоты запросов к Stripe
+        delay = next_request - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        next_request = time.monotonic() + interval
+
+        params = {
+            "limit": settings.PAYMENT_RECONCILE_PAGE_SIZE,
+            "created": {"gte": cursor["created_gte"]},
+        }
+        if cursor["starting_after"]:
+            params["starting_after"] = cursor["starting_after"]
+        page = list_stripe_sessions(**params)
+        pages += 1
+
+        reconciled += _reconcile_page(pending, page.data, stripe_response_time(page))
+        has_more = page.has_more
+        if page.data:
+            cursor["starting_after"] = page.data[-1].id
+        cache.set(
+            PAYMENT_RECONCILE_CURSOR_KEY,
+            cursor,
+            timeout=PAYMENT_RECONCILE_CURSOR_TIMEOUT,
+        )
+
+    if not has_more:
+        cache.delete(PAYMENT_RECONCILE_CURSOR_KEY)
+
+    timing("payments.reconcile.duration_ms", (time.monotonic() - started) * 1000)
+    gauge("payments.reconcile.pages", pages)
+    incr("payments.reconciled", reconciled)
+    return reconciled
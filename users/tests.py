@@ -1,7 +1,53 @@
-from rest_framework.test import APITestCase
+import hashlib
+import hmac
+import json
+import threading
+import time
+from datetime import timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import StringIO
+from unittest import mock
+from urllib.parse import parse_qs
+
+import stripe
+
+from rest_framework.test import APIRequestFactory, APITestCase
 from rest_framework import status
+from rest_framework.request import Request
+from rest_framework_simplejwt.tokens import AccessToken, RefreshToken
+from django.contrib.auth.models import Group
+from django.core.cache import cache
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import connection
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
-from users.models import User, Payment
+from django.utils import timezone
+from config.metrics import get_metric
+from users.authentication import ClaimsUser, StatelessJWTAuthentication
+from users.management.commands.explain_hot_queries import hot_queries, seq_scans
+from config.celery import app as celery_app
+from users.models import User, Payment, StripePrice
+from users.activity import pending_range, record_activity
+from users.services import (
+    create_stripe_product,
+    create_stripe_session,
+    publish_checkout_status,
+    wait_checkout_status,
+)
+from users.stripe_client import CircuitOpenError
+from users import idempotency
+from users.tasks import (
+    BLOCK_INACTIVE_CHECKPOINT_KEY,
+    PAYMENT_RECONCILE_CURSOR_KEY,
+    block_inactive_users,
+    create_checkout_session,
+    expire_pending_checkouts,
+    flush_last_seen,
+    reconcile_payments,
+)
+from users.permissions import MODERATOR_GROUP_NAME, IsModerator, IsOwner
 from lms.models import Course, Lesson  # Нужны для создания Payments
 
 
@@ -101,6 +147,118 @@ class UserAuthTestCase(APITestCase):
         self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
 
 
+class PermissionQueriesTestCase(APITestCase):
+    """Проверка прав не обращается к БД повторно"""
+
+    def setUp(self):
+        self.moderator = User.objects.create(email="mod@user.com")
+        self.moderator.set_password("moder123")
+        self.moderator.save()
+        group, _ = Group.objects.get_or_create(name=MODERATOR_GROUP_NAME)
+        self.moderator.groups.add(group)
+
+        self.course = Course.objects.create(title="Owned", owner=self.moderator)
+
+    def make_request(self, auth=None):
+        request = Request(APIRequestFactory().patch("/"))
+        request.user = self.moderator
+        request.auth = auth
+        return request
+
+    def test_token_contains_moderator_claim(self):
+        """Токен, выданный модератору, содержит claim is_moderator"""
+        response = self.client.post(
+            reverse("users:token"), {"email": "mod@user.com", "password": "moder123"}
+        )
+        self.assertTrue(AccessToken(response.data["access"])["is_moderator"])
+
+    def test_demoted_moderator_loses_role_on_refresh(self):
+        """Роль не хранится в refresh-токене: после снятия роли обновленный
+        access-токен не дает прав модератора"""
+        other = User.objects.create(email="owner@user.com")
+        course = Course.objects.create(title="Чужой курс", owner=other)
+        tokens = self.client.post(
+            reverse("users:token"), {"email": "mod@user.com", "password": "moder123"}
+        ).data
+        self.assertNotIn("is_moderator", RefreshToken(tokens["refresh"]))
+
+        self.moderator.groups.clear()
+        response = self.client.post(
+            reverse("users:token_refresh"), {"refresh": tokens["refresh"]}
+        )
+        access = response.data["access"]
+        self.assertFalse(AccessToken(access)["is_moderator"])
+
+        response = self.client.patch(
+            reverse("lms:course-detail", args=[course.pk]),
+            {"title": "Изменено"},
+            HTTP_AUTHORIZATION=f"Bearer {access}",
+        )
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+    def test_permissions_from_claim_without_queries(self):
+        """Роль из claim токена и владелец по owner_id - ноль запросов"""
+        course = Course.objects.get(pk=self.course.pk)
+        request = self.make_request(auth=AccessToken.for_user(self.moderator))
+        request.auth["is_moderator"] = True
+
+        with self.assertNumQueries(0):
+            self.assertTrue(IsModerator().has_permission(request, None))
+            self.assertTrue(IsModerator().has_object_permission(request, None, course))
+            self.assertTrue(IsOwner().has_object_permission(request, None, course))
+
+    def test_role_resolved_once_per_request(self):
+        """Без claim роль вычисляется одним запросом на весь запрос"""
+        request = self.make_request()
+
+        with self.assertNumQueries(1):
+            self.assertTrue(IsModerator().has_permission(request, None))
+            self.assertTrue(IsModerator().has_object_permission(request, None, None))
+            self.assertTrue((IsModerator | IsOwner)().has_permission(request, None))
+
+
+class StatelessJWTAuthenticationTestCase(APITestCase):
+    """Stateless JWT: пользователь из claims токена без запроса к БД"""
+
+    def setUp(self):
+        self.user = User.objects.create(email="stateless@user.com")
+        self.user.set_password("stateless123")
+        self.user.save()
+        response = self.client.post(
+            reverse("users:token"),
+            {"email": "stateless@user.com", "password": "stateless123"},
+        )
+        self.access = response.data["access"]
+
+    def authenticate(self, method, token):
+        request = getattr(APIRequestFactory(), method)(
+            "/", HTTP_AUTHORIZATION=f"Bearer {token}"
+        )
+        return StatelessJWTAuthentication().authenticate(Request(request))
+
+    def test_safe_request_without_queries(self):
+        """GET аутентифицируется по claims без обращения к БД"""
+        with self.assertNumQueries(0):
+            user, _ = self.authenticate("get", self.access)
+        self.assertIsInstance(user, ClaimsUser)
+        self.assertEqual(user.id, self.user.id)
+        self.assertEqual(user.email, "stateless@user.com")
+
+        # Полная модель загружается только по требованию
+        with self.assertNumQueries(1):
+            self.assertEqual(user.instance, self.user)
+
+    def test_unsafe_request_loads_user(self):
+        """Изменяющий запрос получает модель User из БД"""
+        user, _ = self.authenticate("post", self.access)
+        self.assertIsInstance(user, User)
+
+    def test_token_without_claims_loads_user(self):
+        """Токены без claims пользователя обрабатываются как раньше"""
+        user, _ = self.authenticate("get", AccessToken.for_user(self.user))
+        self.assertIsInstance(user, User)
+
+
 class PaymentTestCase(APITestCase):
     """Тесты для эндпоинта списка платежей (ListAPIView)"""
 
@@ -134,3 +292,869 @@ class PaymentTestCase(APITestCase):
 
         # Проверяем длину списка
         self.assertEqual(len(response.data), 1)
+
+    def test_payment_list_cursor_pagination(self):
+        """?pagination=cursor включает курсорную пагинацию списка платежей"""
+        self.client.force_authenticate(user=self.user)
+        for amount in range(6):
+            Payment.objects.create(
+                user=self.user, course=self.course, amount=amount, payment_method="cash"
+            )
+
+        response = self.client.get(self.payments_url, {"pagination": "cursor"})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data["results"]), 5)
+
+        response = self.client.get(response.data["next"])
+        self.assertEqual(len(response.data["results"]), 2)
+        self.assertIsNone(response.data["next"])
+
+    def test_payment_cursor_ignores_ordering(self):
+        """В курсорном режиме ?ordering= не меняет ключ курсора: страницы
+        идут по id без пропусков и повторов, даже при вставке между ними"""
+        self.client.force_authenticate(user=self.user)
+        for amount in range(6):
+            Payment.objects.create(
+                user=self.user, course=self.course, amount=amount, payment_method="cash"
+            )
+        expected = list(Payment.objects.order_by("id").values_list("id", flat=True))
+        # Даты совпадают у нескольких платежей и убывают с ростом id
+        for index, pk in enumerate(expected):
+            Payment.objects.filter(pk=pk).update(
+                payment_date=timezone.localdate() - timedelta(days=index // 3)
+            )
+
+        seen, url = [], self.payments_url
+        params = {"pagination": "cursor", "ordering": "payment_date", "page_size": 2}
+        while url:
+            response = self.client.get(url, params)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            params = None
+            seen += [item["id"] for item in response.data["results"]]
+            url = response.data["next"]
+            if len(seen) == 2:
+                Payment.objects.create(
+                    user=self.user, course=self.course, amount=1, payment_method="cash"
+                )
+
+        self.assertEqual(seen[: len(expected)], expected)
+        self.assertEqual(len(seen), len(expected) + 1)
+
+
+class ExplainHotQueriesTestCase(APITestCase):
+    """Команда explain_hot_queries"""
+
+    def test_reports_every_query(self):
+        """Для каждого горячего запроса выводится план"""
+        out = StringIO()
+        call_command("explain_hot_queries", stdout=out)
+        for name in hot_queries():
+            self.assertIn(name, out.getvalue())
+
+    def test_strict_fails_on_seq_scan(self):
+        """--strict с нулевым порогом падает: маленькие таблицы читаются целиком"""
+        with self.assertRaises(CommandError):
+            call_command(
+                "explain_hot_queries", "--threshold=-1", "--strict", stdout=StringIO()
+            )
+
+    def test_seq_scans_walks_nested_plans(self):
+        """Seq Scan находится на любом уровне плана"""
+        plan = {
+            "Node Type": "Nested Loop",
+            "Plans": [
+                {"Node Type": "Index Scan", "Relation Name": "lms_course"},
+                {"Node Type": "Seq Scan", "Relation Name": "users_user"},
+            ],
+        }
+        self.assertEqual(
+            [scan["Relation Name"] for scan in seq_scans(plan)], ["users_user"]
+        )
+
+
+@override_settings(BLOCK_INACTIVE_BATCH_SIZE=2, BLOCK_INACTIVE_SLEEP=0)
+class BlockInactiveUsersTestCase(APITestCase):
+    """Блокировка неактивных пользователей диапазонами id"""
+
+    def setUp(self):
+        cache.clear()
+        old = timezone.now() - timedelta(days=60)
+        recent = timezone.now() - timedelta(days=1)
+        self.stale = [
+            User.objects.create(email=f"stale{i}@test.com", last_seen=old)
+            for i in range(5)
+        ]
+        self.recent = User.objects.create(
+            email="recent@test.com", last_login=old, last_seen=recent
+        )
+        self.staff = User.objects.create(
+            email="staff@test.com", last_seen=old, is_staff=True
+        )
+
+    def test_blocks_in_chunks(self):
+        """Блокируются только устаревшие обычные пользователи, UPDATE по диапазонам"""
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(block_inactive_users(), 5)
+
+        updates = [q for q in queries if q["sql"].startswith("UPDATE")]
+        self.assertEqual(len(updates), 4)  # 7 пользователей по 2 id
+        self.assertFalse(any("COUNT(" in q["sql"] for q in queries))
+
+        self.assertEqual(User.objects.filter(is_active=False).count(), 5)
+        self.assertTrue(User.objects.get(pk=self.recent.pk).is_active)
+        self.assertTrue(User.objects.get(pk=self.staff.pk).is_active)
+        self.assertIsNone(cache.get(BLOCK_INACTIVE_CHECKPOINT_KEY))
+        self.assertIsNotNone(get_metric("users.block_inactive.duration_ms"))
+
+    def test_resumes_from_checkpoint(self):
+        """После падения воркера продолжает с контрольной точки"""
+        cutoff = timezone.now() - timedelta(days=30)
+        cache.set(
+            BLOCK_INACTIVE_CHECKPOINT_KEY,
+            {"cutoff": cutoff.isoformat(), "last_id": self.stale[2].pk},
+        )
+
+        self.assertEqual(block_inactive_users(), 2)
+        self.assertEqual(
+            set(User.objects.filter(is_active=False).values_list("id", flat=True)),
+            {self.stale[3].pk, self.stale[4].pk},
+        )
+
+
+@override_settings(LAST_SEEN_INTERVAL=600, LAST_SEEN_FLUSH_BATCH=2)
+class LastSeenTestCase(APITestCase):
+    """Буфер активности пользователей и перенос last_seen в БД"""
+
+    def setUp(self):
+        cache.clear()
+        self.users = [User.objects.create(email=f"seen{i}@test.com") for i in range(3)]
+        self.url = reverse("lms:course-list")
+
+    def get_with_token(self, user):
+        token = AccessToken.for_user(user)
+        return self.client.get(self.url, HTTP_AUTHORIZATION=f"Bearer {token}")
+
+    def test_middleware_records_once_per_interval(self):
+        """Повторные запросы в пределах интервала не пишут активность"""
+        self.get_with_token(self.users[0])
+        self.get_with_token(self.users[0])
+        self.get_with_token(self.users[1])
+        self.assertEqual(len(pending_range()), 2)
+
+        # Запрос не пишет в БД: last_seen появляется только после переноса
+        self.assertIsNone(User.objects.get(pk=self.users[0].pk).last_seen)
+
+    def test_anonymous_not_recorded(self):
+        self.client.get(self.url)
+        self.assertEqual(len(pending_range()), 0)
+
+    def test_flush_bulk_updates_in_batches(self):
+        """Один bulk_update на пачку журнала, журнал очищается"""
+        for user in self.users:
+            record_activity(user.id)
+
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(flush_last_seen(), 3)
+        updates = [q for q in queries if q["sql"].startswith("UPDATE")]
+        self.assertEqual(len(updates), 2)
+
+        self.assertFalse(User.objects.filter(last_seen__isnull=True).exists())
+        self.assertEqual(len(pending_range()), 0)
+        self.assertEqual(flush_last_seen(), 0)
+
+    def test_flushed_activity_prevents_blocking(self):
+        """block_inactive_users смотрит на last_seen"""
+        old = timezone.now() - timedelta(days=60)
+        User.objects.filter(pk__in=[user.pk for user in self.users]).update(
+            last_login=old, last_seen=old
+        )
+        record_activity(self.users[0].id)
+        flush_last_seen()
+
+        with override_settings(BLOCK_INACTIVE_SLEEP=0):
+            self.assertEqual(block_inactive_users(), 2)
+        self.assertTrue(User.objects.get(pk=self.users[0].pk).is_active)
+
+
+class MockStripeHandler(BaseHTTPRequestHandler):
+    """Минимальный Stripe API: продукты, цены и сессии оплаты"""
+
+    # keep-alive: одно соединение обслуживает несколько запросов
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        super().setup()
+        self.server.connections += 1
+
+    def log_message(self, *args):
+        pass
+
+    def date_time_string(self, timestamp=None):
+        """Заголовок Date по часам mock Stripe (server.clock, если задан)"""
+        return super().date_time_string(self.server.clock or timestamp)
+
+    def reply(self, data, code=200):
+        body = json.dumps(data).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        server = self.server
+        length = int(self.headers.get("Content-Length", 0))
+        form = parse_qs(self.rfile.read(length).decode())
+        server.requests.append(("POST", self.path))
+        time.sleep(server.delay)
+        number = len(server.requests)
+
+        if self.path == "/v1/products":
+            return self.reply({"id": f"prod_{number}", "object": "product"})
+        if self.path == "/v1/prices":
+            return self.reply(
+                {
+                    "id": f"price_{number}",
+                    "object": "price",
+                    "product": form["product"][0],
+                    "unit_amount": int(form["unit_amount"][0]),
+                }
+            )
+        if self.path == "/v1/checkout/sessions":
+            if server.session_errors:
+                code = server.session_errors.pop(0)
+                return self.reply({"error": {"message": "Stripe error"}}, code=code)
+            session = {
+                "id": f"cs_test_{number}",
+                "object": "checkout.session",
+                "url": f"https://checkout.stripe.test/{number}",
+                "payment_status": "unpaid",
+            }
+            server.sessions[session["id"]] = session
+            return self.reply(session)
+        self.reply({"error": {"message": "Not found"}}, code=404)
+
+    def do_GET(self):
+        self.server.requests.append(("GET", self.path))
+        path, _, query = self.path.partition("?")
+        if path == "/v1/checkout/sessions":
+            return self.list_sessions(parse_qs(query))
+        session_id = path.rsplit("/", 1)[-1]
+        if session_id in self.server.sessions:
+            return self.reply(self.server.sessions[session_id])
+        self.reply({"error": {"message": "No such session"}}, code=404)
+
+    def list_sessions(self, params):
+        """Сессии от новых к старым, постранично через starting_after"""
+        sessions = list(reversed(self.server.sessions.values()))
+        if "starting_after" in params:
+            ids = [session["id"] for session in sessions]
+            sessions = sessions[ids.index(params["starting_after"][0]) + 1 :]
+        limit = int(params.get("limit", ["10"])[0])
+        self.reply(
+            {
+                "object": "list",
+                "url": "/v1/checkout/sessions",
+                "data": sessions[:limit],
+                "has_more": len(sessions) > limit,
+            }
+        )
+
+
+class MockStripeServerMixin:
+    """Поднимает локальный mock Stripe API и направляет на него клиент stripe"""
+
+    def setUp(self):
+        super().setUp()
+        self.stripe_server = ThreadingHTTPServer(("127.0.0.1", 0), MockStripeHandler)
+        self.stripe_server.requests = []
+        self.stripe_server.sessions = {}
+        self.stripe_server.session_errors = []
+        self.stripe_server.connections = 0
+        self.stripe_server.delay = 0
+        self.stripe_server.clock = None
+        # Клиент, не дождавшийся ответа (таймаут), закрывает соединение
+        self.stripe_server.handle_error = lambda request, client_address: None
+        thread = threading.Thread(target=self.stripe_server.serve_forever, daemon=True)
+        thread.start()
+        self.addCleanup(self.stripe_server.server_close)
+        self.addCleanup(self.stripe_server.shutdown)
+
+        # Клиент Stripe процесса пересоздается при изменении настроек STRIPE_*
+        host, port = self.stripe_server.server_address
+        stripe_settings = override_settings(
+            STRIPE_API_BASE=f"http://{host}:{port}",
+            STRIPE_API_KEY="sk_test_mock",
+            STRIPE_MAX_NETWORK_RETRIES=0,
+        )
+        stripe_settings.enable()
+        self.addCleanup(stripe_settings.disable)
+
+    def stripe_requests(self, path):
+        return [p for _, p in self.stripe_server.requests if p == path]
+
+
+class StripePriceCacheTestCase(MockStripeServerMixin, APITestCase):
+    """Продукт и цена Stripe создаются один раз на курс/урок и сумму"""
+
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create(email="buyer@test.com")
+        self.course = Course.objects.create(title="Stripe Course")
+        self.url = reverse("users:payment-create")
+        self.client.force_authenticate(user=self.user)
+
+    def pay(self, amount, **item):
+        item = item or {"course": self.course.pk}
+        response = self.client.post(
+            self.url, {"amount": amount, "payment_method": "transfer", **item}
+        )
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        return response
+
+    def test_repeat_purchase_creates_only_session(self):
+        """Повторная оплата той же суммы - только сессия оплаты"""
+        first = self.pay(1500)
+        second = self.pay(1500)
+
+        self.assertEqual(len(self.stripe_requests("/v1/products")), 1)
+        self.assertEqual(len(self.stripe_requests("/v1/prices")), 1)
+        self.assertEqual(len(self.stripe_requests("/v1/checkout/sessions")), 2)
+        self.assertNotEqual(first.data["session_id"], second.data["session_id"])
+        self.assertTrue(second.data["link"].startswith("https://checkout.stripe.test/"))
+
+    def test_new_amount_reuses_product(self):
+        """Новая сумма - новая цена для того же продукта"""
+        self.pay(1500)
+        self.pay(2000)
+
+        self.assertEqual(len(self.stripe_requests("/v1/products")), 1)
+        self.assertEqual(len(self.stripe_requests("/v1/prices")), 2)
+        self.assertEqual(
+            set(StripePrice.objects.values_list("product_id", flat=True)), {"prod_1"}
+        )
+
+    def test_lesson_has_own_product(self):
+        lesson = Lesson.objects.create(
+            title="Stripe Lesson", course=self.course, video_url="https://youtube.com/1"
+        )
+        self.pay(1500)
+        self.pay(1500, lesson=lesson.pk)
+
+        self.assertEqual(len(self.stripe_requests("/v1/products")), 2)
+        self.assertEqual(
+            set(StripePrice.objects.values_list("item_key", flat=True)),
+            {f"course:{self.course.pk}", f"lesson:{lesson.pk}"},
+        )
+
+
+class AsyncCheckoutTestCase(MockStripeServerMixin, APITestCase):
+    """Платеж принимается с ответом 202, сессию Stripe создает задача"""
+
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        celery_app.conf.task_always_eager = True
+        self.addCleanup(setattr, celery_app.conf, "task_always_eager", False)
+        self.user = User.objects.create(email="async@test.com")
+        self.course = Course.objects.create(title="Async Course")
+        self.client.force_authenticate(user=self.user)
+
+    def pending_payment(self):
+        return Payment.objects.create(
+            user=self.user,
+            course=self.course,
+            amount=1500,
+            payment_method="transfer",
+            checkout_status=Payment.CHECKOUT_PENDING,
+        )
+
+    def detail(self, payment, **params):
+        url = reverse("users:payment-detail", args=(payment.pk,))
+        return self.client.get(url, params)
+
+    def test_create_returns_202_without_stripe_calls(self):
+        data = {"course": self.course.pk, "amount": 1500, "payment_method": "transfer"}
+        url = reverse("users:payment-create")
+        with self.captureOnCommitCallbacks() as callbacks:
+            response = self.client.post(url, data, HTTP_PREFER="respond-async")
+
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        self.assertEqual(response.data["checkout_status"], Payment.CHECKOUT_PENDING)
+        self.assertIsNone(response.data["link"])
+        self.assertEqual(
+            response["Location"],
+            reverse("users:payment-detail", args=(response.data["id"],)),
+        )
+        self.assertEqual(self.stripe_server.requests, [])
+
+        for callback in callbacks:
+            callback()
+        payment = Payment.objects.get(pk=response.data["id"])
+        self.assertEqual(payment.checkout_status, Payment.CHECKOUT_READY)
+        self.assertTrue(payment.link.startswith("https://checkout.stripe.test/"))
+        self.assertEqual(self.detail(payment).data["link"], payment.link)
+
+    @override_settings(PAYMENT_CHECKOUT_ASYNC=True)
+    def test_async_mode_from_settings(self):
+        data = {"course": self.course.pk, "amount": 1500, "payment_method": "transfer"}
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(reverse("users:payment-create"), data)
+
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        self.assertEqual(len(self.stripe_requests("/v1/checkout/sessions")), 1)
+
+    def test_transient_error_retried(self):
+        """Сбой Stripe 5xx повторяется, после последнего повтора - failed"""
+        self.stripe_server.session_errors = [500]
+        payment = self.pending_payment()
+        self.assertEqual(create_checkout_session.delay(payment.pk).get(), "ready")
+
+        self.stripe_server.session_errors = [500] * 10
+        payment = self.pending_payment()
+        create_checkout_session.delay(payment.pk)
+        payment.refresh_from_db()
+        self.assertEqual(payment.checkout_status, Payment.CHECKOUT_FAILED)
+        self.assertIsNone(payment.link)
+        self.assertEqual(len(self.stripe_server.session_errors), 6)
+
+    def test_invalid_request_not_retried(self):
+        self.stripe_server.session_errors = [400, 400]
+        payment = self.pending_payment()
+        create_checkout_session.delay(payment.pk)
+
+        payment.refresh_from_db()
+        self.assertEqual(payment.checkout_status, Payment.CHECKOUT_FAILED)
+        self.assertEqual(self.stripe_server.session_errors, [400])
+
+    def test_unexpected_error_fails_payment(self):
+        payment = self.pending_payment()
+        with mock.patch(
+            "users.tasks.get_stripe_price_id", side_effect=RuntimeError("bug")
+        ):
+            with self.assertRaises(RuntimeError):
+                create_checkout_session(payment.pk)
+
+        payment.refresh_from_db()
+        self.assertEqual(payment.checkout_status, Payment.CHECKOUT_FAILED)
+        self.assertEqual(wait_checkout_status(payment.pk, 0), Payment.CHECKOUT_FAILED)
+
+    def test_enqueue_failure_fails_payment(self):
+        """Брокер недоступен - платеж помечается failed, ответ остается 202"""
+        data = {"course": self.course.pk, "amount": 1500, "payment_method": "transfer"}
+        with mock.patch.object(
+            create_checkout_session, "delay", side_effect=ConnectionError
+        ):
+            with self.assertLogs("users.views", "ERROR"):
+                with self.captureOnCommitCallbacks(execute=True):
+                    response = self.client.post(
+                        reverse("users:payment-create"),
+                        data,
+                        HTTP_PREFER="respond-async",
+                    )
+
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        payment = Payment.objects.get(pk=response.data["id"])
+        self.assertEqual(payment.checkout_status, Payment.CHECKOUT_FAILED)
+
+    def test_stale_pending_expired(self):
+        stale, fresh = self.pending_payment(), self.pending_payment()
+        Payment.objects.filter(pk=stale.pk).update(
+            created_at=timezone.now() - timedelta(hours=1)
+        )
+
+        self.assertEqual(expire_pending_checkouts(), 1)
+        self.assertEqual(
+            dict(Payment.objects.values_list("id", "checkout_status")),
+            {stale.pk: Payment.CHECKOUT_FAILED, fresh.pk: Payment.CHECKOUT_PENDING},
+        )
+
+    def test_wait_returns_link_when_ready(self):
+        payment = self.pending_payment()
+
+        def finish(payment_id, timeout):
+            create_checkout_session(payment_id)
+            return Payment.CHECKOUT_READY
+
+        with mock.patch("users.views.wait_checkout_status", side_effect=finish):
+            response = self.detail(payment, wait=5)
+
+        self.assertEqual(response.data["checkout_status"], Payment.CHECKOUT_READY)
+        self.assertTrue(response.data["link"])
+
+    @override_settings(PAYMENT_CHECKOUT_MAX_WAIT=0.2)
+    def test_wait_is_bounded(self):
+        payment = self.pending_payment()
+        started = time.monotonic()
+        response = self.detail(payment, wait=30)
+
+        self.assertLess(time.monotonic() - started, 1)
+        self.assertEqual(response.data["checkout_status"], Payment.CHECKOUT_PENDING)
+        self.assertEqual(self.detail(payment, wait="soon").status_code, 400)
+
+    def test_wait_checkout_status_wakes_on_publish(self):
+        timer = threading.Timer(0.1, publish_checkout_status, args=(42, "ready"))
+        timer.start()
+        self.addCleanup(timer.cancel)
+        started = time.monotonic()
+
+        self.assertEqual(wait_checkout_status(42, 5), "ready")
+        self.assertLess(time.monotonic() - started, 1)
+        self.assertIsNone(wait_checkout_status(43, 0.05))
+
+
+class FakeStripeEventSender:
+    """Отправляет в webhook события, подписанные так же, как это делает Stripe"""
+
+    def __init__(self, client, secret):
+        self.client = client
+        self.secret = secret
+        self.url = reverse("users:payment-webhook")
+        self.sent = 0
+
+    def send(self, event_type, session, created=None, secret=None):
+        self.sent += 1
+        payload = json.dumps(
+            {
+                "id": f"evt_{self.sent}",
+                "object": "event",
+                "type": event_type,
+                "created": created or int(time.time()),
+                "data": {"object": {"object": "checkout.session", **session}},
+            }
+        )
+        timestamp = int(time.time())
+        signature = hmac.new(
+            (secret or self.secret).encode(),
+            f"{timestamp}.{payload}".encode(),
+            hashlib.sha256,
+        ).hexdigest()
+        return self.client.post(
+            self.url,
+            payload,
+            content_type="application/json",
+            HTTP_STRIPE_SIGNATURE=f"t={timestamp},v1={signature}",
+        )
+
+
+@override_settings(STRIPE_WEBHOOK_SECRET="whsec_test")
+class StripeWebhookTestCase(MockStripeServerMixin, APITestCase):
+    """Статус оплаты приходит webhook'ом, а не запросом к Stripe на каждый GET"""
+
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create(email="webhook@test.com")
+        self.payment = Payment.objects.create(
+            user=self.user, amount=1500, payment_method="transfer", session_id="cs_1"
+        )
+        self.sender = FakeStripeEventSender(self.client, "whsec_test")
+        self.client.force_authenticate(user=self.user)
+
+    def get_status(self):
+        url = reverse("users:payment-status", args=(self.payment.pk,))
+        return self.client.get(url).data["status"]
+
+    def test_status_served_from_webhook(self):
+        response = self.sender.send(
+            "checkout.session.completed", {"id": "cs_1", "payment_status": "paid"}
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        self.assertEqual(self.get_status(), "paid")
+        self.assertEqual(self.get_status(), "paid")
+        self.assertEqual(self.stripe_server.requests, [])
+
+    def test_invalid_signature_rejected(self):
+        response = self.sender.send(
+            "checkout.session.completed",
+            {"id": "cs_1", "payment_status": "paid"},
+            secret="whsec_other",
+        )
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        with override_settings(STRIPE_WEBHOOK_SECRET=None):
+            response = self.sender.send(
+                "checkout.session.completed", {"id": "cs_1", "payment_status": "paid"}
+            )
+        self.assertEqual(response.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+        self.payment.refresh_from_db()
+        self.assertIsNone(self.payment.payment_status)
+
+    def test_repeated_and_out_of_order_events(self):
+        """Повтор события ничего не меняет, старое событие не перезаписывает новое"""
+        now = int(time.time())
+        paid = {"id": "cs_1", "payment_status": "paid"}
+        self.sender.send("checkout.session.completed", paid, created=now)
+        self.sender.send("checkout.session.completed", paid, created=now)
+        response = self.sender.send(
+            "checkout.session.async_payment_failed",
+            {"id": "cs_1", "payment_status": "unpaid"},
+            created=now - 60,
+        )
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.payment.refresh_from_db()
+        self.assertEqual(self.payment.payment_status, "paid")
+        self.assertEqual(int(self.payment.status_updated_at.timestamp()), now)
+
+    def test_stale_status_falls_back_to_stripe(self):
+        self.stripe_server.sessions["cs_1"] = {
+            "id": "cs_1",
+            "object": "checkout.session",
+            "payment_status": "unpaid",
+        }
+        session_path = "/v1/checkout/sessions/cs_1"
+
+        self.assertEqual(self.get_status(), "unpaid")
+        self.assertEqual(self.get_status(), "unpaid")
+        self.assertEqual(len(self.stripe_requests(session_path)), 1)
+
+        Payment.objects.filter(pk=self.payment.pk).update(
+            status_updated_at=timezone.now() - timedelta(minutes=5)
+        )
+        self.get_status()
+        self.assertEqual(len(self.stripe_requests(session_path)), 2)
+
+
+@override_settings(PAYMENT_RECONCILE_PAGE_SIZE=2, PAYMENT_RECONCILE_RATE=1000)
+class ReconcilePaymentsTestCase(MockStripeServerMixin, APITestCase):
+    """Сверка статусов платежей со Stripe страницами Session.list"""
+
+    def setUp(self):
+        super().setUp()
+        cache.delete(PAYMENT_RECONCILE_CURSOR_KEY)
+        self.user = User.objects.create(email="reconcile@test.com")
+        statuses = ["paid", "unpaid", "paid", "unpaid", "paid", "paid"]
+        for number, payment_status in enumerate(statuses, start=1):
+            session_id = f"cs_{number}"
+            self.stripe_server.sessions[session_id] = {
+                "id": session_id,
+                "object": "checkout.session",
+                "payment_status": payment_status,
+            }
+            # Последняя сессия - платеж не из LMS
+            if number < len(statuses):
+                Payment.objects.create(
+                    user=self.user,
+                    amount=100,
+                    payment_method="transfer",
+                    session_id=session_id,
+                )
+
+    def list_requests(self):
+        return [
+            path
+            for method, path in self.stripe_server.requests
+            if path.startswith("/v1/checkout/sessions?")
+        ]
+
+    def paid(self):
+        return set(
+            Payment.objects.filter(payment_status="paid").values_list(
+                "session_id", flat=True
+            )
+        )
+
+    def test_reconciles_page_by_page(self):
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(reconcile_payments(), 5)
+
+        self.assertEqual(self.paid(), {"cs_1", "cs_3", "cs_5"})
+        self.assertEqual(len(self.list_requests()), 3)
+        updates = [q for q in queries if q["sql"].startswith("UPDATE")]
+        self.assertEqual(len(updates), 3)
+        self.assertIsNone(cache.get(PAYMENT_RECONCILE_CURSOR_KEY))
+
+        # Окончательные статусы больше не сверяются, неоплаченные - да
+        self.assertEqual(reconcile_payments(), 0)
+        self.assertEqual(
+            set(Payment.objects.values_list("payment_status", flat=True)),
+            {"paid", "unpaid"},
+        )
+
+    def test_stores_stripe_time(self):
+        """Время статуса берется из ответа Stripe, а не по локальным часам"""
+        stripe_time = timezone.now().replace(microsecond=0) - timedelta(minutes=3)
+        self.stripe_server.clock = stripe_time.timestamp()
+        reconcile_payments()
+
+        self.assertEqual(
+            set(Payment.objects.values_list("status_updated_at", flat=True)),
+            {stripe_time},
+        )
+
+    def test_newer_status_not_overwritten(self):
+        """Статус, записанный webhook'ом позже ответа Stripe, сохраняется"""
+        webhook_time = timezone.now() + timedelta(minutes=1)
+        Payment.objects.filter(session_id="cs_1").update(
+            payment_status="unpaid", status_updated_at=webhook_time
+        )
+
+        self.assertEqual(reconcile_payments(), 4)
+        payment = Payment.objects.get(session_id="cs_1")
+        self.assertEqual(payment.payment_status, "unpaid")
+        self.assertEqual(payment.status_updated_at, webhook_time)
+
+    def test_resumes_from_cursor(self):
+        with override_settings(PAYMENT_RECONCILE_MAX_PAGES=1):
+            self.assertEqual(reconcile_payments(), 1)
+        self.assertEqual(self.paid(), {"cs_5"})
+        self.assertEqual(
+            cache.get(PAYMENT_RECONCILE_CURSOR_KEY)["starting_after"], "cs_5"
+        )
+
+        self.assertEqual(reconcile_payments(), 4)
+        self.assertIn("starting_after=cs_5", self.list_requests()[1])
+        self.assertEqual(self.paid(), {"cs_1", "cs_3", "cs_5"})
+
+    @override_settings(PAYMENT_RECONCILE_RATE=10)
+    def test_rate_limited(self):
+        with mock.patch("users.tasks.time.sleep") as sleep:
+            reconcile_payments()
+
+        self.assertEqual(sleep.call_count, 2)
+        for call in sleep.call_args_list:
+            self.assertLessEqual(call.args[0], 0.1)
+
+    def test_nothing_pending(self):
+        Payment.objects.update(payment_status="paid")
+        self.assertEqual(reconcile_payments(), 0)
+        self.assertEqual(self.stripe_server.requests, [])
+
+
+class StripeClientTestCase(MockStripeServerMixin, APITestCase):
+    """Клиент Stripe процесса: пул соединений, таймауты, повторы, предохранитель"""
+
+    def test_connection_reused(self):
+        for _ in range(3):
+            create_stripe_session("price_1")
+
+        self.assertEqual(len(self.stripe_requests("/v1/checkout/sessions")), 3)
+        self.assertEqual(self.stripe_server.connections, 1)
+        self.assertIsNotNone(get_metric("stripe.create_stripe_session.duration_ms"))
+
+    @override_settings(STRIPE_READ_TIMEOUT=0.1)
+    def test_read_timeout(self):
+        self.stripe_server.delay = 0.5
+        started = time.monotonic()
+        with self.assertRaises(stripe.APIConnectionError):
+            create_stripe_product("Slow")
+        self.assertLess(time.monotonic() - started, 0.5)
+
+    @override_settings(STRIPE_MAX_NETWORK_RETRIES=2)
+    def test_server_error_retried(self):
+        self.stripe_server.session_errors = [503]
+        session_id, _ = create_stripe_session("price_1")
+
+        self.assertTrue(session_id.startswith("cs_test_"))
+        self.assertEqual(len(self.stripe_requests("/v1/checkout/sessions")), 2)
+
+    @override_settings(STRIPE_BREAKER_THRESHOLD=2, STRIPE_BREAKER_RESET=0.2)
+    def test_circuit_breaker(self):
+        self.stripe_server.session_errors = [500, 500]
+        for _ in range(2):
+            with self.assertRaises(stripe.APIError):
+                create_stripe_session("price_1")
+
+        # Предохранитель разомкнут: запрос в Stripe не уходит
+        with self.assertRaises(CircuitOpenError):
+            create_stripe_session("price_1")
+        self.assertEqual(len(self.stripe_requests("/v1/checkout/sessions")), 2)
+
+        # После паузы пробный запрос проходит и замыкает предохранитель
+        time.sleep(0.25)
+        create_stripe_session("price_1")
+        create_stripe_session("price_1")
+        self.assertEqual(len(self.stripe_requests("/v1/checkout/sessions")), 4)
+
+
+class PaymentIdempotencyTestCase(MockStripeServerMixin, APITestCase):
+    """Повтор создания платежа с тем же Idempotency-Key не создает
+    второй платеж и не обращается к Stripe"""
+
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        self.user = User.objects.create(email="idempotent@test.com")
+        self.course = Course.objects.create(title="Idempotent Course")
+        self.url = reverse("users:payment-create")
+        self.data = {"course": self.course.pk, "amount": 1500, "payment_method": "cash"}
+        self.client.force_authenticate(user=self.user)
+
+    def pay(self, key, **data):
+        return self.client.post(
+            self.url, {**self.data, **data}, HTTP_IDEMPOTENCY_KEY=key
+        )
+
+    def test_retry_replays_response(self):
+        first = self.pay("key-1")
+        second = self.pay("key-1")
+
+        self.assertEqual(first.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(second.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(second.data, first.data)
+        self.assertEqual(second["Idempotent-Replayed"], "true")
+        self.assertEqual(Payment.objects.count(), 1)
+        self.assertEqual(len(self.stripe_requests("/v1/checkout/sessions")), 1)
+
+        self.pay("key-2")
+        self.assertEqual(Payment.objects.count(), 2)
+
+    def test_key_reused_with_other_request(self):
+        self.pay("key-1")
+        response = self.pay("key-1", amount=2000)
+
+        self.assertEqual(response.status_code, status.HTTP_422_UNPROCESSABLE_ENTITY)
+        self.assertEqual(Payment.objects.count(), 1)
+
+    def test_key_scoped_to_user(self):
+        self.pay("key-1")
+        self.client.force_authenticate(user=User.objects.create(email="other@test.com"))
+        self.assertNotIn("Idempotent-Replayed", self.pay("key-1"))
+        self.assertEqual(Payment.objects.count(), 2)
+
+    def in_flight(self, key):
+        cache_key = idempotency._cache_key(self.user.pk, key)
+        fingerprint = idempotency.request_fingerprint(
+            "POST", self.url, {k: str(v) for k, v in self.data.items()}
+        )
+        self.assertTrue(idempotency.acquire(cache_key, fingerprint))
+        return cache_key, fingerprint
+
+    def test_duplicate_waits_for_in_flight_request(self):
+        cache_key, fingerprint = self.in_flight("key-1")
+        timer = threading.Timer(
+            0.2,
+            idempotency.save_response,
+            args=(cache_key, fingerprint, 201, {"id": 42}, {}),
+        )
+        timer.start()
+        self.addCleanup(timer.cancel)
+
+        response = self.pay("key-1")
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.data, {"id": 42})
+        self.assertEqual(Payment.objects.count(), 0)
+        self.assertEqual(self.stripe_server.requests, [])
+
+    @override_settings(IDEMPOTENCY_WAIT=5)
+    def test_other_request_rejected_without_waiting(self):
+        """Другой запрос с ключом выполняющегося запроса сразу получает 422"""
+        self.in_flight("key-1")
+        started = time.monotonic()
+        response = self.pay("key-1", amount=2000)
+
+        self.assertEqual(response.status_code, status.HTTP_422_UNPROCESSABLE_ENTITY)
+        self.assertLess(time.monotonic() - started, 1)
+
+    @override_settings(IDEMPOTENCY_WAIT=0.2)
+    def test_in_flight_timeout(self):
+        """Не дождавшийся ответа повтор получает 409 с Retry-After"""
+        cache_key, _ = self.in_flight("key-1")
+        response = self.pay("key-1")
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+        self.assertEqual(response["Retry-After"], "1")
+
+        # Ключ запроса, завершившегося ошибкой, освобождается
+        idempotency.release(cache_key)
+        self.assertEqual(self.pay("key-1").status_code, status.HTTP_201_CREATED)
@@ -7,6 +7,7 @@ from .views import (
     PaymentCreateAPIView,
     PaymentStatusAPIView,
     PaymentRetrieveAPIView,
+    StripeWebhookAPIView,
 )
 
 
@@ -33,4 +34,5 @@ urlpatterns = [
         PaymentStatusAPIView.as_view(),
         name="payment-status",
     ),
+    path("payments/webhook/", StripeWebhookAPIView.as_view(), name="payment-webhook"),
 ]
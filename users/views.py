@@ -1,4 +1,14 @@
+from datetime import datetime
+from datetime import timezone as dt_timezone
+
+import logging
+
+import stripe
+from django.conf import settings
+from django.db import transaction
+from django.urls import reverse
 from django_filters.rest_framework import DjangoFilterBackend
+from rest_framework.exceptions import ValidationError
 from rest_framework.response import Response
 from rest_framework.filters import OrderingFilter
 from rest_framework.generics import RetrieveUpdateDestroyAPIView, get_object_or_404
@@ -6,6 +16,8 @@ from rest_framework import generics
 from rest_framework.permissions import AllowAny, IsAuthenticated
 from rest_framework.views import APIView
 from rest_framework import status
+from lms.paginators import SelectablePaginationMixin
+from .idempotency import IdempotencyMixin
 from .permissions import IsOwnerOrReadOnly
 from .models import User, Payment
 from .serializers import (
@@ -15,11 +27,16 @@ from .serializers import (
     UserPublicProfileSerializer,
 )
 from .services import (
-    create_stripe_product,
-    create_stripe_price,
     create_stripe_session,
-    check_payment_status,
+    fail_checkouts,
+    get_payment_status,
+    get_stripe_price_id,
+    record_payment_status,
+    wait_checkout_status,
 )
+from .tasks import create_checkout_session
+
+logger = logging.getLogger(__name__)
 
 
 class UserCreateAPIView(generics.CreateAPIView):
@@ -52,8 +69,10 @@ class UserProfileRetrieveUpdateDestroyAPIView(RetrieveUpdateDestroyAPIView):
         return UserPublicProfileSerializer
 
 
-class PaymentListAPIView(generics.ListAPIView):
-    """Вывод списка платежей с фильтрацией и сортировкой"""
+class PaymentListAPIView(SelectablePaginationMixin, generics.ListAPIView):
+    """Вывод списка платежей с фильтрацией и сортировкой.
+    По умолчанию без пагинации, ?pagination=cursor - курсорная пагинация
+    (всегда по id: ?ordering= в этом режиме не применяется)"""
 
     queryset = Payment.objects.all()
     serializer_class = PaymentSerializer
@@ -62,54 +81,98 @@ class PaymentListAPIView(generics.ListAPIView):
     filterset_fields = ("course", "lesson", "payment_method")
 
     ordering_fields = ("payment_date",)
+    ordering = ("id",)
 
 
-class PaymentCreateAPIView(generics.CreateAPIView):
-    """эндпоинт для создания платежа"""
+class PaymentCreateAPIView(IdempotencyMixin, generics.CreateAPIView):
+    """эндпоинт для создания платежа.
+    В асинхронном режиме (PAYMENT_CHECKOUT_ASYNC или заголовок
+    Prefer: respond-async) платеж сохраняется сразу, ответ - 202 с id платежа,
+    а сессию оплаты Stripe создает задача create_checkout_session.
+    Повтор запроса с тем же Idempotency-Key получает сохраненный ответ"""
 
     serializer_class = PaymentSerializer
 
-    def perform_create(self, serializer):
-        # Сохраняем платеж в базе, чтоб получить объект payment
-        payment = serializer.save()
+    def is_async(self):
+        prefer = self.request.headers.get("Prefer", "")
+        return settings.PAYMENT_CHECKOUT_ASYNC or "respond-async" in prefer
 
-        # Определяем за что платим (курс или урок) для названия продукта
-        product_name = "Oplata"
-        if payment.course:
-            product_name = payment.course.title
-        elif payment.lesson:
-            product_name = payment.lesson.title
+    def create(self, request, *args, **kwargs):
+        if not self.is_async():
+            return super().create(request, *args, **kwargs)
 
-        # Создаем продукт в Stripe
-        product_id = create_stripe_product(product_name)
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        payment = serializer.save(checkout_status=Payment.CHECKOUT_PENDING)
+        # Задача должна увидеть уже закоммиченную строку платежа
+        transaction.on_commit(lambda: self.enqueue_checkout(payment.pk))
+
+        location = reverse("users:payment-detail", args=(payment.pk,))
+        return Response(
+            serializer.data,
+            status=status.HTTP_202_ACCEPTED,
+            headers={"Location": location},
+        )
 
-        # Создаем цену в Stripe
-        price_id = create_stripe_price(product_id, payment.amount)
+    def enqueue_checkout(self, payment_id):
+        """Ставит создание сессии в очередь. Если брокер недоступен,
+        платеж сразу помечается failed, а не остается pending"""
+        try:
+            create_checkout_session.delay(payment_id)
+        except Exception:
+            logger.exception("Не удалось поставить в очередь платеж %s", payment_id)
+            fail_checkouts([payment_id])
+
+    def perform_create(self, serializer):
+        # Цена Stripe для курса/урока и суммы (создается только при первой оплате)
+        data = serializer.validated_data
+        price_id = get_stripe_price_id(
+            data.get("course"), data.get("lesson"), data["amount"]
+        )
 
         # Создаем сессию оплаты и получаем ID сессии и ссылку
         session_id, payment_link = create_stripe_session(price_id)
 
-        # Сохраняем данные в наш объект платежа
-        payment.session_id = session_id
-        payment.link = payment_link
-        payment.save()
+        # Сохраняем платеж вместе с данными сессии одним INSERT
+        serializer.save(session_id=session_id, link=payment_link)
 
 
 class PaymentRetrieveAPIView(generics.RetrieveAPIView):
+    """Платеж со статусом сессии оплаты (checkout_status).
+    Пока сессия создается, ?wait=N ждет ссылку до N секунд
+    (не дольше PAYMENT_CHECKOUT_MAX_WAIT), опрашивая только кэш.
+    Все это время запрос занимает воркер, поэтому максимум небольшой"""
+
     queryset = Payment.objects.all()
     serializer_class = PaymentSerializer
 
+    def get_wait(self):
+        try:
+            wait = float(self.request.query_params.get("wait", 0))
+        except ValueError:
+            raise ValidationError({"wait": ["Ожидается число"]})
+        return max(0.0, min(wait, settings.PAYMENT_CHECKOUT_MAX_WAIT))
+
+    def retrieve(self, request, *args, **kwargs):
+        wait = self.get_wait()
+        payment = self.get_object()
+        if payment.checkout_status == Payment.CHECKOUT_PENDING and wait:
+            wait_checkout_status(payment.pk, wait)
+            payment.refresh_from_db(fields=["checkout_status", "session_id", "link"])
+        return Response(self.get_serializer(payment).data)
+
 
 class PaymentStatusAPIView(APIView):
-    """принимает ID платежа, ищет session_id и спрашивает у Stripe статус"""
+    """принимает ID платежа и отдает статус оплаты. Статус приходит
+    webhook'ом Stripe, в Stripe запрос уходит только если статус устарел"""
 
     def get(self, request, pk):
         # Получаем платеж по id из базы
         payment = get_object_or_404(Payment, pk=pk)
 
-        # Если есть session_id, проверяем статус в Stripe
+        # Если есть session_id, отдаем сохраненный статус
         if payment.session_id:
-            status_data = check_payment_status(payment.session_id)
+            status_data = get_payment_status(payment)
             return Response(
                 data={"status": status_data, "payment_id": payment.pk},
                 status=status.HTTP_200_OK,
@@ -118,3 +181,47 @@ class PaymentStatusAPIView(APIView):
             data={"error": "У этого платежа нет Stripe session_id."},
             status=status.HTTP_400_BAD_REQUEST,
         )
+
+
+class StripeWebhookAPIView(APIView):
+    """Принимает события Stripe о сессиях оплаты и сохраняет статус оплаты.
+    Запрос аутентифицируется подписью Stripe-Signature"""
+
+    authentication_classes = ()
+    permission_classes = (AllowAny,)
+
+    # События, после которых меняется payment_status сессии
+    session_events = (
+        "checkout.session.completed",
+        "checkout.session.async_payment_succeeded",
+        "checkout.session.async_payment_failed",
+        "checkout.session.expired",
+    )
+
+    def post(self, request):
+        # Без секрета подпись проверить нельзя - события не принимаются
+        if not settings.STRIPE_WEBHOOK_SECRET:
+            return Response(
+                data={"error": "Webhook Stripe не настроен."},
+                status=status.HTTP_503_SERVICE_UNAVAILABLE,
+            )
+        try:
+            event = stripe.Webhook.construct_event(
+                request.body,
+                request.headers.get("Stripe-Signature", ""),
+                settings.STRIPE_WEBHOOK_SECRET,
+            )
+        except (ValueError, stripe.SignatureVerificationError):
+            return Response(
+                data={"error": "Неверная подпись Stripe."},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
+        if event.type in self.session_events:
+            session = event.data.object
+            record_payment_status(
+                session.id,
+                session.get("payment_status"),
+                datetime.fromtimestamp(event.created, tz=dt_timezone.utc),
+            )
+        return Response(status=status.HTTP_200_OK)